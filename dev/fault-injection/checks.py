@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    checks.py
+# @brief   Pass/fail checks of Martian behaviors, run against the fault server
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/martian
+# =============================================================================
+#
+# Where harness.py measures how downloads cope with faults, this runs short
+# checks of things that are either right or wrong, each against the local
+# fault-injecting server in faultserver.py, and prints "ok" or the problem
+# found for each one.  The exit status is 1 if any check failed.
+#
+# Usage:
+#
+#   python3 checks.py                    # run all checks
+#   python3 checks.py service-recurring
+#   python3 checks.py --list
+
+import argparse
+import os
+from   os import path
+import shutil
+import sys
+import tempfile
+import time
+
+# Allow this program to be executed directly from the dev directory.
+here = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(here, '..', '..'))
+
+import martian.network
+
+from faultserver import Fault, FaultServer
+
+
+# Checks.
+# .............................................................................
+# Each check is called with the server (with no faults scheduled) and a
+# scratch directory, and returns None if all is well or a description of
+# the problem.
+
+CHECKS = {}
+
+def check(name):
+    def register(func):
+        CHECKS[name] = func
+        return func
+    return register
+
+
+@check('service-recurring')
+def service_recurring(server, directory):
+    '''Two runs of a recurring job whose output name has no "{time}".'''
+    from martian.service import HarvestService
+    service = HarvestService(directory, workers = 1)
+    service.start()
+    try:
+        job = service.submit({'search': 'synthetic', 'host': server.host,
+                              'output': 'nightly.xml', 'schedule': '0 0 1 1 *'})
+        runs = []
+        for n in range(2):
+            if n:
+                time.sleep(1.1)         # Run times are stamped to the second.
+            service._launch(service._jobs[job['id']])
+            runs = [j for j in service.list() if j['parent'] == job['id']]
+            wait_for(service, [run['id'] for run in runs])
+        runs = [service.get(run['id']) for run in runs]
+        problems = ['run {} is {}: {}'.format(run['id'], run['status'], run['error'])
+                    for run in runs if run['status'] != 'done']
+        if len({run['output'] for run in runs}) != len(runs):
+            problems.append('runs wrote to the same file')
+        return '; '.join(problems) or None
+    finally:
+        service.stop()
+
+
+@check('service-history')
+def service_history(server, directory):
+    '''Only service jobs that get a whole search go into the history.'''
+    from martian.service import HarvestService
+    service = HarvestService(directory, workers = 1)
+    service.start()
+    try:
+        specs = [{'search': 'synthetic', 'host': server.host, 'total': 100},
+                 {'search': 'synthetic', 'host': server.host, 'start': 201},
+                 {'search': 'synthetic', 'host': server.host}]
+        wait_for(service, [service.submit(spec)['id'] for spec in specs])
+    finally:
+        service.stop()
+    runs = history_rows(path.join(directory, 'history.db'))
+    if runs != 1:
+        return 'history has {} runs instead of 1'.format(runs)
+    return None
+
+
+@check('service-lost-pages')
+def service_lost_pages(server, directory):
+    '''A service job that loses a page is incomplete and logs the page.'''
+    from martian.failures import read_failures
+    from martian.service import HarvestService
+    server.schedule([Fault('page', 2, 1, '404')])
+    service = HarvestService(directory, workers = 1)
+    service.start()
+    try:
+        job = service.submit({'search': 'synthetic', 'host': server.host})
+        wait_for(service, [job['id']])
+        job = service.get(job['id'])
+    finally:
+        service.stop()
+    if job['status'] != 'incomplete' or job['failed'] != 1:
+        return 'job is {} with {} failed pages'.format(job['status'], job['failed'])
+    if not job['failure_log'] or len(read_failures(job['failure_log'])) != 1:
+        return 'failure log {} does not list the page'.format(job['failure_log'])
+    if history_rows(path.join(directory, 'history.db')):
+        return 'the job was added to the history'
+    return None
+
+
+@check('replay-offline')
+def replay_offline(server, directory):
+    '''A cassette recorded from the server replays without a network.'''
+    cassette = path.join(directory, 'run.cassette')
+    outputs = [path.join(directory, name) for name in ['recorded.xml', 'replayed.xml']]
+    run_martian(['-H', server.host, '-o', outputs[0], '-R', cassette, 'synthetic'],
+                network = True)
+    result = run_martian(['-H', server.host, '-o', outputs[1], '-Q', cassette + ',0',
+                          'synthetic'], network = False)
+    if result.returncode != 0:
+        return 'replay exited with status {}: {}'.format(result.returncode,
+                                                         result.stderr.strip()[-200:])
+    if 'No network connection' in result.stdout + result.stderr:
+        return 'replay reported that there is no network connection'
+    with open(outputs[0], 'rb') as recorded, open(outputs[1], 'rb') as replayed:
+        if recorded.read() != replayed.read():
+            return 'the replayed output differs from the recorded one'
+    return None
+
+
+# Helpers.
+# .............................................................................
+
+def wait_for(service, ids, timeout = 60):
+    '''Waits until the service jobs 'ids' have finished.'''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(service.get(id)['finished'] for id in ids):
+            return
+        time.sleep(0.1)
+    raise TimeoutError('jobs did not finish within {} s'.format(timeout))
+
+
+def history_rows(file):
+    '''Returns the number of runs in the History database 'file'.'''
+    import sqlite3
+    if not path.exists(file):
+        return 0
+    db = sqlite3.connect(file)
+    try:
+        return db.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+    finally:
+        db.close()
+
+
+def run_martian(args, network):
+    '''Runs Martian on the command line with 'args' in a separate process,
+    with network_available() patched to return 'network'.  Returns the
+    subprocess.CompletedProcess.'''
+    import subprocess
+    code = ('import sys, martian.network;'
+            ' martian.network.network_available = lambda: {};'
+            ' sys.argv = ["martian"] + sys.argv[1:];'
+            ' import runpy; runpy.run_module("martian", run_name = "__main__")'
+            .format(network))
+    env = dict(os.environ, PYTHONPATH = path.join(here, '..', '..'))
+    return subprocess.run([sys.executable, '-c', code, '-G'] + args, env = env,
+                          stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True)
+
+
+def run_check(server, name):
+    server.schedule([])
+    directory = tempfile.mkdtemp(prefix = 'martian-check-')
+    try:
+        return CHECKS[name](server, directory)
+    except Exception as ex:
+        return '{}: {}'.format(type(ex).__name__, ex)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+
+# Main entry point.
+# .............................................................................
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Pass/fail checks of Martian')
+    parser.add_argument('checks', nargs = '*', help = 'checks to run (default: all)')
+    parser.add_argument('--records', type = int, default = 1000)
+    parser.add_argument('--list', action = 'store_true', help = 'list checks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, func in CHECKS.items():
+            print('{:<22} {}'.format(name, func.__doc__))
+        sys.exit()
+
+    names = args.checks or list(CHECKS)
+    unknown = [n for n in names if n not in CHECKS]
+    if unknown:
+        sys.exit('Unknown check(s): {}'.format(', '.join(unknown)))
+
+    server = FaultServer(num_records = args.records).start()
+    martian.network.network_available = lambda: True
+    failed = 0
+    try:
+        for name in names:
+            problem = run_check(server, name)
+            print('{:<22} {}'.format(name, 'FAILED: ' + problem if problem else 'ok'))
+            failed += bool(problem)
+    finally:
+        server.stop()
+    sys.exit(1 if failed else 0)
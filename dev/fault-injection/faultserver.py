@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    faultserver.py
+# @brief   Local stand-in for caltech.tind.io that injects faults on a schedule
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/martian
+# =============================================================================
+#
+# This server answers the two kinds of requests Martian makes to TIND:
+#
+#  * the preliminary HTML search used to learn how many records to expect
+#    (the "probe"), which contains a "N records found" cell, and
+#  * the MARC XML pages requested with "of=xm", "jrec" and "rg".
+#
+# The records are synthetic, but numbered, so that a harvest against this
+# server can be checked for completeness afterwards.  Record number N has
+# record id (recid) N, and a search that contains "recid:A->B" matches only
+# records A to B, so partitioned harvests can be exercised too.  Collections
+# named "every-K" (given with "c=" as in TIND search URLs) hold the records
+# whose numbers are multiples of K, so collections can overlap.  To mimic
+# the way deep offsets get slower on the real server, each page can be
+# delayed in proportion to its starting offset ('offset_delay').
+#
+# The server also imitates TIND's authenticated API at /api/v1/search, as
+# used by Martian's "api" backend: requests must carry the header
+# "Authorization: Token KEY" (KEY is 'api_key', "secret" by default),
+# responses report the total number of results in an XML comment, and pages
+# after the first are requested with the "search_id" from the previous one.
+#
+# A schedule of faults can be installed; each fault applies to a range of
+# request numbers for one kind of request ('probe' or 'page').  Every request
+# is logged with the time it arrived and the fault (if any) that was applied
+# to it, so that a harness can compute when problems started and when the
+# client recovered.
+#
+# Run it directly to get a server with no faults, for manual exploration:
+#
+#   python3 faultserver.py --port 8080 --records 1000
+
+import argparse
+import re
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import struct
+from   threading import Lock, Thread
+import time
+from   urllib.parse import urlsplit, parse_qs, unquote
+
+
+# Fault definitions.
+# .............................................................................
+
+class Fault(object):
+    '''A fault to inject into requests number 'first' through 'first + count -
+    1' (counting from 1) of kind 'target', which is 'probe' or 'page'.
+
+    'kind' is one of:
+      '429'       -- answer with code 429 and a Retry-After header ('retry_after')
+      '503'       -- answer with code 503 Service Unavailable
+      '404'       -- answer with code 404 Not Found, which is not retried
+      'reset'     -- drop the connection with a TCP reset before answering
+      'slow'      -- send the correct body, but drip it at 'rate' bytes/second
+      'truncated' -- send the headers and part of the body, then close
+      'hang'      -- send the headers and part of the body, then go silent
+                     for 'retry_after' seconds with the connection open
+    '''
+
+    def __init__(self, target, first, count, kind, retry_after = 1, rate = 20000):
+        self.target      = target
+        self.first       = first
+        self.count       = count
+        self.kind        = kind
+        self.retry_after = retry_after
+        self.rate        = rate
+
+
+    def applies(self, target, number):
+        return (target == self.target
+                and self.first <= number < self.first + self.count)
+
+
+    def __repr__(self):
+        return '<Fault {} on {} #{}-{}>'.format(self.kind, self.target, self.first,
+                                                self.first + self.count - 1)
+
+
+# Server.
+# .............................................................................
+
+class FaultServer(object):
+    '''A threaded HTTP server pretending to be TIND, with scheduled faults.'''
+
+    def __init__(self, port = 0, num_records = 1000, host = '127.0.0.1',
+                 offset_delay = 0, api_key = 'secret'):
+        self.num_records  = num_records
+        self.offset_delay = offset_delay
+        self.api_key      = api_key
+        self._faults     = []
+        self._counts     = {'probe': 0, 'page': 0}
+        self._log        = []
+        self._lock       = Lock()
+        self._httpd      = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._httpd.daemon_threads = True
+        self._thread     = None
+
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+
+    @property
+    def host(self):
+        '''The URL of this server, to use as the host given to Martian's
+        backends (or in place of martian.backends._DEFAULT_HOST).'''
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+
+    @property
+    def base_url(self):
+        return self.host + '/search?ln=en'
+
+
+    def start(self):
+        self._thread = Thread(target = self._httpd.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+    def schedule(self, faults):
+        '''Replaces the fault schedule and resets request counts and the log.'''
+        with self._lock:
+            self._faults = list(faults)
+            self._counts = {'probe': 0, 'page': 0}
+            self._log    = []
+
+
+    def log(self):
+        '''Returns a list of (time, target, number, fault kind or None).'''
+        with self._lock:
+            return list(self._log)
+
+
+    def _next(self, target):
+        with self._lock:
+            self._counts[target] += 1
+            number = self._counts[target]
+            fault = next((f for f in self._faults if f.applies(target, number)), None)
+            self._log.append((time.monotonic(), target, number,
+                              fault.kind if fault else None))
+            return fault
+
+
+    def matching(self, search, collections = ()):
+        '''Returns the record numbers matched by 'search' in 'collections'.'''
+        match = re.search(r'recid:(\d+)->(\d+)', unquote(search))
+        if match:
+            numbers = range(max(1, int(match.group(1))),
+                            min(self.num_records, int(match.group(2))) + 1)
+        else:
+            numbers = range(1, self.num_records + 1)
+        if not collections:
+            return numbers
+        factors = [int(c.split('-')[1]) for c in collections]
+        return [n for n in numbers if any(n % k == 0 for k in factors)]
+
+
+    def probe_body(self, search = '', collections = ()):
+        # Like TIND, report one count per collection.
+        counts = [len(self.matching(search, [c])) for c in collections] \
+                 or [len(self.matching(search))]
+        cells = ''.join('<tr><td class="searchresultsboxheader"><strong>{:,}'
+                        '</strong> records found</td></tr>'.format(n) for n in counts)
+        return ('<html><body><table>' + cells + '</table></body></html>').encode('utf-8')
+
+
+    def page_body(self, start, count, search = '', api = False, collections = ()):
+        matching = self.matching(search, collections)
+        records = matching[start - 1 : start - 1 + count]
+        parts = [b'<?xml version="1.0" encoding="UTF-8"?>\n',
+                 b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n']
+        if api:
+            parts.append('<!-- Search-Engine-Total-Number-Of-Results: {} -->\n'
+                         .format(len(matching)).encode('utf-8'))
+            if start + count <= len(matching):
+                parts.append('<search_id>S{}</search_id>\n'
+                             .format(start + count).encode('utf-8'))
+        for n in records:
+            parts.append(_record(n))
+        parts.append(b'</collection>\n')
+        return b''.join(parts)
+
+
+def _record(n):
+    return ('<record>\n'
+            '  <controlfield tag="001">{0}</controlfield>\n'
+            '  <controlfield tag="005">20210101000000.0</controlfield>\n'
+            '  <datafield tag="245" ind1="0" ind2="0">\n'
+            '    <subfield code="a">Synthetic record number {0}</subfield>\n'
+            '  </datafield>\n'
+            '</record>\n').format(n).encode('utf-8')
+
+
+def _handler_for(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            search = query.get('p', [''])[0]
+            collections = query.get('c', [])
+            if url.path == '/api/v1/search':
+                if self.headers.get('Authorization') != 'Token ' + server.api_key:
+                    self.send_response(401)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                search_id = query.get('search_id', [''])[0]
+                start = int(search_id[1:]) if search_id else 1
+                count = int(query.get('rg', ['100'])[0])
+                target = 'page' if search_id or count > 1 else 'probe'
+                body = server.page_body(start, count, search, api = True,
+                                        collections = collections)
+                content_type = 'application/xml'
+            elif query.get('of', [''])[0] == 'xm':
+                target = 'page'
+                start = int(query.get('jrec', ['1'])[0])
+                count = int(query.get('rg', ['10'])[0])
+                body = server.page_body(start, count, search,
+                                        collections = collections)
+                content_type = 'application/xml'
+                time.sleep(server.offset_delay * start / 1000)
+            else:
+                target = 'probe'
+                body = server.probe_body(search, collections)
+                content_type = 'text/html'
+
+            fault = server._next(target)
+            kind = fault.kind if fault else None
+            if kind == 'reset':
+                # SO_LINGER with a zero timeout makes close() send a RST.
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                           struct.pack('ii', 1, 0))
+                self.connection.close()
+                self.close_connection = True
+                return
+            if kind in ['404', '429', '503']:
+                text = b'<html><body>Try again later</body></html>'
+                self.send_response(int(kind))
+                if kind == '429':
+                    self.send_header('Retry-After', str(fault.retry_after))
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if kind == 'truncated':
+                self.wfile.write(body[: len(body) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+            elif kind == 'hang':
+                self.wfile.write(body[: len(body) // 2])
+                self.wfile.flush()
+                time.sleep(fault.retry_after)
+                self.close_connection = True
+            elif kind == 'slow':
+                chunk = max(1, fault.rate // 10)
+                for i in range(0, len(body), chunk):
+                    self.wfile.write(body[i : i + chunk])
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            else:
+                self.wfile.write(body)
+
+    return Handler
+
+
+# Main entry point.
+# .............................................................................
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fault-injecting TIND stand-in')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--records', type = int, default = 1000)
+    parser.add_argument('--offset-delay', type = float, default = 0,
+                        help = 'seconds of delay per 1000 records of page offset')
+    args = parser.parse_args()
+    server = FaultServer(args.port, args.records, offset_delay = args.offset_delay).start()
+    print('Serving {} records at {}'.format(args.records, server.base_url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
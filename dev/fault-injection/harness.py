@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    harness.py
+# @brief   Measure how Martian's network layer copes with an unhealthy server
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/martian
+# =============================================================================
+#
+# This runs complete Martian downloads (the count probe done by network.net()
+# followed by the MARC page loop in Tind) against the local fault-injecting
+# server in faultserver.py, once per scenario, and reports for each one:
+#
+#  * the outcome: "ok", "error" (the download raised an exception), "hung"
+#    (the download did not return within --deadline seconds), or "corrupt"
+#    (the download returned but the output file is not well-formed XML or
+#    does not contain exactly the expected records);
+#  * the elapsed time and records/second, and the throughput loss relative
+#    to the fault-free baseline scenario;
+#  * the time to recover: from the first faulty response to the first good
+#    response after the last faulty one (blank if the client never got a
+#    good response after the faults);
+#  * the time spent in Martian's own back-off pauses: the sleeps done by
+#    martian.network around the count probe, plus the waits before failed
+#    pages are fetched again (see martian/failures.py).
+#
+# Scenarios listed in CONNECTIONS download through a TransportPool allowing
+# only that many connections at once, like a Client created with the same
+# 'connections', to check that retries can't wait forever for a connection.
+#
+# Martian's back-off pauses are long (minutes, in some cases), so by default
+# both kinds are scaled down by --time-scale.  The reported back-off time is
+# the unscaled value Martian asked for.
+#
+# Usage:
+#
+#   python3 harness.py                   # run all scenarios
+#   python3 harness.py page-reset probe-429
+#   python3 harness.py --list
+
+import argparse
+import os
+from   os import path
+import sys
+import tempfile
+from   threading import Thread
+import time
+from   xml.etree import ElementTree
+
+# Allow this program to be executed directly from the dev directory.
+here = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(here, '..', '..'))
+
+import martian.backends
+import martian.network
+from   martian.failures import RetryPolicy
+from   martian.tind import Tind
+from   martian.transport import TransportPool
+
+from faultserver import Fault, FaultServer
+
+
+# Scenarios.
+# .............................................................................
+
+SCENARIOS = {
+    'baseline'        : [],
+    'probe-429'       : [Fault('probe', 1, 3, '429', retry_after = 2)],
+    'probe-503-burst' : [Fault('probe', 1, 4, '503')],
+    'probe-reset'     : [Fault('probe', 1, 2, 'reset')],
+    'page-429'        : [Fault('page', 2, 3, '429', retry_after = 2)],
+    'page-503-burst'  : [Fault('page', 2, 4, '503')],
+    'page-reset'      : [Fault('page', 3, 1, 'reset')],
+    'page-slow'       : [Fault('page', 2, 3, 'slow', rate = 100000)],
+    'page-truncated'  : [Fault('page', 3, 1, 'truncated')],
+    'page-503-1-conn' : [Fault('page', 2, 1, '503')],
+}
+
+CONNECTIONS = {
+    'page-503-1-conn' : 1,
+}
+
+
+# Stand-ins for the user interface objects that Tind expects.
+# .............................................................................
+
+class QuietNotifier(object):
+    def __init__(self):
+        self.messages = []
+
+    def _note(self, text, details = ''):
+        self.messages.append(text)
+
+    info = warn = error = fatal = _note
+
+
+class QuietTracer(object):
+    def start(self, message = None): pass
+    def update(self, message = None): pass
+    def progress(self, done, total, nbytes = 0): pass
+    def stop(self, message = None): pass
+
+
+class ScaledSleep(object):
+    '''Replacement for time.sleep that shrinks pauses and totals them.'''
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.total = 0
+
+    def __call__(self, seconds):
+        self.total += seconds
+        time.sleep(seconds * self.scale)
+
+
+class ScaledRetryPolicy(RetryPolicy):
+    '''RetryPolicy whose waits before retries of pages are shrunk by the
+    same factor as the sleeps, and added to the same total.'''
+
+    def __init__(self, sleeper):
+        super().__init__()
+        self.sleeper = sleeper
+
+    def wait_after(self, attempt):
+        seconds = super().wait_after(attempt)
+        self.sleeper.total += seconds
+        return seconds * self.sleeper.scale
+
+
+# Measurement.
+# .............................................................................
+
+def run_scenario(server, name, faults, num_records, sleeper, deadline):
+    server.schedule(faults)
+    sleeper.total = 0
+    (fd, output) = tempfile.mkstemp(suffix = '.xml')
+    os.close(fd)
+    outcome = 'ok'
+    detail = ''
+    start = time.monotonic()
+    limit = CONNECTIONS.get(name)
+    pool = TransportPool(size = limit, limit = limit) if limit else None
+    tind = Tind(None, QuietNotifier(), QuietTracer(), pool = pool,
+                retry_policy = ScaledRetryPolicy(sleeper))
+    errors = []
+
+    def download():
+        try:
+            tind.download('synthetic', output)
+        except Exception as ex:
+            errors.append(ex)
+
+    thread = Thread(target = download, daemon = True)
+    thread.start()
+    thread.join(deadline)
+    if thread.is_alive():
+        outcome = 'hung'
+        detail = 'no result after {} s'.format(deadline)
+    elif errors:
+        outcome = 'error'
+        detail = '{}: {}'.format(type(errors[0]).__name__, errors[0])
+    elapsed = time.monotonic() - start
+
+    if outcome == 'ok':
+        problem = check_output(output, num_records)
+        if problem:
+            outcome = 'corrupt'
+            detail = problem
+    if outcome != 'hung':
+        os.remove(output)
+
+    return {'name'      : name,
+            'outcome'   : outcome,
+            'detail'    : detail,
+            'elapsed'   : elapsed,
+            'rate'      : num_records / elapsed if outcome == 'ok' else 0,
+            'recovery'  : recovery_time(server.log()),
+            'backoff'   : sleeper.total,
+            'requests'  : len(server.log())}
+
+
+def check_output(output, num_records):
+    '''Returns None if 'output' has exactly records 1..num_records, else a
+    description of the problem.'''
+    try:
+        tree = ElementTree.parse(output)
+    except ElementTree.ParseError as ex:
+        return 'not well-formed XML ({})'.format(ex)
+    ns = '{http://www.loc.gov/MARC21/slim}'
+    ids = [int(cf.text) for cf in tree.iter(ns + 'controlfield')
+           if cf.get('tag') == '001']
+    if sorted(ids) != list(range(1, num_records + 1)):
+        return 'got {} records ({} distinct), expected {}'.format(
+            len(ids), len(set(ids)), num_records)
+    return None
+
+
+def recovery_time(log):
+    '''Time from the first faulty response to the first good response after
+    the last faulty one, or None if there were no faults or no recovery.'''
+    faulty = [i for i, entry in enumerate(log) if entry[3] is not None]
+    if not faulty:
+        return None
+    after = [entry for entry in log[faulty[-1] + 1:] if entry[3] is None]
+    if not after:
+        return None
+    return after[0][0] - log[faulty[0]][0]
+
+
+def report(results):
+    baseline = next((r['rate'] for r in results if r['name'] == 'baseline'), None)
+    header = '{:<17} {:<8} {:>9} {:>10} {:>8} {:>10} {:>9} {:>5}'
+    row    = '{:<17} {:<8} {:>9.2f} {:>10.0f} {:>8} {:>10} {:>9.1f} {:>5}'
+    print(header.format('scenario', 'outcome', 'time (s)', 'records/s',
+                        'loss', 'recover(s)', 'backoff', 'reqs'))
+    for r in results:
+        loss = ('{:.0%}'.format(1 - r['rate'] / baseline)
+                if baseline and r['outcome'] == 'ok' else '-')
+        recovery = '{:.2f}'.format(r['recovery']) if r['recovery'] is not None else '-'
+        print(row.format(r['name'], r['outcome'], r['elapsed'], r['rate'], loss,
+                         recovery, r['backoff'], r['requests']))
+    for r in results:
+        if r['detail']:
+            print('  {}: {}'.format(r['name'], r['detail']))
+
+
+# Main entry point.
+# .............................................................................
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fault-injection harness for Martian')
+    parser.add_argument('scenarios', nargs = '*', help = 'scenarios to run (default: all)')
+    parser.add_argument('--records', type = int, default = 2000)
+    parser.add_argument('--page-size', type = int, default = 200)
+    parser.add_argument('--time-scale', type = float, default = 0.01,
+                        help = 'multiplier applied to Martian back-off pauses')
+    parser.add_argument('--deadline', type = float, default = 120,
+                        help = 'seconds after which a download is reported as hung')
+    parser.add_argument('--list', action = 'store_true', help = 'list scenarios and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, faults in SCENARIOS.items():
+            print('{:<17} {}'.format(name, faults or 'no faults'))
+        sys.exit()
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        sys.exit('Unknown scenario(s): {}'.format(', '.join(unknown)))
+    if 'baseline' not in names:
+        names.insert(0, 'baseline')
+
+    server = FaultServer(num_records = args.records).start()
+    sleeper = ScaledSleep(args.time_scale)
+    martian.backends._DEFAULT_HOST = server.host
+    martian.backends._SEARCH_PAGE_SIZE = args.page_size
+    martian.network.sleep = sleeper
+    martian.network.network_available = lambda: True
+
+    try:
+        results = [run_scenario(server, name, SCENARIOS[name], args.records, sleeper,
+                                args.deadline)
+                   for name in names]
+    finally:
+        server.stop()
+    report(results)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    check_import_time.py
+# @brief   Check that Martian's command-line startup stays fast and headless
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/martian
+# =============================================================================
+#
+# Martian is often run from cron and batch jobs, which pay its startup cost
+# on every run.  This script imports martian.__main__ in a fresh interpreter
+# using Python's -X importtime option, and fails (with exit status 1) if
+#
+#  * any of the modules that should only be loaded on demand were imported
+#    (WxPython, BeautifulSoup, lxml, pycurl, requests, etc.), or
+#  * the cumulative import time of martian.__main__ exceeds the budget.
+#
+# The budget includes third-party modules Martian needs at startup (notably
+# plac), so the default is deliberately generous; the point is to catch
+# regressions, such as someone adding a top-level "import wx".
+#
+# Usage:
+#
+#   python3 check_import_time.py [--budget MILLISECONDS] [--runs N]
+
+import argparse
+from   os import path
+import subprocess
+import sys
+
+here = path.dirname(path.abspath(__file__))
+top  = path.abspath(path.join(here, '..', '..'))
+
+# Modules that must not be loaded just by starting the command-line program.
+LAZY_MODULES = ['wx', 'pubsub', 'bs4', 'lxml', 'pycurl', 'requests', 'urllib3',
+                'humanize', 'webbrowser']
+
+
+def import_times(optimize):
+    '''Returns a list of (nesting level, module name, cumulative import time
+    in µs), in the order reported by python -X importtime.'''
+    cmd = [sys.executable, '-X', 'importtime']
+    if optimize:
+        cmd.append('-O')
+    cmd += ['-c', 'import martian.__main__']
+    proc = subprocess.run(cmd, cwd = top, capture_output = True, text = True)
+    if proc.returncode != 0:
+        sys.exit('Failed to import martian.__main__:\n' + proc.stderr)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        (_, cumulative, name) = line.split('|')
+        level = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        times.append((level, name.strip(), int(cumulative)))
+    return times
+
+
+def main_imports(times):
+    '''Returns the entry for martian.__main__ and the entries for the modules
+    it imported directly.  (Children are listed before their parents.)'''
+    index = next(i for i, entry in enumerate(times) if entry[1] == 'martian.__main__')
+    children = []
+    for entry in reversed(times[:index]):
+        if entry[0] == 0:
+            break
+        if entry[0] == 1:
+            children.append(entry)
+    return (times[index], children)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Check Martian import time')
+    parser.add_argument('--budget', type = int, default = 200,
+                        help = 'maximum import time in milliseconds (default: 200)')
+    parser.add_argument('--runs', type = int, default = 5,
+                        help = 'number of runs; the fastest is used (default: 5)')
+    parser.add_argument('-O', dest = 'optimize', action = 'store_true',
+                        help = 'run Python with -O (as in production)')
+    args = parser.parse_args()
+
+    runs = [import_times(args.optimize) for _ in range(args.runs)]
+    best = min(runs, key = lambda times: main_imports(times)[0][2])
+    (main, children) = main_imports(best)
+    failed = False
+
+    loaded = sorted(set(name for (_, name, _) in best
+                        if name.split('.')[0] in LAZY_MODULES))
+    if loaded:
+        failed = True
+        print('FAIL: modules that should be loaded lazily were imported:')
+        for name in loaded:
+            print('  {}'.format(name))
+
+    total = main[2] / 1000
+    print('Import time of martian.__main__: {:.1f} ms (budget {} ms)'.format(
+        total, args.budget))
+    if total > args.budget:
+        failed = True
+        print('FAIL: import time is over budget')
+
+    print('Slowest modules imported by martian.__main__:')
+    for (_, name, usec) in sorted(children, key = lambda c: c[2], reverse = True)[:10]:
+        print('  {:<30} {:>8.1f} ms'.format(name, usec / 1000))
+
+    sys.exit(1 if failed else 0)
@@ -28,7 +28,170 @@ interrupted and you don't want to restart from 1.
 If given an output file using the -o option (/o on Windows), the results will
 be written to that file.  If no output file is specified, the output is
 written to a file named "output.xml" on the user's desktop.  The results are
-always MARC records in XML format.
+MARC records in XML format, unless the name of the output file ends in ".db",
+".sqlite" or ".sqlite3", in which case the records are written into an SQLite
+database with tables of records, fields and subfields.  If the database
+already exists, it is updated: records with the same 001 value are replaced,
+and other records are left alone.
+
+If the output file is given as "-" (as in "-o -"), the records are written to
+the standard output as they arrive, so that they can be piped into another
+program, and Martian's messages and progress reports go to the standard
+error instead.  If the other program reads more slowly than Martian
+downloads, Martian slows down to match.  A failure log (see the -e option)
+is then named "martian-failed.jsonl", in the current directory.  This cannot
+be combined with the -c option or with more than one host.
+
+If given the -m option (/m on Windows), Martian will write measurements of
+the run to the given file when the download is finished: per-page timing
+breakdowns (DNS, connect, TLS, time to first byte, transfer), bytes, record
+counts, and histograms summarizing them.  The file is written as JSON, unless
+its name ends in ".prom", in which case it is written in the Prometheus text
+format for use with a node_exporter textfile collector.
+
+If given the -H option (/H on Windows), Martian will search the given TIND
+instance instead of caltech.tind.io.  The value is the URL of the instance
+(e.g., "https://caltech.tind.io").  If more than one URL is given, separated
+by commas, Martian will perform the same search on all of them at the same
+time, and write the results from each instance to a separate file, named
+by adding the host name to the output file name (for example,
+"output-caltech.tind.io.xml").  Each instance gets its own set of network
+connections, so that a slow instance does not hold up the others.  The
+option -r (/r on Windows) limits the number of requests per second that
+Martian makes to each instance.
+
+If given the -b option (/b on Windows), Martian will get records from TIND
+using the named backend.  The default, "search", uses TIND's public search
+pages, which return at most 200 records per request.  The alternative, "api",
+uses TIND's authenticated API, which returns larger pages and pages through
+results more efficiently; it requires an API key, which must be given in the
+environment variable TIND_API_KEY.  The "api" backend can only start at the
+first record (i.e., -s cannot be used with it).
+
+If given the -p option (/p on Windows), Martian will divide the search into
+parts by ranges of record ids, and download the given number of parts at the
+same time.  The parts are combined into one output file at the end.  This
+avoids the slow deep paging TIND does for very large result sets, and can
+greatly reduce the time needed for them.  It is only done when getting all
+the results of a search (i.e., when -s and -t are not used).
+
+If given the -l option (/l on Windows) and the search names more than one
+collection (with "&c=" in a search URL), Martian will get the records of each
+collection separately, with all the collections downloaded at the same time
+over a connection each (whatever the -p option says), and then merge the
+results into one output file.  A record that is in more than one collection
+is only written once (records are identified by their 001 field).  This is
+only done when getting all the results of a search.
+
+If some pages of results can't be downloaded, Martian goes on with the
+rest and tries those pages again later, several times, with increasing
+delays in between.  Pages that still fail are listed in a file named by
+adding "-failed.jsonl" to the output file name.  Giving that file to the -e
+option (/e on Windows) in a later run makes Martian download only the pages
+listed in it (use the same -H and -b values as the original run).
+
+Martian gives up on a connection to TIND that can't be made within 30
+seconds, or a page that takes longer than 600 seconds to download; the -k
+option (/k on Windows) changes these limits, given as two numbers separated
+by a comma (e.g., "10,300").  Martian also abandons a page whose download
+stalls, moving fewer than 100 bytes per second for 60 seconds; the -y option
+(/y on Windows) changes these values (e.g., "1000,30").  Pages abandoned for
+any of these reasons are fetched again later.  Interrupting Martian stops
+downloads in progress right away, even if the server has stopped responding.
+
+If given the -w option (/w on Windows), Martian will check and convert the
+pages of records it receives in the given number of separate worker
+processes, in parallel with downloading further pages, so that the work can
+be spread over several CPU cores.  By default, this is done on a single
+thread (still in parallel with downloading).
+
+Output is written to disk on a separate thread, so that a slow disk does
+not slow down the network transfers.  The -B option (/B on Windows) sets the
+largest amount of data (in megabytes) written to the file at one time.  Up to
+8 times that amount can be waiting to be written before the download pauses.
+
+If given the -n option (/n on Windows), Martian does not download anything.
+Instead, it asks TIND how many records the search will produce, times the
+download of one sample page, and looks up the speed of earlier harvests from
+the same host (Martian keeps a history of its complete harvests in its data
+directory).  It then prints estimates of the number of requests, the amount
+of data and the time that the harvest would take with the value given to -p,
+and recommends a value for -p.
+
+If given the -f option (/f on Windows), Martian will compute a hash of
+each record as it is downloaded and write a manifest to the given file when
+the download is finished: one line per record, giving the record's 001 value
+and its hash.  The hash leaves out the 005 field (the date of the latest
+transaction), so it only changes when the content of the record changes.  If
+given the -c option (/c on Windows) with the manifest file of a previous
+download, Martian will also write the records that were added or modified
+since that download, and minimal records (marked as deleted) for the records
+that are no longer present, to files named by adding "-added", "-modified"
+and "-deleted" to the output file name.  The same file can be given to -c
+and -f, in which case it is updated after a complete download.  These
+options cannot be used with more than one host.
+
+If given the -x option (/x on Windows), Martian will pass each record
+through the given transforms before writing it.  A transform is a Python
+function that takes a record (as an lxml element) and returns the record,
+possibly changed, a list of records to write in its place, or None to leave
+the record out.  Transforms are named as "module:function", or by the names
+under which installed packages register them (the entry point group
+"martian.transforms"); several can be given, separated by commas, and are
+applied in order.  They run along with the conversion of the pages, so they
+use the worker processes of the -w option if it is given.
+
+If given the -O option (/O on Windows) with the value "001", Martian will
+sort the records in the output file by their 001 field (the record id) after
+the download, so that harvests of the same records produce identical files
+that can be compared with ordinary tools.  The sort works on files much
+larger than the available memory: pieces of the file are sorted in worker
+processes, written to temporary files, and then merged.  It cannot be used
+with database output or "-o -".  An existing file can be sorted the same way
+with the "sort" subcommand, for example "martian sort output.xml sorted.xml"
+(use "martian sort -h" for its options).
+
+The "merge" subcommand combines several files written by Martian (for
+example, the results of different searches) into one file in which each
+record appears once, as in "martian merge all.xml a.xml b.xml c.xml".  When
+a record is in more than one file, the copy with the latest 005 field is
+kept.  The files are read together a piece at a time, so that they can be
+much larger than the available memory (use "martian merge -h" for details).
+
+If given the -P option (/P on Windows), Martian will profile its main worker
+thread and its download thread, and write the results to the given directory:
+for each thread, a file of cProfile data (".pstats"), a text summary of the
+functions taking the most time (".txt"), and sampled stacks in the "folded"
+format used by flame graph tools (".folded").  Memory allocations are also
+traced, and a report of the top allocation sites is written to the file
+"allocations.txt" in the same directory when Martian exits.
+
+If given the -T option (/T on Windows), Martian will record a timeline of
+the steps of the download (the count probe, the fetch, conversion and writing
+of each page, disk writes, and waits before retries) on each of its threads,
+and write it to the given file in the Chrome trace format when it exits.  The
+file can be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing
+to see how the steps overlap and where threads sit idle.
+
+If given the -R option (/R on Windows), Martian will record the requests it
+makes to TIND, and the responses it gets, in the given cassette file.  If
+given the -Q option (/Q on Windows) with a cassette file, Martian does not
+contact TIND at all, but answers each request with the response recorded
+for the same URL, after the time the original response took.  The file name
+can be followed by a comma and a number by which to multiply those times
+(for example, "-Q run.cassette,0" replays without any delays).  Replaying
+the same cassette gives the same results every time, which makes it
+possible to compare the performance of Martian on real data offline.
+
+If given the -S option (/S on Windows), Martian does not perform a search
+itself, but instead runs as a long-lived service that accepts harvest jobs
+through an HTTP/JSON API on the given port of the local host (127.0.0.1).
+Jobs can be one-time searches or recurring searches on a cron-style schedule.
+The job queue and the output files are kept in Martian's data
+directory, and jobs that were interrupted when the service stopped are
+restarted when it starts again.  The option -j (/j on Windows) sets the
+number of jobs that can run at the same time (default: 2).  See the file
+service.py for a description of the API.
 
 If given the -@ option (/@ on Windows), this program will print a trace of
 what it is doing to the terminal window, and will also drop into a debugger
@@ -59,24 +222,27 @@ file "LICENSE" for more information.
 import os
 import os.path as path
 import plac
-from   pubsub import pub
 from   queue import Queue
 import sys
 from   threading import Thread
 import traceback
-import wx
 
 if __debug__:
     from sidetrack import set_debug, log, logr
 
 import martian
-from martian.control import MartianControlGUI, MartianControlCLI
+from martian.hosts import Host, MultiHostHarvest, output_for
 from martian.exceptions import *
+from martian.database import is_database
 from martian.files import desktop_path, rename_existing, file_in_use
-from martian.messages import MessageHandlerGUI, MessageHandlerCLI
 from martian.network import network_available
-from martian.progress import ProgressIndicatorGUI, ProgressIndicatorCLI
-from martian.tind import Tind
+from martian.profiling import enable as enable_profiling, profiled
+from martian.tind import Tind, STDOUT
+from martian.tracing import enable as enable_tracing, background_logging
+from martian.transport import Timeouts
+
+# Note: the GUI and CLI interface classes are imported inside main(), so that
+# running with -G never loads WxPython.
 
 
 # Main program.
@@ -84,8 +250,30 @@ from martian.tind import Tind
 
 @plac.annotations(
     output     = ('write results to the file R',                      'option', 'o'),
+    metrics    = ('write run metrics to file J (Prometheus if *.prom)', 'option', 'm'),
     start_at   = ("start with Nth record (default: start at 1)",      'option', 's'),
     total      = ('stop after processing M records (default: all)',   'option', 't'),
+    hosts      = ('harvest from TIND hosts H (URLs, comma-separated)', 'option', 'H'),
+    backend    = ('get records using backend B: search or api',       'option', 'b'),
+    rate       = ('make at most R requests/second to each host',      'option', 'r'),
+    parallel   = ('get the results in T parallel parts (default: 1)', 'option', 'p'),
+    workers    = ('convert pages in W worker processes (default: 0)',  'option', 'w'),
+    buffer     = ('write output in chunks of up to Z MB (default: 4)', 'option', 'B'),
+    timeouts   = ('time limits L for connect,page (default: 30,600 s)', 'option', 'k'),
+    stall      = ('refetch pages under X bytes/s,secs (default: 100,60)', 'option', 'y'),
+    manifest   = ('write a manifest of record hashes to file F',      'option', 'f'),
+    changes    = ('write changes since the manifest in file A',       'option', 'c'),
+    transform  = ('pass records through transforms U (module:function)', 'option', 'x'),
+    sort_by    = ('sort the output by field S after download (001)',   'option', 'O'),
+    profile    = ('write CPU & memory profiles to directory D',       'option', 'P'),
+    trace      = ('write a timeline of the run to file Y (Chrome trace)', 'option', 'T'),
+    record     = ('record requests & responses in cassette file I',   'option', 'R'),
+    replay     = ('replay cassette Q (file[,time scale]) offline',    'option', 'Q'),
+    service    = ('run as a service with a job API on local port P',  'option', 'S'),
+    jobs       = ('run at most K jobs at a time in service mode',     'option', 'j'),
+    by_collection = ('get each collection in the search separately',  'flag',   'l'),
+    retry      = ('get only the pages listed in failure log E',       'option', 'e'),
+    plan       = ('only estimate the time & size of the harvest',     'flag',   'n'),
     no_color   = ('do not color-code terminal output',                'flag',   'C'),
     no_gui     = ('do not start the GUI interface (default: do)',     'flag',   'G'),
     version    = ('print version info and exit',                      'flag',   'V'),
@@ -93,8 +281,13 @@ from martian.tind import Tind
     search     = 'search string or complete search URL (default: none)',
 )
 
-def main(output = 'O', start_at = 'N', total = 'M', no_color = False,
-         no_gui = False, version = False, debug = 'out', *search):
+def main(output = 'O', metrics = 'J', start_at = 'N', total = 'M', hosts = 'H',
+         backend = 'B', rate = 'R', parallel = 'T', workers = 'W', buffer = 'Z',
+         timeouts = 'L', stall = 'X', manifest = 'F', changes = 'A', transform = 'U',
+         sort_by = 'S', profile = 'D', trace = 'Y', record = 'I', replay = 'Q',
+         service = 'P', jobs = 'K', retry = 'E',
+         by_collection = False, plan = False, no_color = False, no_gui = False,
+         version = False, debug = 'out', *search):
     '''Search caltech.tind.io and download the results as MARC XML records.
 
 Martian can be run as either a command-line application or a GUI application.
@@ -122,7 +315,170 @@ interrupted and you don't want to restart from 1.
 If given an output file using the -o option (/o on Windows), the results will
 be written to that file.  If no output file is specified, the output is
 written to a file named "output.xml" on the user's desktop.  The results are
-always MARC records in XML format.
+MARC records in XML format, unless the name of the output file ends in ".db",
+".sqlite" or ".sqlite3", in which case the records are written into an SQLite
+database with tables of records, fields and subfields.  If the database
+already exists, it is updated: records with the same 001 value are replaced,
+and other records are left alone.
+
+If the output file is given as "-" (as in "-o -"), the records are written to
+the standard output as they arrive, so that they can be piped into another
+program, and Martian's messages and progress reports go to the standard
+error instead.  If the other program reads more slowly than Martian
+downloads, Martian slows down to match.  A failure log (see the -e option)
+is then named "martian-failed.jsonl", in the current directory.  This cannot
+be combined with the -c option or with more than one host.
+
+If given the -m option (/m on Windows), Martian will write measurements of
+the run to the given file when the download is finished: per-page timing
+breakdowns (DNS, connect, TLS, time to first byte, transfer), bytes, record
+counts, and histograms summarizing them.  The file is written as JSON, unless
+its name ends in ".prom", in which case it is written in the Prometheus text
+format for use with a node_exporter textfile collector.
+
+If given the -H option (/H on Windows), Martian will search the given TIND
+instance instead of caltech.tind.io.  The value is the URL of the instance
+(e.g., "https://caltech.tind.io").  If more than one URL is given, separated
+by commas, Martian will perform the same search on all of them at the same
+time, and write the results from each instance to a separate file, named
+by adding the host name to the output file name (for example,
+"output-caltech.tind.io.xml").  Each instance gets its own set of network
+connections, so that a slow instance does not hold up the others.  The
+option -r (/r on Windows) limits the number of requests per second that
+Martian makes to each instance.
+
+If given the -b option (/b on Windows), Martian will get records from TIND
+using the named backend.  The default, "search", uses TIND's public search
+pages, which return at most 200 records per request.  The alternative, "api",
+uses TIND's authenticated API, which returns larger pages and pages through
+results more efficiently; it requires an API key, which must be given in the
+environment variable TIND_API_KEY.  The "api" backend can only start at the
+first record (i.e., -s cannot be used with it).
+
+If given the -p option (/p on Windows), Martian will divide the search into
+parts by ranges of record ids, and download the given number of parts at the
+same time.  The parts are combined into one output file at the end.  This
+avoids the slow deep paging TIND does for very large result sets, and can
+greatly reduce the time needed for them.  It is only done when getting all
+the results of a search (i.e., when -s and -t are not used).
+
+If given the -l option (/l on Windows) and the search names more than one
+collection (with "&c=" in a search URL), Martian will get the records of each
+collection separately, with all the collections downloaded at the same time
+over a connection each (whatever the -p option says), and then merge the
+results into one output file.  A record that is in more than one collection
+is only written once (records are identified by their 001 field).  This is
+only done when getting all the results of a search.
+
+If some pages of results can't be downloaded, Martian goes on with the
+rest and tries those pages again later, several times, with increasing
+delays in between.  Pages that still fail are listed in a file named by
+adding "-failed.jsonl" to the output file name.  Giving that file to the -e
+option (/e on Windows) in a later run makes Martian download only the pages
+listed in it (use the same -H and -b values as the original run).
+
+Martian gives up on a connection to TIND that can't be made within 30
+seconds, or a page that takes longer than 600 seconds to download; the -k
+option (/k on Windows) changes these limits, given as two numbers separated
+by a comma (e.g., "10,300").  Martian also abandons a page whose download
+stalls, moving fewer than 100 bytes per second for 60 seconds; the -y option
+(/y on Windows) changes these values (e.g., "1000,30").  Pages abandoned for
+any of these reasons are fetched again later.  Interrupting Martian stops
+downloads in progress right away, even if the server has stopped responding.
+
+If given the -w option (/w on Windows), Martian will check and convert the
+pages of records it receives in the given number of separate worker
+processes, in parallel with downloading further pages, so that the work can
+be spread over several CPU cores.  By default, this is done on a single
+thread (still in parallel with downloading).
+
+Output is written to disk on a separate thread, so that a slow disk does
+not slow down the network transfers.  The -B option (/B on Windows) sets the
+largest amount of data (in megabytes) written to the file at one time.  Up to
+8 times that amount can be waiting to be written before the download pauses.
+
+If given the -n option (/n on Windows), Martian does not download anything.
+Instead, it asks TIND how many records the search will produce, times the
+download of one sample page, and looks up the speed of earlier harvests from
+the same host (Martian keeps a history of its complete harvests in its data
+directory).  It then prints estimates of the number of requests, the amount
+of data and the time that the harvest would take with the value given to -p,
+and recommends a value for -p.
+
+If given the -f option (/f on Windows), Martian will compute a hash of
+each record as it is downloaded and write a manifest to the given file when
+the download is finished: one line per record, giving the record's 001 value
+and its hash.  The hash leaves out the 005 field (the date of the latest
+transaction), so it only changes when the content of the record changes.  If
+given the -c option (/c on Windows) with the manifest file of a previous
+download, Martian will also write the records that were added or modified
+since that download, and minimal records (marked as deleted) for the records
+that are no longer present, to files named by adding "-added", "-modified"
+and "-deleted" to the output file name.  The same file can be given to -c
+and -f, in which case it is updated after a complete download.  These
+options cannot be used with more than one host.
+
+If given the -x option (/x on Windows), Martian will pass each record
+through the given transforms before writing it.  A transform is a Python
+function that takes a record (as an lxml element) and returns the record,
+possibly changed, a list of records to write in its place, or None to leave
+the record out.  Transforms are named as "module:function", or by the names
+under which installed packages register them (the entry point group
+"martian.transforms"); several can be given, separated by commas, and are
+applied in order.  They run along with the conversion of the pages, so they
+use the worker processes of the -w option if it is given.
+
+If given the -O option (/O on Windows) with the value "001", Martian will
+sort the records in the output file by their 001 field (the record id) after
+the download, so that harvests of the same records produce identical files
+that can be compared with ordinary tools.  The sort works on files much
+larger than the available memory: pieces of the file are sorted in worker
+processes, written to temporary files, and then merged.  It cannot be used
+with database output or "-o -".  An existing file can be sorted the same way
+with the "sort" subcommand, for example "martian sort output.xml sorted.xml"
+(use "martian sort -h" for its options).
+
+The "merge" subcommand combines several files written by Martian (for
+example, the results of different searches) into one file in which each
+record appears once, as in "martian merge all.xml a.xml b.xml c.xml".  When
+a record is in more than one file, the copy with the latest 005 field is
+kept.  The files are read together a piece at a time, so that they can be
+much larger than the available memory (use "martian merge -h" for details).
+
+If given the -P option (/P on Windows), Martian will profile its main worker
+thread and its download thread, and write the results to the given directory:
+for each thread, a file of cProfile data (".pstats"), a text summary of the
+functions taking the most time (".txt"), and sampled stacks in the "folded"
+format used by flame graph tools (".folded").  Memory allocations are also
+traced, and a report of the top allocation sites is written to the file
+"allocations.txt" in the same directory when Martian exits.
+
+If given the -T option (/T on Windows), Martian will record a timeline of
+the steps of the download (the count probe, the fetch, conversion and writing
+of each page, disk writes, and waits before retries) on each of its threads,
+and write it to the given file in the Chrome trace format when it exits.  The
+file can be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing
+to see how the steps overlap and where threads sit idle.
+
+If given the -R option (/R on Windows), Martian will record the requests it
+makes to TIND, and the responses it gets, in the given cassette file.  If
+given the -Q option (/Q on Windows) with a cassette file, Martian does not
+contact TIND at all, but answers each request with the response recorded
+for the same URL, after the time the original response took.  The file name
+can be followed by a comma and a number by which to multiply those times
+(for example, "-Q run.cassette,0" replays without any delays).  Replaying
+the same cassette gives the same results every time, which makes it
+possible to compare the performance of Martian on real data offline.
+
+If given the -S option (/S on Windows), Martian does not perform a search
+itself, but instead runs as a long-lived service that accepts harvest jobs
+through an HTTP/JSON API on the given port of the local host (127.0.0.1).
+Jobs can be one-time searches or recurring searches on a cron-style schedule.
+The job queue and the output files are kept in Martian's data
+directory, and jobs that were interrupted when the service stopped are
+restarted when it starts again.  The option -j (/j on Windows) sets the
+number of jobs that can run at the same time (default: 2).  See the file
+service.py for a description of the API.
 
 If given the -@ argument (/@ on Windows), this program will output a detailed
 trace of what it is doing to the terminal window, and will also drop into a
@@ -154,11 +510,52 @@ message and exit without doing anything else.
     # Configure debug logging if it's turned on.
     if debug != 'out':
         set_debug(True, debug)
+        background_logging()
+
+    # Turn on profiling as early as possible, to capture more allocations.
+    if profile != 'D':
+        enable_profiling(profile)
+    if trace != 'Y':
+        enable_tracing(trace)
 
     # We use default values that provide more intuitive help text printed by
     # plac.  Rewrite the values to things we actually use.
     if output == 'O':
         output = None
+    if metrics == 'J':
+        metrics = None
+    if jobs == 'K':
+        jobs = 2
+    if workers == 'W':
+        workers = 0
+    if buffer == 'Z':
+        buffer = None
+    if manifest == 'F':
+        manifest = None
+    if changes == 'A':
+        changes = None
+    if retry == 'E':
+        retry = None
+    if transform == 'U':
+        transform = None
+    if sort_by == 'S':
+        sort_by = None
+    if record == 'I':
+        record = None
+    if replay == 'Q':
+        replay = None
+    if timeouts == 'L':
+        timeouts = None
+    if stall == 'X':
+        stall = None
+    if parallel == 'T':
+        parallel = 1
+    if backend == 'B':
+        backend = 'search'
+    if hosts == 'H':
+        hosts = None
+    if rate == 'R':
+        rate = None
     if total and total == 'M':
         total = -1
     if start_at and start_at == 'N':
@@ -166,27 +563,106 @@ message and exit without doing anything else.
     if search:
         search = search[0]
 
+    # Check the hosts and backend early, to fail before any windows open.
+    if record and replay:
+        sys.exit('Cannot record and replay a cassette at the same time')
+    try:
+        cassette = None
+        if record:
+            from martian.cassette import Cassette
+            cassette = Cassette(record, recording = True)
+        elif replay:
+            from martian.cassette import Cassette
+            (file, _, scale) = replay.partition(',')
+            cassette = Cassette(file, scale = float(scale) if scale else 1)
+        urls = hosts.split(',') if hosts else [None]
+        connections = max(2, int(parallel))
+        limits = Timeouts()
+        if timeouts:
+            (limits.connect, limits.total) = _numbers(timeouts, 2, '-k')
+        if stall:
+            (limits.low_speed, limits.low_speed_time) = _numbers(stall, 2, '-y')
+        hosts = [Host(url, backend, connections, float(rate) if rate else None, limits,
+                      cassette) for url in urls]
+    except (ValueError, RequestError, OSError) as ex:
+        sys.exit(str(ex))
+    if output == STDOUT:
+        if len(hosts) > 1:
+            sys.exit('Output from more than one host cannot go to the standard output')
+        if changes:
+            sys.exit('Changes cannot be written when the output is the standard output')
+        # Everything else printed (messages, progress) must stay out of the
+        # records, so send it to the standard error instead.
+        sys.stdout = sys.stderr
+    if sort_by:
+        if sort_by != '001':
+            sys.exit('Records can only be sorted by 001, not {}'.format(sort_by))
+        if output == STDOUT or is_database(output):
+            sys.exit('Sorting needs the output to be a MARC XML file')
+    if (manifest or changes) and len(hosts) > 1:
+        sys.exit('Record manifests can only be made when harvesting from one host')
+    if changes and not path.exists(changes):
+        sys.exit('Manifest file {} does not exist'.format(changes))
+    pages = None
+    if retry:
+        from martian.failures import read_failures
+        try:
+            pages = read_failures(retry)
+        except (OSError, ValueError, KeyError) as ex:
+            sys.exit('Cannot read failure log {}: {}'.format(retry, ex))
+        others = {(p.host, p.backend) for p in pages} - {(hosts[0].name, backend)}
+        if len(hosts) > 1 or others:
+            sys.exit('Failure log {} is for {}; use -H and -b to match it'.format(
+                retry, ', '.join('{} ({})'.format(*other) for other in sorted(others))))
+
+    stages = ()
+    if transform:
+        from martian.transforms import load_transforms
+        try:
+            stages = (load_transforms(transform),)
+        except TransformError as ex:
+            sys.exit(str(ex))
+
+    # Service mode has no user interface beyond log messages on the terminal.
+    if service != 'P':
+        from martian.files import user_data_path
+        from martian.messages import MessageHandlerCLI
+        from martian.service import run_service
+        run_service(int(service), int(jobs), user_data_path(),
+                    MessageHandlerCLI(use_color))
+        return
+
     # Switch between different ways of getting information from/to the user.
     if use_gui:
+        from martian.control import MartianControlGUI
+        from martian.messages import MessageHandlerGUI
+        from martian.progress import ProgressIndicatorGUI
         controller = MartianControlGUI()
         notifier   = MessageHandlerGUI()
         tracer     = ProgressIndicatorGUI()
     else:
+        from martian.control import MartianControlCLI
+        from martian.messages import MessageHandlerCLI
+        from martian.progress import ProgressIndicatorCLI
         controller = MartianControlCLI()
         notifier   = MessageHandlerCLI(use_color)
         tracer     = ProgressIndicatorCLI(use_color)
 
     # Start the worker thread.
     if __debug__: log('starting main body thread')
-    controller.run(MainBody(output, int(total), int(start_at), search,
+    controller.run(MainBody(output, int(total), int(start_at), search, metrics,
+                            int(workers), int(parallel), by_collection, hosts,
+                            int(float(buffer) * 1024 * 1024) if buffer else None,
+                            manifest, changes, pages, plan, stages, bool(sort_by),
                             controller, notifier, tracer))
 
 
 class MainBody(Thread):
     '''Main body of Martian implemented as a Python thread.'''
 
-    def __init__(self, output, total, start_at, search,
-                 controller, notifier, tracer):
+    def __init__(self, output, total, start_at, search, metrics, workers,
+                 parallel, by_collection, hosts, buffer_size, manifest, changes,
+                 pages, plan, stages, sort, controller, notifier, tracer):
         '''Initializes main thread object but does not start the thread.'''
         Thread.__init__(self, name = "MainBody")
         if controller.is_gui:
@@ -197,21 +673,44 @@ class MainBody(Thread):
         self._total       = total
         self._start_at    = start_at
         self._search      = search
+        self._metrics     = metrics
+        self._hosts       = hosts
+        self._manifest    = manifest
+        self._changes     = changes
+        self._pages       = pages
+        self._plan        = plan
+        self._sort        = sort
+        self._parallel    = parallel
         self._controller  = controller
         self._tracer      = tracer
         self._notifier    = notifier
-        self._tind        = Tind(controller, notifier, tracer)
+        if len(hosts) == 1:
+            self._tind    = Tind(controller, notifier, tracer, hosts[0].pool,
+                                 workers = workers, parallel = parallel,
+                                 backend = hosts[0].backend,
+                                 buffer_size = buffer_size,
+                                 by_collection = by_collection, stages = stages)
+        else:
+            self._tind    = MultiHostHarvest(hosts, notifier, tracer,
+                                             workers = workers, parallel = parallel,
+                                             buffer_size = buffer_size,
+                                             by_collection = by_collection,
+                                             stages = stages)
         self._interrupted = False
 
 
     def run(self):
         '''Implementation of Thread object run() method.'''
+        profiled('MainBody', self._main)()
+
 
+    def _main(self):
         # Set shortcut variables for better code readability below.
         output      = self._output
         total       = self._total
         start_at    = self._start_at
         search      = self._search
+        metrics     = self._metrics
         controller  = self._controller
         notifier    = self._notifier
         tracer      = self._tracer
@@ -219,9 +718,10 @@ class MainBody(Thread):
         # Preliminary sanity checks.  Do this here because we need the notifier
         # object to be initialized based on whether we're using GUI or CLI.
         tracer.start('Performing initial checks')
-        if not network_available():
+        # Replaying a cassette doesn't need the network.
+        if not all(host.replaying for host in self._hosts) and not network_available():
             notifier.fatal('No network connection.')
-        if not controller.is_gui and not search:
+        if not controller.is_gui and not search and not self._pages:
             notifier.fatal('No search query string given.')
             tracer.stop('Quitting.')
             controller.quit()
@@ -239,25 +739,77 @@ class MainBody(Thread):
                 if __debug__: log('user cancelled; raising UserCancelled')
                 tracer.update('Input cancelled by user; stopping')
                 raise UserCancelled
-            if not search:
+            if not search and not self._pages:
                 if __debug__: log('No search string given; raising UserCancelled')
                 tracer.update('No search string given -- nothing to do')
                 raise UserCancelled
-            if not output:
-                output = path.join(desktop_path(), "output.xml")
-                tracer.update('No output file specified; using {}'.format(output))
-
-            if not output.endswith('.xml'):
-                output += '.xml'
-            if path.exists(output):
-                rename_existing(output)
-            if file_in_use(output):
-                details = '{} appears to be open in another program'.format(output)
-                notifier.error('Cannot write output file -- is it still open?', details)
-
-            tracer.update('Beginning interaction with caltech.tind.io')
-            written = self._tind.download(search, output, start_at, total)
-            tracer.update('{} records written to {}'.format(written, output))
+            if self._plan:
+                self._show_plans(search)
+            else:
+                if not output:
+                    output = path.join(desktop_path(), "output.xml")
+                    tracer.update('No output file specified; using {}'.format(output))
+
+                if (not output.endswith('.xml') and not is_database(output)
+                    and output != STDOUT):
+                    output += '.xml'
+                if len(self._hosts) == 1:
+                    outputs = [output]
+                    files = list(outputs)
+                    if self._changes:
+                        from martian.changes import changeset_files
+                        files += changeset_files(output)
+                else:
+                    outputs = [output_for(output, host) for host in self._hosts]
+                    files = list(outputs)
+                for file in files:
+                    if file == STDOUT:
+                        continue
+                    # Databases are updated rather than replaced.
+                    if path.exists(file) and not is_database(file):
+                        rename_existing(file)
+                    if file_in_use(file):
+                        details = '{} appears to be open in another program'.format(file)
+                        notifier.error('Cannot write output file -- is it still open?',
+                                       details)
+
+                names = ', '.join(host.name for host in self._hosts)
+                tracer.update('Beginning interaction with {}'.format(names))
+                if self._pages:
+                    tracer.update('Getting {} pages listed in the failure log'
+                                  .format(len(self._pages)))
+                    result = self._tind.download_pages(self._pages, output)
+                elif self._manifest or self._changes:
+                    result = self._download_tracked(search, output)
+                else:
+                    result = self._tind.download(search, output, start_at, total)
+                written = result.written
+                where = 'the standard output' if output == STDOUT else output
+                tracer.update('{} records written to {}'.format(written, where))
+                if self._sort and not self._interrupted:
+                    from martian.sorting import sort_file
+                    for file in outputs:
+                        tracer.update('Sorting the records in {} by 001'.format(file))
+                        sort_file(file, file)
+                # Only complete, successful runs against the real server say
+                # how long a whole harvest takes.
+                from martian.planner import History, whole_run
+                if (len(self._hosts) == 1 and not self._hosts[0].replaying
+                        and not self._interrupted and not self._pages
+                        and whole_run(start_at, total, result)):
+                    History().add(self._hosts[0].backend, result.metrics)
+                if metrics:
+                    result.metrics.write(metrics)
+                    tracer.update('Run metrics written to {}'.format(metrics))
+                if result.failed:
+                    from martian.failures import write_failures
+                    base = 'martian' if output == STDOUT else path.splitext(output)[0]
+                    log_file = base + '-failed.jsonl'
+                    if path.exists(log_file):
+                        rename_existing(log_file)
+                    write_failures(log_file, result.failed)
+                    notifier.warn('{} pages could not be downloaded; they are listed'
+                                  ' in {}'.format(len(result.failed), log_file))
         except (KeyboardInterrupt, UserCancelled) as err:
             # If using the GUI and the user deliberately quit in the input
             # dialog, we stop what we're doing and leave it to the user to
@@ -270,6 +822,11 @@ class MainBody(Thread):
         except ServiceFailure:
             tracer.stop('Stopping due to a problem connecting to services')
             controller.quit()
+        except BrokenPipeError:
+            # The program reading our output went away (e.g., "| head").
+            tracer.stop('Stopping because the output pipe was closed')
+            self._tind.interrupt()
+            controller.quit()
         except Exception as err:
             tracer.stop('Stopping due to error')
             notifier.fatal(martian.__title__ + ' encountered an error',
@@ -277,13 +834,52 @@ class MainBody(Thread):
             controller.quit()
         else:
             tracer.stop('Done')
-            if controller.is_gui:
+            if controller.is_gui and not self._plan:
                 status = 'Interrupted' if self._interrupted else 'Done'
                 say = notifier.warn if self._interrupted else notifier.info
                 say('{}; {} records written to {}'.format(status, written, output))
             controller.quit()
 
 
+    def _show_plans(self, search):
+        '''Reports estimates for harvesting the results of 'search' from each
+        host, without downloading them.'''
+        from martian.planner import History, plan_download
+        history = History()
+        for host in self._hosts:
+            self._tracer.update('Planning the harvest from {}'.format(host.name))
+            plan = plan_download(host.backend, host.pool, search, history,
+                                 self._parallel)
+            self._notifier.info('Plan for {}:\n  {}'.format(
+                host.name, '\n  '.join(plan.summary())))
+
+
+    def _download_tracked(self, search, output):
+        '''Downloads while computing record hashes, then writes the manifest
+        and changesets.  Returns the result of the download.'''
+        from martian.changes import ChangeTracker
+        from martian.planner import whole_run
+        tracker = ChangeTracker(output, self._manifest, self._changes)
+        complete = False
+        try:
+            result = self._tind.download(search, output, self._start_at,
+                                         self._total, changes = tracker)
+            complete = (whole_run(self._start_at, self._total, result)
+                        and not self._interrupted)
+        finally:
+            counts = tracker.finish(complete)
+        if self._changes:
+            self._tracer.update('{} added, {} modified and {} deleted records'
+                                .format(counts['added'], counts['modified'],
+                                        counts['deleted']))
+        if self._manifest:
+            if complete:
+                self._tracer.update('Manifest written to {}'.format(self._manifest))
+            else:
+                self._notifier.warn('Download was not complete; manifest not written')
+        return result
+
+
     def stop(self):
         '''Stop execution of processes.  This is called by our controller.'''
         self._interrupted = True
@@ -292,6 +888,8 @@ class MainBody(Thread):
 
 
     def get_user_input(self, search, output):
+        import wx
+        from pubsub import pub
         results = Queue()
         if __debug__: log('sending message to user_dialog')
         wx.CallAfter(pub.sendMessage, "user_dialog", results = results,
@@ -303,18 +901,122 @@ class MainBody(Thread):
         return results_tuple
 
 
+# Subcommands.
+# ......................................................................
+# These are run instead of main() when the first command-line argument is
+# the name of one of them (see cli() below).
+
+@plac.annotations(
+    memory     = ('use at most about M MB of memory (default: 256)',   'option', 'm'),
+    workers    = ('sort in W worker processes (default: 1 per core)',  'option', 'w'),
+    input      = 'MARC XML file written by Martian',
+    output     = 'file for the sorted records (default: replace input)',
+)
+
+def sort(memory = 'M', workers = 'W', input = None, output = None):
+    '''Sort the records in a MARC XML file by their 001 field.
+
+The file is sorted in pieces of bounded size, in worker processes, and the
+pieces are then merged, so that files much larger than the available memory
+can be sorted.  The temporary files for the pieces are put in the directory
+of the output file.  Records without a 001 field are put at the end.
+'''
+    if not input:
+        sys.exit('No input file given')
+    from martian.sorting import sort_file
+    try:
+        options = {}
+        if memory != 'M':
+            options['memory'] = int(float(memory) * 1024 * 1024)
+        if workers != 'W':
+            options['workers'] = int(workers)
+        count = sort_file(input, output or input, **options)
+    except (OSError, ValueError) as ex:
+        sys.exit(str(ex))
+    print('{} records sorted into {}'.format(count, output or input))
+
+
+@plac.annotations(
+    keep       = ('keep duplicate K: newest (by 005), first or last',  'option', 'k'),
+    memory     = ('sort unsorted inputs in about M MB (default: 256)', 'option', 'm'),
+    workers    = ('sort in W worker processes (default: 1 per core)',  'option', 'w'),
+    output     = 'file for the merged records',
+    inputs     = 'MARC XML files written by Martian',
+)
+
+def merge(keep = 'K', memory = 'M', workers = 'W', output = None, *inputs):
+    '''Merge MARC XML files into one, with one copy of each record.
+
+Records are identified by their 001 field.  When a record is in more than
+one input file, the copy with the latest 005 field is kept by default; the
+-k option (/k on Windows) can instead keep the copy in the first or the last
+input file that has it.  Records without a 001 field are all kept.
+
+The input files are read together a piece at a time, so memory use depends
+on the number of inputs rather than their size.  This needs the records in
+each input to be in order of their 001 fields (as written by the -O option
+of Martian or by "martian sort").  Inputs that are not in order are sorted
+into temporary files first, using the -m and -w options as "martian sort"
+does.  The output is in 001 order, and can be one of the input files.
+'''
+    if not output or not inputs:
+        sys.exit('Need an output file and at least one input file')
+    from martian.merging import merge_files
+    try:
+        options = {}
+        if memory != 'M':
+            options['memory'] = int(float(memory) * 1024 * 1024)
+        if workers != 'W':
+            options['workers'] = int(workers)
+        (written, duplicates) = merge_files(inputs, output,
+                                            'newest' if keep == 'K' else keep,
+                                            **options)
+    except (OSError, ValueError) as ex:
+        sys.exit(str(ex))
+    print('{} records written to {} ({} duplicates left out)'.format(
+        written, output, duplicates))
+
+
+_SUBCOMMANDS = {'sort': sort, 'merge': merge}
+
+
+# Helper functions.
+# ......................................................................
+
+def _numbers(text, count, option):
+    '''Returns the 'count' comma-separated numbers in 'text', the value given
+    to 'option'.  Raises ValueError if the value is not of that form.'''
+    values = text.split(',')
+    if len(values) != count:
+        raise ValueError('{} needs {} comma-separated numbers'.format(option, count))
+    return [float(value) for value in values]
+
+
 # On windows, we want the command-line args to use slash instead of hyphen.
 
 if sys.platform.startswith('win'):
     main.prefix_chars = '/'
+    for command in _SUBCOMMANDS.values():
+        command.prefix_chars = '/'
 
 
 # Main entry point.
 # ......................................................................
+
+def cli():
+    '''Runs the subcommand named by the first command-line argument, if
+    there is one, or else main().'''
+    args = sys.argv[1:]
+    if args and args[0] in _SUBCOMMANDS:
+        plac.call(_SUBCOMMANDS[args[0]], args[1:])
+    else:
+        plac.call(main)
+
+
 # The following allows users to invoke this using "python3 -m martian".
 
 if __name__ == '__main__':
-    plac.call(main)
+    cli()
 
 
 # For Emacs users
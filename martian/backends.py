@@ -0,0 +1,256 @@
+'''
+backends.py: the ways Martian can get records out of TIND
+
+A backend knows how to ask TIND how many records a search will produce, how
+to form the request for each page of MARC XML records, and how to find the
+position of the next page.  Tind (in tind.py) does the rest.  Each backend
+object talks to one TIND instance, given by its host URL (by default,
+https://caltech.tind.io).
+
+There are two backends:
+
+  search -- TIND's public search pages (the "/search" endpoint with "of=xm"),
+            which is what Martian has always used.  Anyone can use it, but
+            TIND returns at most 200 records per request to users who are
+            not logged in, and pages are addressed by offsets ("jrec") that
+            get slower as they get deeper.
+
+  api    -- TIND's authenticated API ("/api/v1/search").  It requires an API
+            key, which is sent in an Authorization header; the key is taken
+            from the environment variable TIND_API_KEY if not given directly.
+            Pages can be larger, and each response carries a search id that
+            is used to get the next page, so deep pages cost no more than the
+            first one.  Since paging is done with search ids, this backend
+            can only start at the first record.
+
+Use backend_for() to get a backend by name.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import os
+import re
+import urllib.parse
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+from martian.network import net
+
+
+# Constants.
+# .............................................................................
+
+_DEFAULT_HOST = 'https://caltech.tind.io'
+'''The TIND instance used if no other is specified.'''
+
+_SEARCH_PATH = '/search?ln=en'
+'''URL fragment common to all our search + download calls.'''
+
+# Some testing with caltech.tind.io reveals that if you ask for more than 200,
+# it returns 200.
+
+_SEARCH_PAGE_SIZE = 200
+'''Number of records to request from the search pages at each iteration.
+The maximum allowed by TIND is 200.'''
+
+_API_PATH = '/api/v1/search'
+'''Endpoint of TIND's authenticated search API.'''
+
+_API_PAGE_SIZE = 1000
+'''Number of records to request from the API at each iteration.'''
+
+_API_KEY_VARIABLE = 'TIND_API_KEY'
+'''Environment variable consulted for the API key.'''
+
+
+# Exported functions.
+# .............................................................................
+
+def backend_for(name, **kwargs):
+    '''Returns a new backend object for the backend named 'name' ("search" or
+    "api"), passing it the keyword arguments given.'''
+    if name == 'search':
+        return SearchBackend(**kwargs)
+    elif name == 'api':
+        return ApiBackend(**kwargs)
+    raise ValueError('Unknown backend "{}"'.format(name))
+
+
+# Exported classes.
+# .............................................................................
+
+class Backend(object):
+    '''Base class for backends.'''
+
+    name = None
+
+    sequential = False
+    '''True if pages can only be fetched in order, one after another.'''
+
+    def __init__(self, host, page_size):
+        self.host      = (host or _DEFAULT_HOST).rstrip('/')
+        self.page_size = page_size
+
+
+    @property
+    def host_name(self):
+        '''The host name part of the host URL, e.g., "caltech.tind.io".'''
+        return urllib.parse.urlsplit(self.host).netloc or self.host
+
+
+    def count(self, query, collections, session = None):
+        '''Returns the number of records TIND reports for the search 'query'
+        (in URL-quoted form) in the given 'collections'.  Raises
+        ServiceFailure if TIND can't be reached, RequestError if the search
+        fails, AuthenticationFailure if TIND rejects the credentials, and
+        InternalError if the number can't be found.'''
+        raise NotImplementedError
+
+
+    def page(self, query, collections, start, cursor = None):
+        '''Returns a tuple (url, headers) for getting the page of records
+        that begins with record number 'start'.  'cursor' is the value
+        returned by next_cursor() for the previous page, if any.'''
+        raise NotImplementedError
+
+
+    def next_cursor(self, body):
+        '''Returns the value to pass to page() for the page after the one
+        whose content is 'body'.'''
+        return None
+
+
+    def records(self, body):
+        '''Returns 'body' without anything that is not part of the MARC XML
+        collection of records.'''
+        return body
+
+
+class SearchBackend(Backend):
+    '''Gets records from TIND's public search pages.'''
+
+    name = 'search'
+
+    def __init__(self, host = None, page_size = None):
+        super().__init__(host, page_size or _SEARCH_PAGE_SIZE)
+        self.base_url = self.host + _SEARCH_PATH
+
+
+    def count(self, query, collections, session = None):
+        # TIND doesn't seem to offer a way to find out the number of expected
+        # records if you ask for MARC XML output.  So we do a normal TIND
+        # search and parse the HTML to look for the total results it reports.
+        prelim_search = self.url(query, collections, get = 1, start = 1, marc = False)
+        (response, error) = net('get', prelim_search, session)
+        _check_response(response, error)
+        # BeautifulSoup and lxml take a while to load; only do it when needed.
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(response.content, features='lxml')
+
+        # When multiple collections are used, the total number of records is
+        # the sum of the results from individual collections.
+        num_records = 0
+        for td in soup.select('.searchresultsboxheader'):
+            if td.text.find('records found') > 0:
+                match = re.search('([0-9,]+) records found', td.text)
+                if match and match.group(1):
+                    num_records += int(match.group(1).replace(',', ''))
+                else:
+                    raise InternalError('unexpected text: {}'.format(td.text))
+        return num_records
+
+
+    def page(self, query, collections, start, cursor = None):
+        return (self.url(query, collections, self.page_size, start, marc = True), [])
+
+
+    def url(self, search_string, collections, get, start, marc = False):
+        return (self.base_url
+                + ('&c=' + '&c='.join(collections) if collections else '')
+                + '&p=' + search_string
+                + '&jrec=' + str(start)
+                + '&rg=' + str(get)
+                + ('&of=xm' if marc else ''))
+
+
+class ApiBackend(Backend):
+    '''Gets records from TIND's authenticated search API.'''
+
+    name = 'api'
+    sequential = True
+
+    _TOTAL = re.compile(rb'Search-Engine-Total-Number-Of-Results:\s*(\d+)')
+    _SEARCH_ID = re.compile(rb'<search_id>([^<]*)</search_id>\s*')
+    _COMMENT = re.compile(rb'<!--.*?-->\s*', re.DOTALL)
+
+    def __init__(self, host = None, page_size = None, api_key = None):
+        super().__init__(host, page_size or _API_PAGE_SIZE)
+        self.base_url = self.host + _API_PATH
+        self._api_key = api_key or os.environ.get(_API_KEY_VARIABLE)
+        if not self._api_key:
+            raise RequestError('The TIND API needs an API key; set {}'
+                               .format(_API_KEY_VARIABLE))
+
+
+    @property
+    def headers(self):
+        return ['Authorization: Token ' + self._api_key]
+
+
+    def count(self, query, collections, session = None):
+        url = self.url(query, collections, 1)
+        headers = {'Authorization': 'Token ' + self._api_key}
+        (response, error) = net('get', url, session, headers = headers)
+        _check_response(response, error)
+        match = self._TOTAL.search(response.content)
+        if not match:
+            raise InternalError('TIND API response lacks the number of results')
+        return int(match.group(1))
+
+
+    def page(self, query, collections, start, cursor = None):
+        if start != 1 and cursor is None:
+            raise RequestError('The TIND API backend can only start at record 1')
+        return (self.url(query, collections, self.page_size, cursor), self.headers)
+
+
+    def next_cursor(self, body):
+        match = self._SEARCH_ID.search(body)
+        return match.group(1).decode('utf-8') if match else None
+
+
+    def records(self, body):
+        return self._COMMENT.sub(b'', self._SEARCH_ID.sub(b'', body, count = 1))
+
+
+    def url(self, search_string, collections, get, search_id = None):
+        return (self.base_url
+                + '?of=xm'
+                + ('&c=' + '&c='.join(collections) if collections else '')
+                + '&p=' + search_string
+                + '&rg=' + str(get)
+                + ('&search_id=' + urllib.parse.quote(search_id) if search_id else ''))
+
+
+# Internal implementation.
+# .............................................................................
+
+def _check_response(response, error):
+    if isinstance(error, AuthenticationFailure):
+        raise error
+    if response is None or response.status_code > 300:
+        raise ServiceFailure('exception connecting to TIND: {}'.format(error))
+    if error:
+        raise RequestError('exception: {}'.format(error))
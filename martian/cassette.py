@@ -0,0 +1,285 @@
+'''
+cassette.py: record and replay the HTTP traffic of a harvest
+
+A cassette is a file holding the requests Martian made to TIND during a
+harvest and the responses it got back: the count probes (made through
+network.net()) and the pages of MARC XML (made with a Transport).  Recording
+a harvest from the real server once makes it possible to repeat it later,
+offline and with the same results every time, for example to compare the
+performance of two versions of Martian on production-like data without
+putting load on TIND.
+
+The file is a ZIP archive.  Each response body is a compressed member of
+its own, so that a replay only has to decompress the pages it asks for, and
+the member "index.jsonl" lists, in the order they were made, the requests:
+their kind ("probe" or "page"), URL, HTTP status, response headers (for
+probes) and timing, or the Curl error if the request failed.  Request
+headers are not recorded, so API keys are not saved in the cassette.
+
+Recording and replaying are both done by a CassettePool, which stands in for
+the TransportPool of a host (see hosts.py).  When recording, it hands out
+real Transports and a real requests Session, wrapped so that every response
+is also added to the cassette.  When replaying, it answers each request
+with the next recorded response for the same URL (the last one is repeated
+if the URL is requested more often than it was during the recording), and
+a URL that was never recorded gets an error.  A replayed response arrives
+after the time the original took, multiplied by the cassette's 'scale':
+1 reproduces the original timing, 0.5 runs twice as fast, and 0 returns
+responses at once.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import atexit
+from   collections import defaultdict
+import json
+from   threading import Lock
+import time
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+from martian.transport import Response, Timing, TransportPool
+
+
+# Constants.
+# .............................................................................
+
+_INDEX = 'index.jsonl'
+'''Name of the member of the cassette that lists the recorded requests.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Cassette(object):
+    '''The cassette in the file 'file'.  If 'recording' is True, the file is
+    created (replacing any existing file) and requests are added to it;
+    otherwise, requests are answered from it, with delays equal to the
+    original durations times 'scale'.  A cassette being recorded is closed
+    when the program exits, if close() has not been called before then.'''
+
+    def __init__(self, file, recording = False, scale = 1):
+        import zipfile
+        self.file      = file
+        self.recording = recording
+        self.scale     = scale
+        self._lock     = Lock()
+        self._entries  = []
+        self._served   = defaultdict(int)
+        if recording:
+            if __debug__: log('recording cassette {}', file)
+            self._zip = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
+            atexit.register(self.close)
+        else:
+            if __debug__: log('replaying cassette {} at time scale {}', file, scale)
+            try:
+                self._zip = zipfile.ZipFile(file, 'r')
+                lines = self._zip.read(_INDEX).decode('utf-8').splitlines()
+            except (OSError, KeyError, zipfile.BadZipFile) as ex:
+                raise RequestError('Cannot read cassette {}: {}'.format(file, ex))
+            self._recorded = defaultdict(list)
+            for line in lines:
+                entry = json.loads(line)
+                self._recorded[(entry['kind'], entry['url'])].append(entry)
+
+
+    def add(self, kind, url, status = 0, body = b'', timing = None, headers = None,
+            error = None):
+        '''Adds a request of 'kind' ("probe" or "page") for 'url' to the
+        cassette, with the response 'status', 'body', 'timing' (a Timing)
+        and 'headers', or, for a request that failed, the arguments of the
+        pycurl.error in 'error'.'''
+        with self._lock:
+            if self._zip is None:
+                return
+            entry = {'kind'    : kind,
+                     'url'     : url,
+                     'status'  : status,
+                     'timing'  : (timing or Timing()).as_dict(),
+                     'headers' : headers or {},
+                     'error'   : list(error) if error else None,
+                     'member'  : 'r{:07d}'.format(len(self._entries))}
+            self._zip.writestr(entry['member'], body)
+            self._entries.append(entry)
+
+
+    def play(self, kind, url, cancel = None):
+        '''Returns a tuple (status, body, timing, headers) for the recorded
+        response to the request of 'kind' for 'url', after waiting as long
+        as the original response took (times the scale).  Raises
+        pycurl.error for a request that failed when it was recorded,
+        RequestError for a request that was not recorded, and UserCancelled
+        if the threading.Event 'cancel' is set while waiting.'''
+        with self._lock:
+            entries = self._recorded.get((kind, url))
+            if not entries:
+                raise RequestError('No recorded response for {}'.format(url))
+            served = self._served[(kind, url)]
+            self._served[(kind, url)] = served + 1
+            entry = entries[min(served, len(entries) - 1)]
+            body = self._zip.read(entry['member'])
+        timing = Timing(**{name: value * self.scale
+                           for name, value in entry['timing'].items()})
+        if timing.total:
+            if cancel is not None:
+                if cancel.wait(timing.total):
+                    raise UserCancelled('transfer cancelled')
+            else:
+                time.sleep(timing.total)
+        if entry['error']:
+            import pycurl
+            raise pycurl.error(*entry['error'])
+        return (entry['status'], body, timing, entry['headers'])
+
+
+    def close(self):
+        '''Finishes writing the cassette, if it is being recorded, and
+        closes the file.'''
+        with self._lock:
+            if self._zip is None:
+                return
+            if self.recording:
+                if __debug__: log('writing {} requests to {}', len(self._entries), self.file)
+                index = ''.join(json.dumps(entry) + '\n' for entry in self._entries)
+                self._zip.writestr(_INDEX, index)
+            self._zip.close()
+            self._zip = None
+
+
+class CassettePool(TransportPool):
+    '''TransportPool that records the traffic of its Transports and its
+    Session in the Cassette 'cassette', or replays it from there.  Other
+    arguments are as for TransportPool.'''
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+
+    def acquire(self, cancel = None):
+        if self.cassette.recording:
+            return _RecordingTransport(super().acquire(cancel), self.cassette)
+        self._take_slot(cancel)
+        return _ReplayTransport(self)
+
+
+    def release(self, transport):
+        if self.cassette.recording:
+            super().release(transport.transport)
+        elif self._slots:
+            self._slots.release()
+
+
+    @property
+    def session(self):
+        if self.cassette.recording:
+            return _RecordingSession(super().session, self.cassette)
+        return _ReplaySession(self.cassette)
+
+
+# Internal implementation.
+# .............................................................................
+# The sessions stand in for a requests.Session in calls to network.net(),
+# which only uses their get() method and the status_code, content and
+# headers of the responses.
+
+class _RecordingTransport(object):
+    def __init__(self, transport, cassette):
+        self.transport = transport
+        self._cassette = cassette
+
+
+    def get(self, url, headers = None, cancel = None):
+        import pycurl
+        try:
+            response = self.transport.get(url, headers, cancel)
+        except pycurl.error as ex:
+            self._cassette.add('page', url, error = ex.args)
+            raise
+        self._cassette.add('page', url, response.status, response.body, response.timing)
+        return response
+
+
+    def close(self):
+        self.transport.close()
+
+
+class _ReplayTransport(object):
+    def __init__(self, pool):
+        self._pool = pool
+
+
+    def get(self, url, headers = None, cancel = None):
+        import pycurl
+        self._pool.pace()
+        try:
+            (status, body, timing, _) = self._pool.cassette.play('page', url, cancel)
+        except pycurl.error as ex:
+            self._pool.record(False, ex)
+            raise
+        self._pool.record(status < 500 and status != 429, status)
+        return Response(status, body, timing)
+
+
+    def close(self):
+        pass
+
+
+class _RecordingSession(object):
+    def __init__(self, session, cassette):
+        self._session  = session
+        self._cassette = cassette
+
+
+    def get(self, url, **kwargs):
+        response = self._session.get(url, **kwargs)
+        elapsed = response.elapsed.total_seconds()
+        self._cassette.add('probe', url, response.status_code, response.content,
+                           Timing(total = elapsed), dict(response.headers))
+        return response
+
+
+class _ReplaySession(object):
+    def __init__(self, cassette):
+        self._cassette = cassette
+
+
+    def get(self, url, **kwargs):
+        try:
+            (status, body, _, headers) = self._cassette.play('probe', url)
+        except RequestError as ex:
+            # network.net() retries exceptions as if they were network
+            # problems, so report a missing recording as a missing page.
+            if __debug__: log(str(ex))
+            return _ReplayResponse(404, b'', {})
+        return _ReplayResponse(status, body, headers)
+
+
+class _ReplayResponse(object):
+    def __init__(self, status, content, headers):
+        self.status_code = status
+        self.content     = content
+        self.headers     = _Headers(headers)
+
+
+class _Headers(dict):
+    '''Dictionary of HTTP headers with case-insensitive get().'''
+
+    def __init__(self, headers):
+        super().__init__((name.lower(), value) for name, value in headers.items())
+
+
+    def get(self, name, default = None):
+        return super().get(name.lower(), default)
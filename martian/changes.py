@@ -0,0 +1,218 @@
+'''
+changes.py: record hashes, manifests, and changesets between harvests
+
+While the records of a download stream through the page pipeline, Martian
+can compute a hash of each record.  The hash is computed over the record's
+XML with the whitespace between elements removed and with the 005 field
+(the date and time of latest transaction) left out, so that it only changes
+when the content of the record changes.  The (001 -> hash) pairs for a
+download are saved in a manifest file: a text file with one line per
+record, holding the value of the 001 field and the hash separated by a tab.
+
+Given the manifest of an earlier download, a ChangeTracker also writes the
+records that differ from the earlier download to separate files, as they
+arrive: records whose 001 value was not in the earlier manifest go to the
+"added" file, and records whose hash is different go to the "modified" file.
+At the end, records that were in the earlier manifest but were not seen in
+this download are written to the "deleted" file, as minimal records (with
+only a leader and a 001 field) whose leader has record status "d", the
+usual MARC convention for deleted records.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import hashlib
+import os
+from   os import path
+import re
+from   threading import Lock
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.database import is_database
+from martian.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_RECORD   = re.compile(rb'<record\b.*?</record>', re.DOTALL)
+_ID       = re.compile(rb'<controlfield tag="001">\s*([^<]*?)\s*</controlfield>')
+_DATE     = re.compile(rb'<controlfield tag="005">[^<]*</controlfield>')
+_BETWEEN  = re.compile(rb'>\s+<')
+
+_HEADER = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+           b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+_FOOTER = b'</collection>\n'
+
+# Status "d" (deleted), type "a" (language material) and encoding level "u"
+# (unknown): the manifest doesn't say what kind of bibliographic record the
+# deleted one was.
+_DELETED_RECORD = ('<record>\n'
+                   '  <leader>00000da  a2200000u  4500</leader>\n'
+                   '  <controlfield tag="001">{}</controlfield>\n'
+                   '</record>\n')
+
+
+# Exported functions.
+# .............................................................................
+
+def digest_records(body):
+    '''Returns a list of tuples (id, hash, start, end) for the records in
+    'body' (bytes), where 'id' is the value of the record's 001 field (None
+    if it has none), 'hash' is the hex digest of the normalized record, and
+    'start' and 'end' are the positions of the record in 'body'.'''
+    results = []
+    for match in _RECORD.finditer(body):
+        record = match.group(0)
+        id = record_id(record)
+        normalized = _BETWEEN.sub(b'><', _DATE.sub(b'', record))
+        digest = hashlib.blake2b(normalized, digest_size = 16).hexdigest()
+        results.append((id, digest, match.start(), match.end()))
+    return results
+
+
+def record_id(record):
+    '''Returns the value of the 001 field of 'record' (bytes), or None.'''
+    match = _ID.search(record)
+    return match.group(1).decode('utf-8') if match else None
+
+
+def id_order(id):
+    '''Returns a sort key for the record id (001 value) 'id' that puts
+    numeric ids in numeric order, followed by any other ids in string
+    order, followed by records without an id (None).'''
+    if id is None:
+        return (2, 0, '')
+    # TIND record ids are numbers, but sort anything else after them.
+    return (0, int(id), '') if id.isdigit() else (1, 0, id)
+
+
+def records_in(file, chunk_size = 1024 * 1024):
+    '''Yields the records (as bytes) in 'file', which must hold a sequence of
+    MARC XML records, reading it a chunk at a time.'''
+    pending = b''
+    with open(file, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            pending += chunk
+            end = pending.rfind(b'</record>')
+            if end >= 0:
+                end += len(b'</record>')
+                for match in _RECORD.finditer(pending, 0, end):
+                    yield match.group(0)
+                pending = pending[end:]
+            if not chunk:
+                return
+
+
+def read_manifest(file):
+    '''Returns a dict mapping 001 values to hashes, read from 'file'.'''
+    if __debug__: log('reading manifest {}', file)
+    manifest = {}
+    with open(file, 'r', encoding = 'utf-8') as f:
+        for line in f:
+            (id, _, digest) = line.rstrip('\n').partition('\t')
+            if id:
+                manifest[id] = digest
+    return manifest
+
+
+def write_manifest(file, manifest):
+    '''Writes the dict 'manifest' to 'file', sorted by 001 value.'''
+    if __debug__: log('writing manifest of {} records to {}', len(manifest), file)
+    tmp = file + '.tmp'
+    with open(tmp, 'w', encoding = 'utf-8') as f:
+        for id in sorted(manifest, key = id_order):
+            f.write('{}\t{}\n'.format(id, manifest[id]))
+    os.replace(tmp, file)
+
+
+def changeset_files(output):
+    '''Returns the names of the (added, modified, deleted) files that go with
+    the output file 'output'.'''
+    (base, ext) = path.splitext(output)
+    # Changes are written as MARC XML even when the output is a database.
+    if not ext or is_database(output):
+        ext = '.xml'
+    return tuple('{}-{}{}'.format(base, kind, ext)
+                 for kind in ['added', 'modified', 'deleted'])
+
+
+# Exported classes.
+# .............................................................................
+
+class ChangeTracker(object):
+    '''Collects the record hashes of a download, and, if given the file name
+    of the manifest of a previous download in 'previous', writes changesets
+    next to 'output' (see changeset_files()).  Safe to use from several
+    threads.'''
+
+    def __init__(self, output, manifest = None, previous = None):
+        self._manifest = manifest
+        self._previous = read_manifest(previous) if previous else None
+        self._current  = {}
+        self._lock     = Lock()
+        self._files    = None
+        self._counts   = {'records': 0, 'added': 0, 'modified': 0, 'deleted': 0}
+        if self._previous is not None:
+            self._names = changeset_files(output)
+            self._files = [open(name, 'wb') for name in self._names]
+            for f in self._files:
+                f.write(_HEADER)
+
+
+    def observe(self, body, digests):
+        '''Records the digests of the records in 'body', as returned by
+        digest_records(), and writes any changed records to the changesets.'''
+        with self._lock:
+            for (id, digest, start, end) in digests:
+                self._counts['records'] += 1
+                if id is None or self._current.get(id) == digest:
+                    # Records can appear more than once in a download when
+                    # collections overlap; only count them once.
+                    continue
+                self._current[id] = digest
+                if self._previous is None:
+                    continue
+                old = self._previous.get(id)
+                if old == digest:
+                    continue
+                kind = 'added' if old is None else 'modified'
+                self._counts[kind] += 1
+                f = self._files[0 if old is None else 1]
+                f.write(body[start:end])
+                f.write(b'\n')
+
+
+    def finish(self, complete = True):
+        '''Finishes the changesets and writes the manifest.  If 'complete' is
+        False (because the download was interrupted or only covered part of
+        the results), deletions are not computed and no manifest is written,
+        since either would be wrong.  Returns a dict of counts.'''
+        with self._lock:
+            if self._files:
+                if complete:
+                    deleted = self._files[2]
+                    for id in sorted(set(self._previous) - set(self._current),
+                                     key = id_order):
+                        deleted.write(_DELETED_RECORD.format(id).encode('utf-8'))
+                        self._counts['deleted'] += 1
+                for f in self._files:
+                    f.write(_FOOTER)
+                    f.close()
+                self._files = None
+            if complete and self._manifest:
+                write_manifest(self._manifest, self._current)
+            return dict(self._counts)
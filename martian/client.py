@@ -0,0 +1,168 @@
+'''
+client.py: programmatic interface to Martian for use in other programs
+
+The Tind class used by the command-line and GUI interfaces reports problems
+and progress through a controller, a notifier and a progress tracer.  A
+Client wraps it for use as a library: it is configured with ordinary
+arguments, it raises exceptions (from exceptions.py) when something goes
+wrong, and it reports progress by calling functions given to it.  It does
+not need (or load) wxPython, plac or any of the terminal output modules.
+
+One Client can be used by many threads at once.  Every call to download()
+uses its own Tind object, while the network connections to the TIND instance
+are shared in a pool (see transport.py), which also limits the number of
+connections and the rate of requests for all the downloads together.
+Example:
+
+    from martian.client import Client
+
+    with Client(host = 'https://caltech.tind.io', connections = 8) as client:
+        result = client.download('856:"ebrary"', 'ebrary.xml',
+                                 progress = lambda done, total, nbytes: ...)
+        print(result.written)
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+from martian.hosts import Host
+from martian.tind import Tind, parse_search
+
+
+# Main class.
+# .............................................................................
+
+class Client(object):
+    '''Downloads records from the TIND instance at 'host' (default:
+    caltech.tind.io) using the backend named 'backend' ("search" or "api";
+    for "api", 'api_key' can be given instead of setting TIND_API_KEY).  At
+    most 'connections' connections are open to the host at once and at most
+    'rate' page requests are made per second (None for no limit), summed
+    over all downloads.  Transfers are limited by the Timeouts object
+    'timeouts' (see transport.py).  'workers', 'parallel', 'buffer_size' and
+    'by_collection' are passed to Tind for each download.  'transforms' is
+    a list of record transforms (functions, or names for load_transform()
+    in transforms.py) to apply to the records before they are written.  If
+    'cassette' is given, requests are recorded in or replayed from that
+    Cassette (see cassette.py).'''
+
+    def __init__(self, host = None, backend = 'search', api_key = None,
+                 connections = 4, rate = None, workers = 0, parallel = 0,
+                 buffer_size = None, by_collection = False, timeouts = None,
+                 transforms = None, cassette = None):
+        kwargs = {'api_key': api_key} if api_key else {}
+        self._host        = Host(host, backend, connections, rate, timeouts, cassette,
+                                 **kwargs)
+        self._workers     = workers
+        self._parallel    = parallel
+        self._buffer_size = buffer_size
+        self._per_coll    = by_collection
+        self._stages      = ()
+        if transforms:
+            from martian.transforms import RecordTransform, load_transform
+            funcs = [load_transform(t) if isinstance(t, str) else t for t in transforms]
+            self._stages = (RecordTransform(funcs),)
+
+
+    @property
+    def host(self):
+        '''The name of the TIND host, e.g., "caltech.tind.io".'''
+        return self._host.name
+
+
+    def count(self, search):
+        '''Returns the number of records TIND reports for 'search', which can
+        be a search expression or a complete search URL.'''
+        (query, collections) = parse_search(search)
+        return self._host.backend.count(query, collections, self._host.pool.session)
+
+
+    def download(self, search, output, start = 1, total = -1, progress = None,
+                 status = None, changes = None):
+        '''Downloads the records found by 'search' to the file 'output', from
+        record number 'start', getting at most 'total' records (default:
+        all).  If given, 'progress' is called with the arguments (done,
+        total, nbytes) as pages arrive, and 'status' is called with a string
+        describing each step.  'changes' can be a ChangeTracker (see
+        changes.py).  Returns a DownloadResult; raises an exception from
+        exceptions.py (or OSError) if the download fails.'''
+        if not search:
+            raise ValueError('Empty search string')
+        if __debug__: log('client downloading "{}" to {}', search, output)
+        tind = Tind(None, _Notifier(status), _Tracer(progress, status),
+                    self._host.pool, workers = self._workers,
+                    parallel = self._parallel, backend = self._host.backend,
+                    buffer_size = self._buffer_size,
+                    by_collection = self._per_coll, stages = self._stages)
+        return tind.download(search, output, start, total, changes = changes)
+
+
+    def status(self):
+        '''Returns a dict describing the state of the connections to the host.'''
+        return self._host.status()
+
+
+    def close(self):
+        '''Closes the network connections.  The client can't be used after
+        this.'''
+        self._host.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Internal implementation.
+# .............................................................................
+# Tind raises an exception after every call to notifier.fatal(), so the
+# notifier here only has to pass the messages on.
+
+class _Notifier(object):
+    '''Notifier for Tind that sends messages to a status function.'''
+
+    def __init__(self, status):
+        self._status = status
+
+    def _say(self, text, details = ''):
+        if self._status:
+            self._status(text)
+
+    info = warn = error = fatal = _say
+
+    def yes_no(self, question):
+        return False
+
+
+class _Tracer(object):
+    '''Progress tracer for Tind that calls a progress function.'''
+
+    def __init__(self, progress, status):
+        self._progress = progress
+        self._status = status
+
+    def _say(self, message = None):
+        if message and self._status:
+            self._status(message)
+
+    start = update = stop = _say
+
+    def progress(self, done, total, nbytes = 0):
+        if self._progress:
+            self._progress(done, total, nbytes)
@@ -0,0 +1,245 @@
+'''
+database.py: write harvested records directly into an SQLite database
+
+When the output file named for a download ends in ".db", ".sqlite" or
+".sqlite3", Tind writes the records into an SQLite database instead of a
+MARC XML file, so that they can be queried without first loading the XML
+into a database in a separate step.  The database has three tables:
+
+  records    (id, leader, harvested)
+  fields     (record, seq, tag, ind1, ind2, value)
+  subfields  (record, field, seq, code, value)
+
+'id' is the value of the record's 001 field, and the 'record' columns of
+the other tables refer to it.  'seq' numbers the fields of a record (and
+the subfields of a field) in order, starting with 1; the 'field' column of
+a subfield is the 'seq' of its field.  Control fields have a 'value' and no
+indicators; data fields have indicators and subfields but no 'value'.
+'harvested' is the time (in seconds since the epoch) when the record was
+last written.
+
+A DatabaseWriter can be used in place of the output file of a download: it
+takes the bytes of the records in write() calls of any size, and inserts
+them in transactions of many thousands of records each.  The database uses
+write-ahead logging, and the indexes on the fields and subfields tables are
+created when the writer is closed, after the bulk of the inserts, which is
+faster than updating them record by record.
+
+Writing into an existing database updates it: a record whose 001 value is
+already present replaces the earlier version, fields and all, and records
+that are not in the new download are left alone.  This makes it possible to
+refresh a database with the results of a search for recently-changed
+records.  Records without a 001 field can't be stored this way and are
+skipped.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   os import path
+import re
+from   threading import Lock
+import time
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+DATABASE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+'''File name extensions that make Tind write to a database.'''
+
+_BATCH_SIZE = 20000
+'''Number of records inserted in each transaction.'''
+
+_MAX_PARAMS = 500
+'''Number of values looked up at a time in one SELECT ... IN query.'''
+
+_RECORD = re.compile(rb'<record\b.*?</record>', re.DOTALL)
+
+_COLLECTION_START = b'<collection xmlns="http://www.loc.gov/MARC21/slim">'
+_COLLECTION_END   = b'</collection>'
+_MARC = '{http://www.loc.gov/MARC21/slim}'
+
+_SCHEMA = ['''CREATE TABLE IF NOT EXISTS records (
+                  id        TEXT PRIMARY KEY NOT NULL,
+                  leader    TEXT,
+                  harvested REAL)''',
+           '''CREATE TABLE IF NOT EXISTS fields (
+                  record    TEXT NOT NULL,
+                  seq       INTEGER,
+                  tag       TEXT,
+                  ind1      TEXT,
+                  ind2      TEXT,
+                  value     TEXT)''',
+           '''CREATE TABLE IF NOT EXISTS subfields (
+                  record    TEXT NOT NULL,
+                  field     INTEGER,
+                  seq       INTEGER,
+                  code      TEXT,
+                  value     TEXT)''']
+
+_INDEXES = ['CREATE INDEX IF NOT EXISTS fields_record ON fields (record, seq)',
+            'CREATE INDEX IF NOT EXISTS fields_tag ON fields (tag)',
+            'CREATE INDEX IF NOT EXISTS subfields_record ON subfields (record, field)']
+
+_UPSERT = '''INSERT INTO records (id, leader, harvested) VALUES (?, ?, ?)
+             ON CONFLICT (id) DO UPDATE SET leader = excluded.leader,
+                                            harvested = excluded.harvested'''
+
+
+# Exported functions.
+# .............................................................................
+
+def is_database(file):
+    '''Returns True if records written to 'file' go into a database.'''
+    return bool(file) and path.splitext(file)[1].lower() in DATABASE_EXTENSIONS
+
+
+# Main class.
+# .............................................................................
+
+class DatabaseWriter(object):
+    '''Inserts the MARC XML records written to it into the SQLite database
+    in 'file', creating the database if it does not exist.  Text that is not
+    part of a record (such as the XML declaration and collection element)
+    is ignored, and a record may be split across calls to write().'''
+
+    def __init__(self, file):
+        import sqlite3
+        if __debug__: log('opening database {}', file)
+        self._file    = file
+        self._lock    = Lock()
+        self._pending = b''
+        self._rows    = ([], [], [])
+        self._batch   = set()
+        self._db      = sqlite3.connect(file, check_same_thread = False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        self.records  = 0
+
+
+    @property
+    def name(self):
+        return self._file
+
+
+    def write(self, data):
+        '''Adds the records in 'data' (bytes) to the database.'''
+        with self._lock:
+            self._pending += data
+            end = self._pending.rfind(b'</record>')
+            if end < 0:
+                return
+            end += len(b'</record>')
+            records = _RECORD.findall(self._pending, 0, end)
+            self._pending = self._pending[end:]
+            if records:
+                self._add(records)
+
+
+    def close(self):
+        '''Inserts the remaining records, creates the indexes, and closes
+        the database.'''
+        with self._lock:
+            try:
+                self._flush()
+                if __debug__: log('creating indexes in {}', self._file)
+                with self._db:
+                    for statement in _INDEXES:
+                        self._db.execute(statement)
+            finally:
+                self._db.close()
+        if __debug__: log('wrote {} records to {}', self.records, self._file)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _add(self, records):
+        from lxml import etree
+        try:
+            collection = etree.fromstring(_COLLECTION_START + b''.join(records)
+                                          + _COLLECTION_END)
+        except etree.XMLSyntaxError as ex:
+            raise CorruptData('records are not well-formed XML: {}'.format(ex))
+        now = time.time()
+        for record in collection:
+            id = (record.findtext(_MARC + 'controlfield[@tag="001"]') or '').strip()
+            if not id:
+                if __debug__: log('skipping record without a 001 field')
+                continue
+            if id in self._batch:
+                # The earlier copy has to be in the database before it can
+                # be replaced.
+                self._flush()
+            (record_rows, field_rows, subfield_rows) = self._rows
+            self._batch.add(id)
+            record_rows.append((id, record.findtext(_MARC + 'leader'), now))
+            seq = 0
+            for field in record:
+                if field.tag == _MARC + 'controlfield':
+                    seq += 1
+                    field_rows.append((id, seq, field.get('tag'), None, None, field.text))
+                elif field.tag == _MARC + 'datafield':
+                    seq += 1
+                    field_rows.append((id, seq, field.get('tag'), field.get('ind1'),
+                                       field.get('ind2'), None))
+                    subfield_rows.extend((id, seq, n, sub.get('code'), sub.text)
+                                         for n, sub in enumerate(field, 1))
+        if len(self._batch) >= _BATCH_SIZE:
+            self._flush()
+
+
+    def _flush(self):
+        (record_rows, field_rows, subfield_rows) = self._rows
+        if not record_rows:
+            return
+        if __debug__: log('inserting {} records into {}', len(record_rows), self._file)
+        with self._db:
+            self._remove_fields(list(self._batch))
+            self._db.executemany(_UPSERT, record_rows)
+            self._db.executemany('INSERT INTO fields VALUES (?, ?, ?, ?, ?, ?)',
+                                 field_rows)
+            self._db.executemany('INSERT INTO subfields VALUES (?, ?, ?, ?, ?)',
+                                 subfield_rows)
+        self.records += len(record_rows)
+        for rows in self._rows:
+            rows.clear()
+        self._batch.clear()
+
+
+    def _remove_fields(self, ids):
+        '''Deletes the fields and subfields of the records in 'ids' that are
+        already in the database.'''
+        known = []
+        for start in range(0, len(ids), _MAX_PARAMS):
+            chunk = ids[start : start + _MAX_PARAMS]
+            query = 'SELECT id FROM records WHERE id IN ({})'.format(','.join('?' * len(chunk)))
+            known += [row[0] for row in self._db.execute(query, chunk)]
+        if known:
+            if __debug__: log('replacing {} records already in {}', len(known), self._file)
+            self._db.executemany('DELETE FROM subfields WHERE record = ?',
+                                 [(id,) for id in known])
+            self._db.executemany('DELETE FROM fields WHERE record = ?',
+                                 [(id,) for id in known])
@@ -22,6 +22,14 @@ class ServiceFailure(Exception):
     '''Unrecoverable problem involving network services.'''
     pass
 
+class NetworkFailure(Exception):
+    '''Unrecoverable problem involving the network connection.'''
+    pass
+
+class AuthenticationFailure(Exception):
+    '''The server rejected our credentials.'''
+    pass
+
 class NoContent(Exception):
     '''Server returned a code 401 or 404, indicating no content found.'''
 
@@ -36,3 +44,11 @@ class InternalError(Exception):
 class RequestError(Exception):
     '''Problem with the TIND query or request.'''
     pass
+
+class CorruptData(Exception):
+    '''Data received from the server could not be parsed.'''
+    pass
+
+class TransformError(Exception):
+    '''A record transform could not be loaded or failed.'''
+    pass
@@ -0,0 +1,264 @@
+'''
+failures.py: isolate failed pages, retry them, and record the ones that fail
+
+A page of records that can't be fetched (because of a network error, a 429
+or 5xx response, or a body that is truncated or not well-formed) does not
+stop a download.  The page is put on a RetryQueue, and the download moves on
+to the next page.  The queue's own thread tries the page again after a delay
+that grows with each attempt (see RetryPolicy); a page that still fails
+after the last attempt, or that fails in a way that retrying won't fix
+(such as a 404 response), is reported as a permanent failure.  Records from
+pages that succeed on a retry are written when they arrive, so they can
+appear later in the output than their position in the search results.
+
+Permanent failures are listed in the DownloadResult of the download, and
+can be written to a failure log with write_failures(): a file in JSON Lines
+format with one object per page, giving the host, backend, query,
+collections, starting record number and size of the page, along with the
+last error and the number of attempts.  A later run can read the file with
+read_failures() and fetch just those pages (see Tind.download_pages()).
+
+Some problems are not limited to one page: if TIND rejects the credentials
+(a 401 or 403 response), every page will fail the same way, so
+AuthenticationFailure still stops the download.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import heapq
+import json
+from   threading import Condition, Thread
+import time
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+from martian.tracing import span
+
+
+# Exported functions.
+# .............................................................................
+
+def check_page(response):
+    '''Raises an exception if 'response' is not a usable page of records.'''
+    status = response.status
+    if status in (401, 403):
+        raise AuthenticationFailure('TIND returned status {}'.format(status))
+    if status == 429:
+        raise RateLimitExceeded('TIND returned status 429')
+    if status >= 500:
+        raise ServiceFailure('TIND returned status {}'.format(status))
+    if status == 404:
+        raise NoContent('TIND returned status 404')
+    if status >= 300:
+        raise RequestError('TIND returned status {}'.format(status))
+    if not response.body or response.body.rfind(b'</collection>') < 0:
+        raise CorruptData('page is empty or truncated')
+
+
+def retryable(error):
+    '''Returns True if a page that failed with 'error' may succeed later.'''
+    return not isinstance(error, (AuthenticationFailure, NoContent, RequestError))
+
+
+def write_failures(file, pages):
+    '''Writes a failure log of the Page objects 'pages' to 'file'.'''
+    if __debug__: log('writing {} failed pages to {}', len(pages), file)
+    with open(file, 'w', encoding = 'utf-8') as f:
+        for page in pages:
+            f.write(json.dumps(page.as_dict()) + '\n')
+
+
+def read_failures(file):
+    '''Returns a list of Page objects read from the failure log 'file'.'''
+    pages = []
+    with open(file, 'r', encoding = 'utf-8') as f:
+        for line in f:
+            if line.strip():
+                pages.append(Page.from_dict(json.loads(line)))
+    return pages
+
+
+# Exported classes.
+# .............................................................................
+
+class RetryPolicy(object):
+    '''How often and how soon to retry a failed page: up to 'attempts'
+    attempts in all, waiting 'delay' seconds before the first retry and
+    'factor' times longer before each one after that, up to 'max_delay'.'''
+
+    def __init__(self, attempts = 5, delay = 1, factor = 2, max_delay = 60):
+        self.attempts  = attempts
+        self.delay     = delay
+        self.factor    = factor
+        self.max_delay = max_delay
+
+
+    def wait_after(self, attempt):
+        '''Returns the number of seconds to wait after attempt 'attempt'.'''
+        return min(self.max_delay, self.delay * self.factor ** (attempt - 1))
+
+
+class Page(object):
+    '''One page of search results: up to 'size' records starting with record
+    number 'start' of the search 'query' (URL-quoted) in 'collections'.'''
+
+    __slots__ = ('host', 'backend', 'query', 'collections', 'start', 'size',
+                 'attempts', 'error', 'due', 'queued', 'backoff')
+
+    def __init__(self, host, backend, query, collections, start, size):
+        self.host        = host
+        self.backend     = backend
+        self.query       = query
+        self.collections = list(collections or [])
+        self.start       = start
+        self.size        = size
+        self.attempts    = 0
+        self.error       = None
+        self.due         = 0
+        self.queued      = 0
+        self.backoff     = 0            # Seconds spent waiting to retry.
+
+
+    def as_dict(self):
+        return {'host'        : self.host,
+                'backend'     : self.backend,
+                'query'       : self.query,
+                'collections' : self.collections,
+                'start'       : self.start,
+                'size'        : self.size,
+                'attempts'    : self.attempts,
+                'error'       : str(self.error or '')}
+
+
+    @classmethod
+    def from_dict(cls, data):
+        page = cls(data['host'], data['backend'], data['query'],
+                   data.get('collections'), data['start'], data['size'])
+        page.error = data.get('error')
+        return page
+
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+
+    def __repr__(self):
+        return '<Page {} records from {}>'.format(self.size, self.start)
+
+
+class RetryQueue(object):
+    '''Retries failed pages on a separate thread.  'fetch' is called with a
+    Page and must return the page's data or raise an exception; 'accept' is
+    called with the Page and the result of 'fetch' when a retry succeeds.
+    Pages that fail for good are collected in the 'failed' attribute.'''
+
+    def __init__(self, fetch, accept, policy = None):
+        self._fetch   = fetch
+        self._accept  = accept
+        self._policy  = policy or RetryPolicy()
+        self._pending = []
+        self._busy    = False
+        self._closing = False
+        self._ready   = Condition()
+        self._thread  = None
+        self.failed   = []
+
+
+    def add(self, page, error):
+        '''Records that an attempt to get 'page' failed with 'error', and
+        schedules another attempt if the policy allows it.'''
+        page.attempts += 1
+        page.error = error
+        if not retryable(error) or page.attempts >= self._policy.attempts:
+            if __debug__: log('giving up on {}: {}', page, str(error))
+            with self._ready:
+                self.failed.append(page)
+                self._ready.notify_all()
+            return
+        page.queued = time.monotonic()
+        page.due = page.queued + self._policy.wait_after(page.attempts)
+        if __debug__: log('will retry {} in {:.1f}s', page, page.due - time.monotonic())
+        with self._ready:
+            if self._closing:
+                self.failed.append(page)
+                return
+            heapq.heappush(self._pending, page)
+            if not self._thread:
+                self._thread = Thread(target = self._retry_loop, name = 'Retrier',
+                                      daemon = True)
+                self._thread.start()
+            self._ready.notify_all()
+
+
+    def idle(self):
+        '''Returns True if no pages are waiting or being retried.'''
+        with self._ready:
+            return not self._pending and not self._busy
+
+
+    def wait(self):
+        '''Waits until no pages are waiting or being retried.'''
+        with self._ready:
+            while self._pending or self._busy:
+                self._ready.wait()
+
+
+    def close(self, abandon = False):
+        '''Stops the retry thread.  If 'abandon' is True, pages still waiting
+        are added to the failed pages instead of being retried.'''
+        if not abandon:
+            self.wait()
+        with self._ready:
+            self.failed.extend(self._pending)
+            self._pending = []
+            self._closing = True
+            self._ready.notify_all()
+        if self._thread:
+            self._thread.join()
+
+
+    def _retry_loop(self):
+        while True:
+            with self._ready:
+                while True:
+                    if self._closing:
+                        return
+                    now = time.monotonic()
+                    if self._pending and self._pending[0].due <= now:
+                        break
+                    if self._pending:
+                        with span('retry-wait', start = self._pending[0].start):
+                            self._ready.wait(self._pending[0].due - now)
+                    else:
+                        self._ready.wait()
+                page = heapq.heappop(self._pending)
+                page.backoff += now - page.queued
+                self._busy = True
+            if __debug__: log('retrying {} (attempt {})', page, page.attempts + 1)
+            try:
+                data = self._fetch(page)
+            except Exception as ex:
+                self.add(page, ex)
+            else:
+                try:
+                    self._accept(page, data)
+                except Exception as ex:
+                    if __debug__: log('could not accept {}: {}', page, str(ex))
+                    page.error = ex
+                    with self._ready:
+                        self.failed.append(page)
+            with self._ready:
+                self._busy = False
+                self._ready.notify_all()
@@ -16,9 +16,8 @@ file "LICENSE" for more information.
 
 import os
 from   os import path
+import shutil
 import sys
-import subprocess
-import webbrowser
 
 if __debug__:
     from sidetrack import log, logr
@@ -81,6 +80,22 @@ def desktop_path():
         return path.join(path.join(path.expanduser('~')), 'Desktop')
 
 
+def user_data_path():
+    '''Returns the path to the directory where Martian keeps its own files
+    for the current user (e.g., the job queue in service mode), creating
+    the directory if it does not exist.'''
+    if sys.platform.startswith('win'):
+        base = os.environ.get('APPDATA', path.expanduser('~'))
+        dir = path.join(base, 'Martian')
+    elif sys.platform.startswith('darwin'):
+        dir = path.join(path.expanduser('~'), 'Library', 'Application Support', 'Martian')
+    else:
+        base = os.environ.get('XDG_DATA_HOME', path.join(path.expanduser('~'), '.local', 'share'))
+        dir = path.join(base, 'martian')
+    os.makedirs(dir, exist_ok = True)
+    return dir
+
+
 def datadir_path():
     '''Returns the path to Lost It's internal data directory.'''
     return path.join(module_path(), 'data')
@@ -146,6 +161,7 @@ def file_in_use(file):
 def open_file(file):
     '''Open document with default application in Python.'''
     # Code originally from https://stackoverflow.com/a/435669/743730
+    import subprocess
     if __debug__: log('opening file {}', file)
     if sys.platform.startswith('darwin'):
         subprocess.call(('open', file))
@@ -158,5 +174,6 @@ def open_file(file):
 def open_url(url):
     '''Open the given 'url' in a web browser using the current platform's
     default approach.'''
+    import webbrowser
     if __debug__: log('opening url {}', url)
     webbrowser.open(url)
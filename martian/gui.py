@@ -0,0 +1,496 @@
+'''
+gui.py: WxPython windows used by Martian's GUI controller
+
+This module holds the main application frame and the user input dialog.
+It is only imported by MartianControlGUI (in control.py), so that running
+Martian from the command line with -G never loads WxPython.  Please see the
+comments at the top of control.py for how these objects communicate with the
+main body thread.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import os.path as path
+from   pubsub import pub
+import wx
+import wx.adv
+import wx.richtext
+import sys
+import textwrap
+from   threading import Thread
+from   time import sleep
+import webbrowser
+
+if __debug__:
+    from sidetrack import log, logr
+
+import martian
+from martian.files import datadir_path, readable
+from martian.exceptions import *
+from martian.logo import getMartianLogoIcon
+
+
+# Constants.
+# .............................................................................
+
+_FRAME_INTERVAL = 100
+'''Milliseconds between polls of the progress channel by the main frame.'''
+
+_MAX_LOG_LINES = 1000
+'''Maximum number of lines kept in the main frame's message area.  When
+there are more, the oldest lines are removed.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class MartianMainFrame(wx.Frame):
+    '''Defines the main application GUI frame.'''
+
+    def __init__(self, *args, **kwds):
+        self._cancel = False
+        self._height = 380 if sys.platform.startswith('win') else 350
+        self._width  = 500
+        self._channel = None
+        self._last_snapshot = None
+
+        kwds["style"] = kwds.get("style", 0) | wx.DEFAULT_FRAME_STYLE | wx.TAB_TRAVERSAL
+        wx.Frame.__init__(self, *args, **kwds)
+        self.panel = wx.Panel(self)
+        headline = martian.__name__ + " gets MARC records from TIND"
+        self.headline = wx.StaticText(self.panel, wx.ID_ANY, headline, style = wx.ALIGN_CENTER)
+        self.headline.SetFont(wx.Font(14, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_ITALIC,
+                                      wx.FONTWEIGHT_BOLD, 0, "Arial"))
+
+        # For macos, I figured out how to make the background color of the text
+        # box be the same as the rest of the UI elements.  That looks nicer for
+        # our purposes (IMHO) than the default (which would be white), but then
+        # we need a divider to separate the headline from the text area.
+        if not sys.platform.startswith('win'):
+            self.divider1 = wx.StaticLine(self.panel, wx.ID_ANY)
+            self.divider1.SetMinSize((self._width, 2))
+
+        self.text_area = wx.richtext.RichTextCtrl(self.panel, wx.ID_ANY,
+                                                  size = (self._width, 200),
+                                                  style = wx.TE_MULTILINE | wx.TE_READONLY)
+
+        # Progress bar and a line of text for throughput and time remaining.
+        self.gauge = wx.Gauge(self.panel, wx.ID_ANY, range = 100,
+                              size = (self._width, 16), style = wx.GA_HORIZONTAL)
+        self.status = wx.StaticText(self.panel, wx.ID_ANY, '', style = wx.ALIGN_LEFT)
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
+
+        # Quit button on the bottom.
+        if not sys.platform.startswith('win'):
+            self.divider2 = wx.StaticLine(self.panel, wx.ID_ANY)
+        self.quit_button = wx.Button(self.panel, label = "Quit")
+        self.quit_button.Bind(wx.EVT_KEY_DOWN, self.on_cancel_or_quit)
+
+        # On macos, the color of the text background is set to the same as the
+        # rest of the UI panel.  I haven't figured out how to do it on Windows.
+        if not sys.platform.startswith('win'):
+            gray = wx.SystemSettings.GetColour(wx.SYS_COLOUR_BACKGROUND)
+            self.text_area.SetBackgroundColour(gray)
+
+        # Create a simple menu bar.
+        self.menuBar = wx.MenuBar(0)
+
+        # Add a "File" menu with a quit item.
+        self.fileMenu = wx.Menu()
+        self.exitItem = wx.MenuItem(self.fileMenu, wx.ID_EXIT, "&Exit",
+                                    wx.EmptyString, wx.ITEM_NORMAL)
+        self.fileMenu.Append(self.exitItem)
+        if sys.platform.startswith('win'):
+            # Only need to add a File menu on Windows.  On Macs, wxPython
+            # automatically puts the wx.ID_EXIT item under the app menu.
+            self.menuBar.Append(self.fileMenu, "&File")
+
+        # Add a "help" menu bar item.
+        self.helpMenu = wx.Menu()
+        self.helpItem = wx.MenuItem(self.helpMenu, wx.ID_HELP, "&Help",
+                                    wx.EmptyString, wx.ITEM_NORMAL)
+        self.helpMenu.Append(self.helpItem)
+        self.helpMenu.AppendSeparator()
+        self.aboutItem = wx.MenuItem(self.helpMenu, wx.ID_ABOUT,
+                                     "&About " + martian.__name__,
+                                     wx.EmptyString, wx.ITEM_NORMAL)
+        self.helpMenu.Append(self.aboutItem)
+        self.menuBar.Append(self.helpMenu, "Help")
+
+        # Put everything together and bind some keystrokes to events.
+        self.SetMenuBar(self.menuBar)
+        self.Bind(wx.EVT_MENU, self.on_cancel_or_quit, id = self.exitItem.GetId())
+        self.Bind(wx.EVT_MENU, self.on_help, id = self.helpItem.GetId())
+        self.Bind(wx.EVT_MENU, self.on_about, id = self.aboutItem.GetId())
+        self.Bind(wx.EVT_CLOSE, self.on_cancel_or_quit)
+        self.Bind(wx.EVT_BUTTON, self.on_cancel_or_quit, self.quit_button)
+
+        close_id = wx.NewId()
+        self.Bind(wx.EVT_MENU, self.on_cancel_or_quit, id = close_id)
+        accel_tbl = wx.AcceleratorTable([(wx.ACCEL_CTRL, ord('W'), close_id )])
+        self.SetAcceleratorTable(accel_tbl)
+
+        # Now that we created all the elements, set layout and placement.
+        self.SetSize((self._width, self._height))
+        self.SetTitle(martian.__name__)
+        self.outermost_sizer = wx.BoxSizer(wx.VERTICAL)
+        self.outermost_sizer.AddSpacer(5)
+        self.outermost_sizer.Add(self.headline, 0, wx.ALIGN_CENTER, 0)
+        self.outermost_sizer.AddSpacer(5)
+        if not sys.platform.startswith('win'):
+            self.outermost_sizer.Add(self.divider1, 0, wx.EXPAND, 0)
+            self.outermost_sizer.AddSpacer(5)
+        self.outermost_sizer.Add(self.text_area, 0, wx.EXPAND, 0)
+        self.outermost_sizer.AddSpacer(5)
+        self.outermost_sizer.Add(self.gauge, 0, wx.EXPAND, 0)
+        self.outermost_sizer.AddSpacer(3)
+        self.outermost_sizer.Add(self.status, 0, wx.EXPAND, 0)
+        self.outermost_sizer.AddSpacer(5)
+        if not sys.platform.startswith('win'):
+            self.outermost_sizer.Add(self.divider2, 0, wx.EXPAND, 0)
+            self.outermost_sizer.AddSpacer(5)
+        self.outermost_sizer.Add(self.quit_button, 0, wx.BOTTOM | wx.CENTER, 0)
+        self.outermost_sizer.AddSpacer(5)
+        self.SetSizer(self.outermost_sizer)
+        self.Layout()
+        self.Centre()
+
+        # Finally, hook in message-passing interface.
+        pub.subscribe(self.progress_message, "progress_message")
+        pub.subscribe(self.progress_channel, "progress_channel")
+        pub.subscribe(self.user_dialog, "user_dialog")
+
+
+    def on_cancel_or_quit(self, event):
+        if __debug__: log('got Exit/Cancel')
+        self._cancel = True
+        wx.BeginBusyCursor()
+        self.progress_message('')
+        self.progress_message('Stopping work – this may take a few moments')
+
+        # We can't call pub.sendMessage from this function, nor does it work
+        # to call it using wx.CallAfter directly from this function: both
+        # methods hang the GUI and the progress message is never printed.
+        # Calling it from a separate thread works.  The sleep is to make sure
+        # this calling function returns before the thread calls 'quit'.
+
+        def quitter():
+            sleep(1)
+            if __debug__: log('sending message to quit')
+            wx.CallAfter(pub.sendMessage, 'quit')
+
+        subthread = Thread(target = quitter)
+        subthread.start()
+        return True
+
+
+    def on_escape(self, event):
+        if __debug__: log('got Escape')
+        keycode = event.GetKeyCode()
+        if keycode == wx.WXK_ESCAPE:
+            self.on_cancel_or_quit(event)
+        else:
+            event.Skip()
+        return True
+
+
+    def on_about(self, event):
+        if __debug__: log('opening About window')
+        dlg = wx.adv.AboutDialogInfo()
+        dlg.SetName(martian.__name__)
+        dlg.SetVersion(martian.__version__)
+        dlg.SetLicense(martian.__license__)
+        dlg.SetDescription('\n'.join(textwrap.wrap(martian.__description__, 81)))
+        dlg.SetWebSite(martian.__url__)
+        dlg.AddDeveloper(martian.__author__)
+        dlg.SetIcon(getMartianLogoIcon())
+        wx.adv.AboutBox(dlg)
+        return True
+
+
+    def on_help(self, event):
+        if __debug__: log('opening Help window')
+        wx.BeginBusyCursor()
+        help_file = path.join(datadir_path(), "help.html")
+        if readable(help_file):
+            webbrowser.open_new("file://" + help_file)
+        wx.EndBusyCursor()
+        return True
+
+
+    def progress_message(self, message):
+        self.append_messages([message])
+        return True
+
+
+    def progress_channel(self, channel):
+        '''Starts polling the given ProgressChannel at a fixed rate.'''
+        if __debug__: log('got progress channel; starting timer')
+        self._channel = channel
+        self.timer.Start(_FRAME_INTERVAL)
+        return True
+
+
+    def on_timer(self, event):
+        '''Takes whatever messages and counts have accumulated in the progress
+        channel since the last tick and displays them all at once.'''
+        messages = self._channel.drain()
+        if messages:
+            self.append_messages(messages)
+        snapshot = self._channel.meter.snapshot()
+        if snapshot != self._last_snapshot:
+            self._last_snapshot = snapshot
+            (done, total, _, _, _) = snapshot
+            if total:
+                self.gauge.SetValue(min(100, 100 * done // total))
+                self.status.SetLabel(self._channel.meter.summary())
+
+
+    def append_messages(self, messages):
+        '''Appends the messages to the message area in a single update, and
+        drops the oldest lines if there are more than _MAX_LOG_LINES.'''
+        self.text_area.Freeze()
+        self.text_area.SetInsertionPointEnd()
+        self.text_area.AppendText(''.join(m + ' ...\n' for m in messages))
+        excess = self.text_area.GetNumberOfLines() - _MAX_LOG_LINES
+        if excess > 0:
+            self.text_area.Remove(0, self.text_area.XYToPosition(0, excess))
+        self.text_area.Thaw()
+        self.text_area.ShowPosition(self.text_area.GetLastPosition())
+
+
+    def user_dialog(self, results, search, output):
+        if __debug__: log('creating and showing user dialog')
+        dialog = UserDialog(self)
+        dialog.initialize_values(results, search, output)
+        dialog.ShowWindowModal()
+        return True
+
+
+class UserDialog(wx.Dialog):
+    '''Defines the modal dialog used for getting the search string.'''
+
+    def __init__(self, *args, **kwargs):
+        super(UserDialog, self).__init__(*args, **kwargs)
+        self._search = None
+        self._output = None
+        self._cancel = False
+        self._wait_queue = None
+
+        panel = wx.Panel(self)
+        if sys.platform.startswith('win'):
+            self.SetSize((450, 175))
+        else:
+            self.SetSize((450, 155))
+        self.explanation = wx.StaticText(panel, wx.ID_ANY,
+                                         'Please provide a search string (or URL) and a destination file',
+                                         style = wx.ALIGN_CENTER)
+        self.top_line = wx.StaticLine(panel, wx.ID_ANY)
+
+        self.search_label = wx.StaticText(panel, wx.ID_ANY, "Search (or URL): ", style = wx.ALIGN_RIGHT)
+        self.search = wx.TextCtrl(panel, wx.ID_ANY, '', style = wx.TE_PROCESS_ENTER,
+                                  size = (300, 22))
+        self.search.Bind(wx.EVT_KEY_DOWN, self.on_enter_or_tab)
+        self.search.Bind(wx.EVT_TEXT, self.on_input)
+
+        self.output_label = wx.StaticText(panel, wx.ID_ANY, "Output file: ", style = wx.ALIGN_RIGHT)
+        file_picker_height = 32 if not sys.platform.startswith('win') else 25
+        self.output = wx.FilePickerCtrl(panel, message = "Save downloaded records",
+                                        style = wx.FLP_USE_TEXTCTRL | wx.FLP_SAVE,
+                                        size = (340, file_picker_height))
+        self.output.Bind(wx.EVT_FILEPICKER_CHANGED, self.on_input)
+
+        self.bottom_line = wx.StaticLine(panel, wx.ID_ANY)
+        self.cancel_button = wx.Button(panel, wx.ID_ANY, "Cancel")
+        self.cancel_button.Bind(wx.EVT_KEY_DOWN, self.on_escape)
+        self.ok_button = wx.Button(panel, wx.ID_ANY, "OK")
+        self.ok_button.Bind(wx.EVT_KEY_DOWN, self.on_ok_enter_key)
+        self.ok_button.SetDefault()
+        self.ok_button.Disable()
+
+        # Put everything together and bind some keystrokes to events.
+        self.__set_properties()
+        self.__do_layout()
+        self.Bind(wx.EVT_BUTTON, self.on_cancel_or_quit, self.cancel_button)
+        self.Bind(wx.EVT_BUTTON, self.on_ok, self.ok_button)
+        self.Bind(wx.EVT_CLOSE, self.on_cancel_or_quit)
+
+        close_id = wx.NewId()
+        self.Bind(wx.EVT_MENU, self.on_cancel_or_quit, id = close_id)
+        accel_tbl = wx.AcceleratorTable([
+            (wx.ACCEL_CTRL, ord('W'), close_id ),
+            (wx.ACCEL_CMD, ord('.'), close_id ),
+        ])
+        self.SetAcceleratorTable(accel_tbl)
+
+
+    def __set_properties(self):
+        self.SetTitle(martian.__name__)
+        self.search_label.SetToolTip('A search string or the full URL of a search in caltech.tind.io')
+        self.search.SetMinSize((330, 22))
+        self.output_label.SetToolTip('The file where the downloaded results should be written')
+        self.output.SetMinSize((330, 22))
+        self.ok_button.SetFocus()
+
+
+    def __do_layout(self):
+        self.user_dialog_sizer = wx.FlexGridSizer(2, 2, 5, 0)
+        self.user_dialog_sizer.Add(self.search_label, 0, wx.ALIGN_RIGHT, 0)
+        self.padding_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        if not sys.platform.startswith('win'):
+            self.padding_sizer.AddSpacer(5)
+        self.padding_sizer.Add(self.search, 0, wx.ALIGN_LEFT | wx.EXPAND, 0)
+        self.user_dialog_sizer.Add(self.padding_sizer, 0, wx.ALIGN_LEFT | wx.FIXED_MINSIZE, 0)
+        self.user_dialog_sizer.Add(self.output_label, 0, wx.ALIGN_RIGHT, 0)
+        self.user_dialog_sizer.Add(self.output, 0, wx.ALIGN_BOTTOM | wx.FIXED_MINSIZE, 0)
+
+        self.button_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.button_sizer.Add((0, 0), 0, 0, 0)
+        self.button_sizer.Add(self.cancel_button, 0, wx.ALIGN_CENTER, 0)
+        self.button_sizer.Add((10, 20), 0, 0, 0)
+        self.button_sizer.Add(self.ok_button, 0, wx.ALIGN_CENTER, 0)
+        self.button_sizer.Add((10, 20), 0, wx.ALIGN_CENTER, 0)
+
+        self.outermost_sizer = wx.BoxSizer(wx.VERTICAL)
+        self.outermost_sizer.Add((420, 5), 0, wx.ALIGN_CENTER, 0)
+        self.outermost_sizer.Add(self.explanation, 0, wx.ALIGN_CENTER, 0)
+        self.outermost_sizer.Add((420, 5), 0, wx.ALIGN_CENTER, 0)
+        self.outermost_sizer.Add(self.top_line, 0, wx.EXPAND, 0)
+        self.outermost_sizer.Add((420, 8), 0, wx.ALIGN_CENTER, 0)
+        self.outermost_sizer.Add(self.user_dialog_sizer, 1, wx.ALIGN_CENTER | wx.FIXED_MINSIZE, 5)
+        self.outermost_sizer.Add((420, 5), 0, 0, 0)
+        self.outermost_sizer.Add(self.bottom_line, 0, wx.EXPAND, 0)
+        self.outermost_sizer.Add((420, 5), 0, 0, 0)
+        self.outermost_sizer.Add(self.button_sizer, 1, wx.ALIGN_RIGHT, 0)
+        self.outermost_sizer.Add((420, 5), 0, wx.ALIGN_CENTER, 0)
+        self.SetSizer(self.outermost_sizer)
+
+        self.Layout()
+        self.Centre()
+
+
+    def initialize_values(self, wait_queue, search, output):
+        '''Initializes values used to populate the dialog and communicate
+        with calling code.
+
+        'wait_queue' must be a Pytho queue.Queue() object.  Callers must
+        create the queue object and pass it to this function.  After creating
+        and displaying the dialog, callers can use .get() on the queue object
+        to wait until the user has either clicked OK or Cancel in the dialog.
+
+        'search' and 'output' are used to populate the form in
+        case there are preexisting values to be used as defaults.
+        '''
+
+        self._wait_queue = wait_queue
+        self._search = search
+        self._output = output
+        if self._search:
+            self.search.AppendText(self._search)
+            self.search.Refresh()
+        if self._output:
+            self.output.SetPath(self._output)
+        if search and output:
+            self.ok_button.Enable()
+
+
+    def return_values(self):
+        if __debug__: log('return_values called')
+        self._wait_queue.put((self._search, self._output, self._cancel))
+
+
+    def inputs_nonempty(self):
+        search = self.search.GetValue()
+        output = self.output.GetPath()
+        if search.strip() and output.strip():
+            return True
+        return False
+
+
+    def on_ok(self, event):
+        '''Stores the current values and destroys the dialog.'''
+
+        if __debug__: log('got OK')
+        if self.inputs_nonempty():
+            self._cancel = False
+            self._search = self.search.GetValue()
+            self._output = self.output.GetPath()
+            self.return_values()
+            self.EndModal(event.EventObject.Id)
+        else:
+            if __debug__: log('has incomplete inputs')
+            self.complain_incomplete_values(event)
+
+
+    def on_cancel_or_quit(self, event):
+        if __debug__: log('got Cancel')
+        self._cancel = True
+        self.return_values()
+        self.EndModal(event.EventObject.Id)
+
+
+    def on_input(self, event):
+        if self.search.GetValue() and self.output.GetPath():
+            self.ok_button.Enable()
+        else:
+            self.ok_button.Disable()
+
+
+    def on_escape(self, event):
+        keycode = event.GetKeyCode()
+        if keycode == wx.WXK_ESCAPE:
+            if __debug__: log('got Escape')
+            self.on_cancel_or_quit(event)
+        else:
+            event.Skip()
+
+
+    def on_ok_enter_key(self, event):
+        keycode = event.GetKeyCode()
+        if keycode in [wx.WXK_RETURN, wx.WXK_NUMPAD_ENTER, wx.WXK_SPACE]:
+            self.on_ok(event)
+        elif keycode == wx.WXK_ESCAPE:
+            self.on_cancel_or_quit(event)
+        else:
+            event.EventObject.Navigate()
+
+
+    def on_enter_or_tab(self, event):
+        keycode = event.GetKeyCode()
+        if keycode in [wx.WXK_RETURN, wx.WXK_NUMPAD_ENTER]:
+            # If the ok button is enabled, we interpret return/enter as "done".
+            if self.ok_button.IsEnabled():
+                self.on_ok(event)
+            # If focus is on the login line, move to output.
+            if wx.Window.FindFocus() is self.search:
+                event.EventObject.Navigate()
+        elif keycode == wx.WXK_TAB:
+            event.EventObject.Navigate()
+        elif keycode == wx.WXK_ESCAPE:
+            self.on_cancel_or_quit(event)
+        else:
+            event.Skip()
+
+
+    def complain_incomplete_values(self, event):
+        dialog = wx.MessageDialog(self, caption = "Missing search and/or output",
+                                  message = "Incomplete values – do you want to quit?",
+                                  style = wx.YES_NO | wx.ICON_WARNING,
+                                  pos = wx.DefaultPosition)
+        response = dialog.ShowModal()
+        dialog.EndModal(wx.OK)
+        dialog.Destroy()
+        if (response == wx.ID_YES):
+            self._cancel = True
+            self.return_values()
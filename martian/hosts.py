@@ -0,0 +1,227 @@
+'''
+hosts.py: harvest from one or more TIND instances
+
+A Host object stands for one TIND instance.  It holds the backend used to
+talk to the instance and a TransportPool of connections to it, which limits
+the number of connections open to that instance at once, can limit the rate
+of requests sent to it, and keeps track of whether the instance seems to be
+healthy.  When an instance fails several requests in a row, its pool turns
+away further requests to it for a growing pause, until one succeeds (see
+TransportPool in transport.py), so that the pages for an instance that is
+down fail quickly instead of tying up the harvest.  Since every instance has
+its own pool, a slow or failing instance is paused on its own, without
+holding up work on the others.
+
+A MultiHostHarvest runs the same search on several instances at the same
+time, each in its own thread, and writes the results from each instance to
+its own output file.  It has the same download() and interrupt() methods as
+Tind, so it can be used in place of a Tind object.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   os import path
+from   threading import Lock, Thread
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.backends import backend_for
+from martian.exceptions import *
+from martian.metrics import DownloadResult, RunMetrics
+from martian.tind import Tind
+from martian.transport import TransportPool
+
+
+# Exported functions.
+# .............................................................................
+
+def output_for(output, host):
+    '''Returns the name of the output file for 'host', made by adding the
+    host name to the file name 'output' (e.g., "out-caltech.tind.io.xml").'''
+    (base, ext) = path.splitext(output)
+    # Host names can include a port number, but ':' is not allowed in file
+    # names on Windows.
+    return '{}-{}{}'.format(base, host.name.replace(':', '_'), ext or '.xml')
+
+
+# Exported classes.
+# .............................................................................
+
+class Host(object):
+    '''A TIND instance at 'url' (None for the default instance), accessed
+    using the backend named 'backend' with at most 'connections' open
+    connections and at most 'rate' page requests per second (None for no
+    limit), with transfers limited by the Timeouts object 'timeouts'.  If
+    'cassette' is given, requests are recorded in or replayed from that
+    Cassette (see cassette.py).  Any further keyword arguments are passed to
+    the backend.'''
+
+    def __init__(self, url = None, backend = 'search', connections = 4, rate = None,
+                 timeouts = None, cassette = None, **kwargs):
+        self.backend = backend_for(backend, host = url, **kwargs)
+        self.name    = self.backend.host_name
+        limits = dict(size = connections, limit = connections, rate = rate,
+                      timeouts = timeouts)
+        if cassette:
+            from martian.cassette import CassettePool
+            self.pool = CassettePool(cassette, **limits)
+        else:
+            self.pool = TransportPool(**limits)
+
+
+    @property
+    def replaying(self):
+        '''True if responses come from a cassette instead of the instance.'''
+        cassette = getattr(self.pool, 'cassette', None)
+        return bool(cassette and not cassette.recording)
+
+
+    def status(self):
+        return {'host'       : self.name,
+                'requests'   : self.pool.requests,
+                'failures'   : self.pool.failures,
+                'healthy'    : self.pool.healthy,
+                'last_error' : str(self.pool.last_error or '')}
+
+
+    def close(self):
+        self.pool.close()
+
+
+class MultiHostHarvest(object):
+    '''Downloads the results of a search from each of 'hosts' at once.  The
+    notifier and tracer are shared; messages are labeled with the host name
+    and progress is added up over all the hosts.  Keyword arguments are
+    passed on to the Tind objects used for the hosts.'''
+
+    def __init__(self, hosts, notifier, tracer, **kwargs):
+        self._hosts    = hosts
+        self._notifier = notifier
+        self._tracer   = tracer
+        self._kwargs   = kwargs
+        self._tinds    = []
+        self._progress = {}
+        self._lock     = Lock()
+
+
+    def download(self, search, output, start = 1, total = -1):
+        '''Runs the search on every host, writing the results to files named
+        by output_for().  Returns a DownloadResult whose 'written' value is
+        the total over all hosts.  Failures on some hosts are reported as
+        warnings; if every host fails, the first failure is raised.'''
+        results = {}
+
+        def run(host, tind):
+            try:
+                results[host.name] = tind.download(search, output_for(output, host),
+                                                   start, total)
+            except Exception as ex:
+                if __debug__: log('harvest from {} failed: {}', host.name, str(ex))
+                results[host.name] = ex
+
+        threads = []
+        for host in self._hosts:
+            tind = Tind(None, _HostNotifier(self._notifier, host.name),
+                        _HostTracer(self, host.name), host.pool,
+                        backend = host.backend, **self._kwargs)
+            self._tinds.append(tind)
+            threads.append(Thread(target = run, args = (host, tind),
+                                  name = 'Harvest-{}'.format(host.name)))
+        if __debug__: log('harvesting from {} hosts', len(threads))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        combined = DownloadResult(0, output, RunMetrics())
+        failures = []
+        for host in self._hosts:
+            result = results.get(host.name)
+            if isinstance(result, Exception):
+                failures.append(result)
+                self._notifier.warn('Harvest from {} failed: {}'.format(host.name, result))
+                continue
+            combined.written += result.written
+            combined.failed.extend(result.failed)
+            combined.metrics.probe_time = max(combined.metrics.probe_time,
+                                              result.metrics.probe_time)
+            for page in result.metrics.pages:
+                combined.metrics.add_page(page)
+            self._tracer.update('{}: {} records written to {}'.format(
+                host.name, result.written, result.output))
+        combined.metrics.finish()
+        if failures and len(failures) == len(self._hosts):
+            raise failures[0]
+        return combined
+
+
+    def interrupt(self):
+        for tind in self._tinds:
+            tind.interrupt()
+
+
+    def _progress_of(self, name, done, total, nbytes):
+        with self._lock:
+            self._progress[name] = (done, total, nbytes)
+            sums = [sum(values) for values in zip(*self._progress.values())]
+            self._tracer.progress(*sums)
+
+
+# Internal implementation.
+# .............................................................................
+
+class _HostNotifier(object):
+    '''Notifier that labels messages with a host name.'''
+
+    def __init__(self, notifier, name):
+        self._notifier = notifier
+        self._name = name
+
+    def info(self, text, details = ''):
+        self._notifier.info('{}: {}'.format(self._name, text), details)
+
+    def warn(self, text, details = ''):
+        self._notifier.warn('{}: {}'.format(self._name, text), details)
+
+    def error(self, text, details = ''):
+        self._notifier.error('{}: {}'.format(self._name, text), details)
+
+    def fatal(self, text, details = ''):
+        # A failure on one host is not fatal to the others.
+        self._notifier.error('{}: {}'.format(self._name, text), details)
+
+    def yes_no(self, question):
+        return self._notifier.yes_no('{}: {}'.format(self._name, question))
+
+
+class _HostTracer(object):
+    '''Progress tracer that labels messages with a host name and sends
+    progress values to the MultiHostHarvest to be added up.'''
+
+    def __init__(self, harvest, name):
+        self._harvest = harvest
+        self._name = name
+
+    def start(self, message = None):
+        pass
+
+    def update(self, message = None):
+        if message:
+            self._harvest._tracer.update('{}: {}'.format(self._name, message))
+
+    def stop(self, message = None):
+        pass
+
+    def progress(self, done, total, nbytes = 0):
+        self._harvest._progress_of(self._name, done, total, nbytes)
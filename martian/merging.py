@@ -0,0 +1,170 @@
+'''
+merging.py: combine several harvest files into one collection of records
+
+merge_files() streams any number of MARC XML files written by Martian (from
+different searches, hosts or parts of a harvest) into one output file, with
+each record appearing once.  Records are identified by their 001 field.
+When the same record is in more than one input, one copy is kept according
+to a policy:
+
+  newest  -- the copy with the latest 005 field (the date of the record's
+             latest transaction); if they are equal, the later input wins
+  first   -- the copy in the earliest input file in the list
+  last    -- the copy in the latest input file in the list
+
+Records without a 001 field can't be matched and are all kept.
+
+The inputs are combined with a k-way merge: each is read a chunk at a time,
+and a heap picks the record with the lowest 001 among the next records of
+all of them.  Copies of a record therefore come out next to each other, and
+memory use depends on the number of inputs, not on their size.  This needs
+the inputs to be in order of their 001 fields, as written by the -O option
+or the "sort" subcommand.  Each input is checked in a first pass, and one
+that is not in order is sorted into a temporary file (see sorting.py).  The
+output is in 001 order as well.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import heapq
+from   itertools import groupby
+from   operator import itemgetter
+import os
+from   os import path
+import re
+import shutil
+import tempfile
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.changes import id_order, records_in
+from martian.exceptions import *
+from martian.sorting import sort_file, sort_key
+
+
+# Constants.
+# .............................................................................
+
+POLICIES = ('newest', 'first', 'last')
+'''Ways of choosing which copy of a duplicated record to keep.'''
+
+_CHUNK_SIZE = 256 * 1024
+'''Number of bytes read from each input at a time.'''
+
+_NO_ID = id_order(None)
+
+_DATE = re.compile(rb'<controlfield tag="005">\s*([^<]*?)\s*</controlfield>')
+
+_HEADER = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+           b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+_FOOTER = b'</collection>\n'
+
+
+# Exported functions.
+# .............................................................................
+
+def merge_files(inputs, output, keep = 'newest', **sort_options):
+    '''Writes the records of the MARC XML files 'inputs' to the file
+    'output', in order of their 001 fields and with one copy of each record,
+    chosen according to the policy 'keep' (one of POLICIES).  'output' can
+    be one of the inputs.  Inputs that are not sorted by 001 are sorted
+    first, with 'sort_options' passed to sort_file().  Returns a tuple of
+    the number of records written and the number of duplicates left out.'''
+    if keep not in POLICIES:
+        raise ValueError('Unknown policy "{}" for duplicates; use one of {}'
+                         .format(keep, ', '.join(POLICIES)))
+    directory = path.dirname(path.abspath(output))
+    scratch = tempfile.mkdtemp(prefix = '.martian-merge-', dir = directory)
+    try:
+        files = []
+        for n, file in enumerate(inputs):
+            if _is_sorted(file):
+                files.append(file)
+            else:
+                if __debug__: log('{} is not sorted by 001; sorting it first', file)
+                sorted_file = path.join(scratch, 'input-{:06d}.xml'.format(n))
+                sort_file(file, sorted_file, directory = scratch, **sort_options)
+                files.append(sorted_file)
+        (fd, temp) = tempfile.mkstemp(prefix = '.martian-merged-', suffix = '.xml',
+                                      dir = directory)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(_HEADER)
+                (written, duplicates) = _merge(files, out, keep)
+                out.write(_FOOTER)
+            os.replace(temp, output)
+        except BaseException:
+            if path.exists(temp):
+                os.remove(temp)
+            raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors = True)
+    if __debug__: log('wrote {} records to {}, leaving out {} duplicates',
+                      written, output, duplicates)
+    return (written, duplicates)
+
+
+# Internal implementation.
+# .............................................................................
+
+def _is_sorted(file):
+    '''Returns True if the records in 'file' are in order of their 001s.'''
+    previous = None
+    for record in records_in(file, _CHUNK_SIZE):
+        key = sort_key(record)
+        if previous is not None and key < previous:
+            return False
+        previous = key
+    return True
+
+
+def _merge(files, out, keep):
+    '''Writes one copy of each record in the sorted 'files' to 'out'.'''
+    def entries(n, file):
+        # The input number and position make the tuples unique, so records
+        # with equal keys come out in the order of the inputs.
+        for position, record in enumerate(records_in(file, _CHUNK_SIZE)):
+            yield (sort_key(record), n, position, record)
+
+    written = duplicates = 0
+    streams = [entries(n, file) for n, file in enumerate(files)]
+    for (id_key, copies) in groupby(heapq.merge(*streams), key = itemgetter(0)):
+        if id_key == _NO_ID:
+            # Records without a 001 field can't be matched with each other.
+            kept = [copy[3] for copy in copies]
+        else:
+            copies = list(copies)
+            kept = [_choose(copies, keep)]
+            duplicates += len(copies) - 1
+        for record in kept:
+            out.write(record)
+            out.write(b'\n')
+            written += 1
+    return (written, duplicates)
+
+
+def _choose(copies, keep):
+    '''Returns the record to keep from the list 'copies' of entries made by
+    _merge(), which are in the order of the inputs.'''
+    if keep == 'first':
+        return copies[0][3]
+    if keep == 'last':
+        return copies[-1][3]
+    # Dates in 005 fields (yyyymmddhhmmss.f) sort correctly as strings.
+    return max(reversed(copies), key = lambda copy: _date(copy[3]))[3]
+
+
+def _date(record):
+    match = _DATE.search(record)
+    return match.group(1) if match else b''
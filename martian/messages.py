@@ -16,8 +16,6 @@ file "LICENSE" for more information.
 
 import queue
 import sys
-import wx
-import wx.lib.dialogs
 
 try:
     from termcolor import colored
@@ -86,7 +84,11 @@ class MessageHandlerCLI(MessageHandlerBase):
 
 
 class MessageHandlerGUI(MessageHandlerBase):
-    '''Class for GUI-based user messages and asking the user questions.'''
+    '''Class for GUI-based user messages and asking the user questions.
+
+    WxPython is imported inside the methods of this class rather than at the
+    top of this module, so that the command-line interface never loads it.
+    '''
 
     def __init__(self):
         super().__init__()
@@ -96,19 +98,19 @@ class MessageHandlerGUI(MessageHandlerBase):
 
     def info(self, text, details = ''):
         '''Prints an informational message.'''
-        wx.CallAfter(self._note, text, details, 'info')
+        self._call_after(self._note, text, details, 'info')
         self._wait()
 
 
     def warn(self, text, details = ''):
         '''Prints a nonfatal, noncritical warning message.'''
-        wx.CallAfter(self._note, text, details, 'warn')
+        self._call_after(self._note, text, details, 'warn')
         self._wait()
 
 
     def error(self, text, details = ''):
         '''Prints a message reporting a critical error.'''
-        wx.CallAfter(self._dialog, text, details, 'error')
+        self._call_after(self._dialog, text, details, 'error')
         self._wait()
 
 
@@ -117,19 +119,25 @@ class MessageHandlerGUI(MessageHandlerBase):
         exit the program; it leaves that to the caller in case the caller
         needs to perform additional tasks before exiting.
         '''
-        wx.CallAfter(self._dialog, text, details, 'fatal')
+        self._call_after(self._dialog, text, details, 'fatal')
         self._wait()
 
 
     def yes_no(self, question):
         '''Asks the user a yes/no question using a GUI dialog.'''
-        wx.CallAfter(self._yes_no, question)
+        self._call_after(self._yes_no, question)
         self._wait()
         return self._response
 
 
+    def _call_after(self, func, *args):
+        import wx
+        wx.CallAfter(func, *args)
+
+
     def _note(self, text, details = '', severity = 'info'):
         '''Displays a simple notice with a single OK button.'''
+        import wx
         frame = wx.Frame(wx.GetApp().TopWindow)
         frame.Center()
         icon = wx.ICON_WARNING if severity == 'warn' else wx.ICON_INFORMATION
@@ -143,6 +151,8 @@ class MessageHandlerGUI(MessageHandlerBase):
 
 
     def _dialog(self, text, details = '', severity = 'error'):
+        import wx
+        import wx.lib.dialogs
         frame = wx.Frame(wx.GetApp().TopWindow)
         frame.Center()
         if 'fatal' in severity:
@@ -180,6 +190,7 @@ class MessageHandlerGUI(MessageHandlerBase):
 
 
     def _yes_no(self, question):
+        import wx
         frame = wx.Frame(wx.GetApp().TopWindow)
         frame.Center()
         dlg = wx.GenericMessageDialog(frame, question, caption = "Martian",
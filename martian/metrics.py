@@ -0,0 +1,264 @@
+'''
+metrics.py: record and summarize measurements of Martian harvest runs
+
+A RunMetrics object collects one PageMetrics record for every page of MARC
+records fetched from TIND, plus the time taken by the preliminary count
+probe.  The per-page values are aggregated into histograms, and the whole
+thing can be written out as a JSON summary or as a Prometheus "textfile"
+(for use with the node_exporter textfile collector).
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import json
+import os
+from   threading import Lock
+import time
+
+if __debug__:
+    from sidetrack import log, logr
+
+
+# Constants.
+# .............................................................................
+
+_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+'''Upper bounds (in seconds) of the histogram buckets used for durations.'''
+
+_PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'total')
+'''Names of the per-page timing values that get histograms.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class PageMetrics(object):
+    '''Measurements for one page of records fetched from TIND.'''
+
+    __slots__ = ('start', 'status', 'bytes', 'records', 'retries', 'backoff') + _PHASES
+
+    def __init__(self, start, status = 0, bytes = 0, records = 0, retries = 0,
+                 backoff = 0, timing = None):
+        self.start   = start
+        self.status  = status
+        self.bytes   = bytes
+        self.records = records
+        self.retries = retries
+        self.backoff = backoff
+        for phase in _PHASES:
+            setattr(self, phase, getattr(timing, phase) if timing else 0)
+
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Histogram(object):
+    '''Cumulative histogram with fixed bucket upper bounds, in the style of
+    Prometheus histograms.'''
+
+    def __init__(self, buckets = _TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)   # Last one is +Inf.
+        self.count   = 0
+        self.sum     = 0
+        self.min     = None
+        self.max     = None
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+
+    def quantile(self, q):
+        '''Returns an estimate of quantile 'q' (0-1): the upper bound of the
+        bucket in which it falls, capped at the largest observed value.'''
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for index, bound in enumerate(self.buckets):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+    def cumulative(self):
+        '''Returns a list of (upper bound, cumulative count), ending with
+        (float('inf'), total count).'''
+        result = []
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            result.append((bound, seen))
+        return result
+
+
+    def summary(self):
+        return {'count' : self.count,
+                'sum'   : self.sum,
+                'min'   : self.min,
+                'max'   : self.max,
+                'mean'  : (self.sum / self.count) if self.count else None,
+                'p50'   : self.quantile(0.5),
+                'p90'   : self.quantile(0.9),
+                'p99'   : self.quantile(0.99)}
+
+
+class RunMetrics(object):
+    '''Collects measurements for one download.  Safe to use from multiple
+    threads.'''
+
+    def __init__(self):
+        self.pages       = []
+        self.histograms  = {phase: Histogram() for phase in _PHASES}
+        self.probe_time  = 0
+        self.concurrency = 1            # Number of parts fetched at once.
+        self.started     = time.time()
+        self.finished    = None
+        self._lock       = Lock()
+
+
+    def add_page(self, page):
+        with self._lock:
+            self.pages.append(page)
+            for phase in _PHASES:
+                self.histograms[phase].observe(getattr(page, phase))
+
+
+    def finish(self):
+        self.finished = time.time()
+
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+
+    def totals(self):
+        with self._lock:
+            return {'pages'   : len(self.pages),
+                    'records' : sum(p.records for p in self.pages),
+                    'bytes'   : sum(p.bytes for p in self.pages),
+                    'retries' : sum(p.retries for p in self.pages),
+                    'backoff' : sum(p.backoff for p in self.pages)}
+
+
+    def summary(self):
+        '''Returns a dict summarizing the run, suitable for JSON output.'''
+        totals = self.totals()
+        elapsed = self.elapsed
+        with self._lock:
+            return {'started'       : self.started,
+                    'finished'      : self.finished,
+                    'elapsed'       : elapsed,
+                    'probe_time'    : self.probe_time,
+                    'concurrency'   : self.concurrency,
+                    'totals'        : totals,
+                    'records_per_s' : totals['records'] / elapsed if elapsed else 0,
+                    'bytes_per_s'   : totals['bytes'] / elapsed if elapsed else 0,
+                    'timing'        : {phase: h.summary()
+                                       for phase, h in self.histograms.items()},
+                    'pages'         : [p.as_dict() for p in self.pages]}
+
+
+    def write(self, file):
+        '''Writes the metrics to 'file': in Prometheus text format if the name
+        ends in ".prom", otherwise as JSON.'''
+        if file.endswith('.prom'):
+            self.write_prometheus(file)
+        else:
+            self.write_json(file)
+
+
+    def write_json(self, file):
+        if __debug__: log('writing JSON metrics to {}', file)
+        with open(file, 'w') as f:
+            json.dump(self.summary(), f, indent = 2)
+            f.write('\n')
+
+
+    def write_prometheus(self, file):
+        '''Writes the metrics in the Prometheus text exposition format.  The
+        file is written under a temporary name and then renamed, as the
+        node_exporter textfile collector expects.'''
+        if __debug__: log('writing Prometheus metrics to {}', file)
+        totals = self.totals()
+        lines = []
+
+        def metric(name, kind, help, value, labels = ''):
+            lines.append('# HELP martian_{} {}'.format(name, help))
+            lines.append('# TYPE martian_{} {}'.format(name, kind))
+            lines.append('martian_{}{} {}'.format(name, labels, value))
+
+        # These describe one run rather than counting up over time, so they
+        # are gauges, and Prometheus reserves the suffix "_total" for counters.
+        metric('last_run_pages', 'gauge', 'Pages fetched in the last run.', totals['pages'])
+        metric('last_run_records', 'gauge', 'Records fetched in the last run.',
+               totals['records'])
+        metric('last_run_bytes', 'gauge', 'Bytes fetched in the last run.', totals['bytes'])
+        metric('last_run_retries', 'gauge', 'Page retries in the last run.',
+               totals['retries'])
+        metric('last_run_backoff_seconds', 'gauge', 'Time spent backing off in the last run.',
+               totals['backoff'])
+        metric('probe_seconds', 'gauge', 'Duration of the record count probe.', self.probe_time)
+        metric('run_seconds', 'gauge', 'Duration of the last run.', self.elapsed)
+        metric('last_run_timestamp_seconds', 'gauge', 'Time the last run finished.',
+               self.finished or time.time())
+
+        lines.append('# HELP martian_page_phase_seconds Per-page transfer phase durations.')
+        lines.append('# TYPE martian_page_phase_seconds histogram')
+        with self._lock:
+            for phase, histogram in self.histograms.items():
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('martian_page_phase_seconds_bucket{{phase="{}",le="{}"}} {}'
+                                 .format(phase, le, count))
+                lines.append('martian_page_phase_seconds_sum{{phase="{}"}} {}'
+                             .format(phase, histogram.sum))
+                lines.append('martian_page_phase_seconds_count{{phase="{}"}} {}'
+                             .format(phase, histogram.count))
+
+        tmp = file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, file)
+
+
+class DownloadResult(object):
+    '''Value returned by Tind.download(): how many records were written,
+    where they were written, the RunMetrics for the run, and the pages
+    that could not be downloaded (a list of failures.Page objects).'''
+
+    def __init__(self, written = 0, output = None, metrics = None):
+        self.written = written
+        self.output  = output
+        self.metrics = metrics or RunMetrics()
+        self.failed  = []
+
+
+    def __int__(self):
+        return self.written
+
+
+    def __repr__(self):
+        return '<DownloadResult {} records to {}>'.format(self.written, self.output)
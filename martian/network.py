@@ -14,21 +14,13 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-import datetime
-import http.client
-from   http.client import responses as http_responses
-from   os import path
-import requests
-from   requests.packages.urllib3.exceptions import InsecureRequestWarning
 from   time import sleep
-import shutil
-import ssl
-import urllib
-from   urllib import request
-from   urllib.parse import urlsplit
-import urllib3
 import warnings
 
+# Note: requests, urllib3 and urllib.request are imported inside the functions
+# that use them.  They take a noticeable time to load, and are not needed at
+# all for some of Martian's modes of operation (e.g., printing the version).
+
 if __debug__:
     from sidetrack import log, logr
 
@@ -49,12 +41,16 @@ _MAX_RETRIES = 5
 '''Maximum number of times we back off and try again.  This also affects the
 maximum wait time that will be reached after repeated retries.'''
 
+_MAX_RETRY_AFTER = 300
+'''Upper limit (in seconds) on how long we will honor a server's Retry-After.'''
+
 
 # Main functions.
 # .............................................................................
 
 def network_available():
     '''Return True if it appears we have a network connection, False if not.'''
+    import urllib.request
     r = None
     try:
         r = urllib.request.urlopen("http://www.google.com")
@@ -72,6 +68,9 @@ def timed_request(get_or_post, url, session = None, timeout = 20, **kwargs):
     "Timeout" is a timeout (in seconds) on the network requests get or post.
     Other keyword arguments are passed to the network call.
     '''
+    import requests
+    from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
     failures = 0
     retries = 0
     error = None
@@ -126,6 +125,9 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
     If keyword 'polling' is True, certain statuses like 404 are ignored and
     the response is returned; otherwise, they are considered errors.
     '''
+    import requests
+    import urllib3
+
     def addurl(text):
         return (text + ' for {}').format(url)
 
@@ -146,7 +148,7 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
             else:
                 raise NetworkFailure(addurl('Lost network connection with server'))
         elif (isinstance(arg0, urllib3.exceptions.ProtocolError)
-              and arg0.args and isinstance(args0.args[1], ConnectionResetError)):
+              and len(arg0.args) > 1 and isinstance(arg0.args[1], ConnectionResetError)):
             if __debug__: log('net() got ConnectionResetError; will recurse')
             sleep(1)                    # Sleep a short time and try again.
             return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
@@ -178,9 +180,11 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
         error = ServiceFailure(addurl('Server rejected the request'))
     elif code == 429:
         if recursing < _MAX_RECURSIVE_CALLS:
-            pause = 5 * (recursing + 1)   # +1 b/c we start with recursing = 0.
+            # Honor the server's Retry-After value if it gave one; otherwise,
+            # pause for 5 s, then 10 s, then 15 s, etc.
+            pause = retry_after(req) or 5 * (recursing + 1)
             if __debug__: log('rate limit hit -- sleeping {}', pause)
-            sleep(pause)                  # 5 s, then 10 s, then 15 s, etc.
+            sleep(pause)
             return net(get_or_post, url, session, polling, recursing + 1, **kwargs)
         error = RateLimitExceeded('Server blocking further requests due to rate limits')
     elif code == 503:
@@ -192,6 +196,18 @@ def net(get_or_post, url, session = None, polling = False, recursing = 0, **kwar
     return (req, error)
 
 
+def retry_after(response):
+    '''Returns the number of seconds indicated by the Retry-After header in
+    the given 'response', or None if there is no such header or it is not a
+    plain number of seconds.  (HTTP dates are allowed by the spec, but TIND
+    and most servers use delay-seconds.)
+    '''
+    value = response.headers.get('Retry-After') if response is not None else None
+    if value and value.strip().isdigit():
+        return min(int(value.strip()), _MAX_RETRY_AFTER)
+    return None
+
+
 def unwrapped_urllib3_exception(ex):
     if hasattr(ex, 'args') and isinstance(ex.args, tuple):
         return unwrapped_urllib3_exception(ex.args[0])
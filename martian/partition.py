@@ -0,0 +1,256 @@
+'''
+partition.py: split one TIND search into parts that can be harvested in parallel
+
+Paging through a large result set with TIND's "jrec" offsets gets slower the
+deeper the offset, and a single search can only be fetched one page at a
+time.  To get around both problems, a search can be split into disjoint
+sub-searches by ranges of a numeric field (by default, the record id), e.g.,
+"(original search) and recid:1->25000".  Each sub-search starts at offset 1,
+and the sub-searches can be fetched in parallel.
+
+The ranges are chosen using TIND's record counts: the range of values is
+bisected until every part holds no more than a target number of records.
+If the range of the field does not hold all of the records found by the
+whole search (e.g., because some records lack a value for the field), plan()
+returns None, and the caller should fall back to an ordinary download.
+
+A search in more than one collection can also be split by collection: each
+collection is then harvested as a separate stream (see collection_parts()).
+Since a record can be in more than one collection, the results of these
+parts are merged with merge_unique(), which drops records whose 001 value
+has already been written.
+
+Parts are handed out to worker threads by a WorkQueues object.  Each worker
+has its own queue; a worker whose queue is empty steals the last part from
+the longest queue of another worker.  The results of the parts are written
+to temporary files and concatenated in order at the end.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+from   datetime import date
+import os
+import shutil
+from   threading import Lock
+import urllib.parse
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.changes import record_id, records_in
+from martian.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_FIELD_RANGES = {
+    'recid' : (1, None),
+    'year'  : (1000, None),
+}
+'''Fields that searches can be partitioned on, with the lowest value to
+consider and the highest (None to find it from the data).'''
+
+_PARTS_PER_WORKER = 4
+'''Target number of parts per worker, so that the load can be balanced.'''
+
+_MAX_VALUE = 10**10
+'''Upper limit when searching for the largest value of a field.'''
+
+
+# Exported functions.
+# .............................................................................
+
+def plan(count, query, total, workers, page_size, field = 'recid'):
+    '''Returns a list of Part objects that together cover the 'total' records
+    found by the search 'query' (in URL-quoted form), or None if a complete
+    partition could not be found.  'count' must be a function that takes a
+    URL-quoted search and returns the number of records it finds.'''
+    if field not in _FIELD_RANGES:
+        raise ValueError('cannot partition on field "{}"'.format(field))
+    size = max(page_size, -(-total // (workers * _PARTS_PER_WORKER)))
+    (low, high) = _FIELD_RANGES[field]
+    if __debug__: log('partitioning {} records on {} into parts of <= {}',
+                      total, field, size)
+
+    def count_in(lo, hi):
+        return count(ranged_query(query, field, lo, hi))
+
+    if high is None and field == 'year':
+        high = date.today().year + 1
+    elif high is None:
+        # Find an upper bound by widening the range until it covers all.
+        high = max(1000, total)
+        while count_in(low, high) < total:
+            high *= 4
+            if high > _MAX_VALUE:
+                if __debug__: log('could not find upper bound of {}', field)
+                return None
+    if count_in(low, high) != total:
+        if __debug__: log('{} does not cover all the records', field)
+        return None
+
+    parts = []
+    pending = [(low, high, total)]
+    while pending:
+        (lo, hi, n) = pending.pop()
+        if n <= 0:
+            continue
+        if n <= size or lo == hi:
+            parts.append(Part(field, lo, hi, n))
+            continue
+        mid = (lo + hi) // 2
+        left = count_in(lo, mid)
+        pending.append((mid + 1, hi, n - left))
+        pending.append((lo, mid, left))
+    parts.sort(key = lambda part: part.low)
+    if __debug__: log('search partitioned into {} parts', len(parts))
+    return parts
+
+
+def collection_parts(count, collections):
+    '''Returns a list of CollectionPart objects, one for each of the
+    'collections' that holds any records.  'count' must be a function that
+    takes a list of collections and returns the number of records the search
+    finds in them.'''
+    parts = []
+    for collection in collections:
+        number = count([collection])
+        if __debug__: log('collection {} has {} records', collection, number)
+        if number > 0:
+            parts.append(CollectionPart(collection, number))
+    return parts
+
+
+def ranged_query(query, field, low, high):
+    '''Returns the URL-quoted search 'query' restricted to values of 'field'
+    from 'low' to 'high' inclusive.'''
+    clause = urllib.parse.quote('{}:{}->{}'.format(field, low, high))
+    if not query:
+        return clause
+    return urllib.parse.quote('(') + query + urllib.parse.quote(') and ') + clause
+
+
+def concatenate(parts, out):
+    '''Copies the output files of 'parts', in order, to the open binary file
+    'out', deleting them as it goes.'''
+    for part in parts:
+        if part.file and os.path.exists(part.file):
+            with open(part.file, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part.file)
+
+
+def merge_unique(parts, out):
+    '''Copies the records in the output files of 'parts', in order, to the
+    open binary file 'out', leaving out records whose 001 value has already
+    been copied, and deletes the files.  Returns the number of records
+    copied.'''
+    seen = set()
+    written = 0
+    for part in parts:
+        if not (part.file and os.path.exists(part.file)):
+            continue
+        for record in records_in(part.file):
+            id = record_id(record)
+            if id is not None:
+                if id in seen:
+                    continue
+                seen.add(id)
+            out.write(record)
+            out.write(b'\n')
+            written += 1
+        os.remove(part.file)
+    if __debug__: log('merged {} unique records from {} parts', written, len(parts))
+    return written
+
+
+def remove_files(parts):
+    for part in parts:
+        if part.file and os.path.exists(part.file):
+            os.remove(part.file)
+
+
+# Exported classes.
+# .............................................................................
+
+class Part(object):
+    '''One part of a partitioned search: records whose 'field' value lies
+    from 'low' to 'high' (inclusive), of which there are 'count'.'''
+
+    __slots__ = ('field', 'low', 'high', 'count', 'file', 'collections')
+
+    def __init__(self, field, low, high, count):
+        self.field = field
+        self.low   = low
+        self.high  = high
+        self.count = count
+        self.file  = None
+        self.collections = None         # Use the collections of the search.
+
+
+    def query(self, query):
+        return ranged_query(query, self.field, self.low, self.high)
+
+
+    def __repr__(self):
+        return '<Part {}:{}->{} ({} records)>'.format(self.field, self.low,
+                                                     self.high, self.count)
+
+
+class CollectionPart(object):
+    '''One part of a search split by collection: the records of the search
+    in 'collection', of which there are 'count'.'''
+
+    __slots__ = ('collections', 'count', 'file')
+
+    def __init__(self, collection, count):
+        self.collections = [collection]
+        self.count = count
+        self.file  = None
+
+
+    def query(self, query):
+        return query
+
+
+    def __repr__(self):
+        return '<CollectionPart {} ({} records)>'.format(self.collections[0],
+                                                         self.count)
+
+
+class WorkQueues(object):
+    '''Distributes parts to 'workers' workers, with work stealing.'''
+
+    def __init__(self, parts, workers):
+        self._queues = [deque() for _ in range(workers)]
+        self._lock   = Lock()
+        # Deal the largest parts out first, so the queues start out even.
+        for index, part in enumerate(sorted(parts, key = lambda p: -p.count)):
+            self._queues[index % workers].append(part)
+
+
+    def next(self, worker):
+        '''Returns the next part for worker number 'worker', or None if there
+        is no work left.'''
+        with self._lock:
+            own = self._queues[worker]
+            if own:
+                return own.popleft()
+            victim = max(self._queues, key = len)
+            if victim:
+                part = victim.pop()
+                if __debug__: log('worker {} stole {}', worker, part)
+                return part
+            return None
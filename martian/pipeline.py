@@ -0,0 +1,239 @@
+'''
+pipeline.py: process and write pages of records while downloading
+
+The download loop in tind.py only fetches pages.  Each page it gets is handed
+to a PagePipeline, which converts it (extracting the records from the MARC XML
+collection wrapper, checking that they are well-formed, and applying any
+additional conversion stages) and writes the result to the output, which is
+normally a BackgroundWriter (see writer.py), so that disk writes don't hold
+up conversion either.
+
+Conversion runs either on the pipeline's writer thread (the default) or, if
+given a number of workers, in a pool of separate processes so that it can use
+more than one CPU core.  Either way it overlaps with the network transfers.
+Pages are written in the order in which they were submitted, no matter in
+which order the workers finish them.  The number of pages in the pipeline is
+bounded, so that if conversion or writing falls behind, submit() blocks the
+downloader instead of letting pages pile up in memory.
+
+Conversion stages must be functions defined at the top level of a module,
+so that they can be sent to worker processes.  A stage takes the bytes of
+the records of one page and returns new bytes.
+
+A page that turns out not to be well-formed normally stops the pipeline,
+but if the pipeline is given a function 'on_corrupt', that function is
+called instead with the tag given to submit() for the page and the
+exception, and the pipeline carries on; this is how damaged pages are sent
+to be retried (see failures.py).
+
+A pipeline can also be given an observer, a function that is called on the
+writer thread with the converted records of each page and the list of
+record digests computed for them by digest_records() (see changes.py).  The
+digests are computed along with the conversion, so they also use the
+worker processes when there are any.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   concurrent.futures import Future
+from   queue import Queue
+from   threading import Thread
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.changes import digest_records
+from martian.exceptions import *
+from martian.tracing import span
+
+
+# Constants.
+# .............................................................................
+
+_COLLECTION_START = b'<collection xmlns="http://www.loc.gov/MARC21/slim">'
+_COLLECTION_END   = b'</collection>'
+
+_MIN_DEPTH = 4
+'''Minimum number of pages allowed in the pipeline at one time.'''
+
+_END = object()
+'''Marker put on the queue to tell the writer thread to finish.'''
+
+
+# Conversion functions.
+# .............................................................................
+# These run in worker processes when the pipeline has workers.
+
+def convert_page(data, stages = ()):
+    '''Returns the records in 'data' (one page of MARC XML from TIND, as
+    bytes) without the surrounding collection element, after checking that
+    they are well-formed and passing them through each of 'stages'.'''
+    start = data.find(_COLLECTION_START)
+    end = data.rfind(_COLLECTION_END)
+    if start < 0 or end < start:
+        raise CorruptData('page does not contain a MARC XML collection')
+    body = data[start + len(_COLLECTION_START) : end]
+    check_well_formed(body)
+    for stage in stages:
+        body = stage(body)
+    return body
+
+
+def convert_and_digest(data, stages = ()):
+    '''Returns a tuple (body, digests), where 'body' is the result of
+    convert_page() and 'digests' is the result of digest_records(body).'''
+    body = convert_page(data, stages)
+    return (body, digest_records(body))
+
+
+def check_well_formed(body):
+    '''Raises CorruptData if 'body' is not a well-formed sequence of records.'''
+    from lxml import etree
+    try:
+        etree.fromstring(_COLLECTION_START + body + _COLLECTION_END)
+    except etree.XMLSyntaxError as ex:
+        raise CorruptData('page of records is not well-formed XML: {}'.format(ex))
+
+
+# Main class.
+# .............................................................................
+
+class PagePipeline(object):
+    '''Converts pages of records and writes them, in order, to the open
+    binary file 'out'.  If 'workers' is greater than 0, conversion is done
+    in that many worker processes; otherwise it is done on the writer
+    thread.  At most 'depth' pages may be waiting at one time.  If given,
+    'observer' is called with the records and record digests of each page
+    after they are written.  If given, 'on_corrupt' is called with the tag
+    of each page that is not well-formed, which is then skipped.  The
+    attribute 'records' counts the records written.'''
+
+    def __init__(self, out, stages = (), workers = 0, depth = None, observer = None,
+                 on_corrupt = None):
+        self._out      = out
+        self._stages   = tuple(stages)
+        self._workers  = workers
+        self._observer = observer
+        self._convert  = convert_and_digest if observer else convert_page
+        self._corrupt  = on_corrupt
+        self.records   = 0
+        self._pending  = Queue(maxsize = depth or max(_MIN_DEPTH, 2 * workers))
+        self._executor = None
+        self._writer   = None
+        self._error    = None
+
+
+    def start(self):
+        if self._workers > 0:
+            from concurrent.futures import ProcessPoolExecutor
+            if __debug__: log('starting {} page conversion processes', self._workers)
+            self._executor = ProcessPoolExecutor(max_workers = self._workers)
+        self._writer = Thread(target = self._write_loop, name = 'PageWriter',
+                              daemon = True)
+        self._writer.start()
+        return self
+
+
+    def submit(self, data, tag = None):
+        '''Adds a page to the pipeline.  Blocks if the pipeline is full.
+        'tag' identifies the page to the 'on_corrupt' function.  Raises the
+        exception that stopped the pipeline, if any.'''
+        if self._error:
+            raise self._error
+        with span('submit'):
+            if self._executor:
+                self._pending.put((tag, self._executor.submit(self._convert, data,
+                                                              self._stages)))
+            else:
+                self._pending.put((tag, data))
+
+
+    def join(self):
+        '''Waits until every page submitted so far has been written (or
+        passed to 'on_corrupt').'''
+        self._pending.join()
+
+
+    def close(self):
+        '''Waits until all submitted pages have been written, then shuts
+        down.  Raises the exception that stopped the pipeline, if any.'''
+        self._shutdown()
+        if self._error:
+            raise self._error
+
+
+    def abort(self):
+        '''Shuts down without raising exceptions; pages still waiting to be
+        converted are dropped.'''
+        if self._executor:
+            self._executor.shutdown(wait = False, cancel_futures = True)
+        self._shutdown()
+
+
+    def _shutdown(self):
+        if self._writer:
+            self._pending.put(_END)
+            self._writer.join()
+            self._writer = None
+        if self._executor:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            try:
+                if item is _END:
+                    return
+                self._write(*item)
+            finally:
+                self._pending.task_done()
+
+
+    def _write(self, tag, item):
+        if self._error:
+            # Keep draining the queue so that submit() doesn't block.
+            return
+        try:
+            if isinstance(item, Future):
+                with span('strip-wait'):
+                    result = item.result()
+            else:
+                with span('strip'):
+                    result = self._convert(item, self._stages)
+        except CorruptData as ex:
+            if not self._corrupt:
+                if __debug__: log('page pipeline stopped by exception: {}', str(ex))
+                self._error = ex
+                return
+            if __debug__: log('skipping corrupt page: {}', str(ex))
+            try:
+                self._corrupt(tag, ex)
+            except Exception as ex:
+                self._error = ex
+            return
+        except Exception as ex:
+            if __debug__: log('page pipeline stopped by exception: {}', str(ex))
+            self._error = ex
+            return
+        try:
+            body = result[0] if self._observer else result
+            with span('write', bytes = len(body)):
+                self._out.write(body)
+                self.records += body.count(b'</record>')
+                if self._observer:
+                    self._observer(*result)
+        except Exception as ex:
+            if __debug__: log('page pipeline stopped by exception: {}', str(ex))
+            self._error = ex
@@ -0,0 +1,247 @@
+'''
+planner.py: estimate the cost of a harvest without performing it
+
+Planning a harvest means asking TIND how many records a search will
+produce, timing the download of one sample page, and looking up the
+throughput of earlier harvests from the same host in a history database.
+From these, plan_download() estimates the number of requests, the number of
+bytes and the time the full harvest will take, and recommends how many
+parts to download at once (the -p option).
+
+The history database is an SQLite file ("history.db") in Martian's data
+directory.  Every completed download adds a row to it, giving the host, the
+backend, the page size, the number of parts downloaded at once, and the
+records, bytes, pages and time of the run.  When several levels of
+concurrency have been used with the same host, the recommendation is the
+lowest one that came within 10% of the best throughput seen, since beyond
+that point more connections mostly add load on the server.  Without any
+history, the estimates are based on the sample page alone, which does not
+account for the way the search pages slow down at deep offsets.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   contextlib import closing
+from   os import path
+import time
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+_HISTORY_FILE = 'history.db'
+'''Name of the history database file in Martian's data directory.'''
+
+_GOOD_ENOUGH = 0.9
+'''Fraction of the best throughput that a recommended concurrency must reach.'''
+
+_MAX_SUGGESTED = 8
+'''Largest concurrency recommended when there is no history to go on.'''
+
+_PAGES_PER_PART = 10
+'''Smallest number of pages per part worth splitting a search for.'''
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS runs (
+    finished    REAL,
+    host        TEXT,
+    backend     TEXT,
+    page_size   INTEGER,
+    concurrency INTEGER,
+    records     INTEGER,
+    bytes       INTEGER,
+    pages       INTEGER,
+    elapsed     REAL
+)'''
+
+
+# Exported functions.
+# .............................................................................
+
+def plan_download(backend, pool, search, history, concurrency = 1):
+    '''Returns a Plan for downloading all the results of 'search' with the
+    backend object 'backend', using connections from the TransportPool
+    'pool'.  'history' is a History object.  'concurrency' is the number of
+    parts the user intends to download at once.'''
+    from martian.tind import parse_search
+    (query, collections) = parse_search(search)
+
+    probe_start = time.perf_counter()
+    num_records = backend.count(query, collections, pool.session)
+    probe_time = time.perf_counter() - probe_start
+    plan = Plan(backend, num_records, probe_time, concurrency)
+    if num_records == 0:
+        return plan
+
+    if __debug__: log('timing a sample page from {}', backend.host_name)
+    transport = pool.acquire()
+    try:
+        (url, headers) = backend.page(query, collections, 1)
+        sample_start = time.perf_counter()
+        response = transport.get(url, headers)
+        sample_time = time.perf_counter() - sample_start
+    finally:
+        pool.release(transport)
+    plan.sample_time = response.timing.total or sample_time
+    plan.sample_bytes = len(response.body)
+    plan.sample_records = response.body.count(b'</record>')
+    plan.history = history.throughput(backend.host_name, backend.name, backend.page_size)
+    plan.estimate()
+    return plan
+
+
+def whole_run(start, total, result):
+    '''Returns True if a download that began at record 'start' and asked for
+    'total' records (negative for all), with the DownloadResult 'result',
+    got all the results of its search.  Only the metrics of such runs are
+    worth adding to the History, since the planner's estimates are for
+    whole harvests.'''
+    return start == 1 and total < 0 and not result.failed
+
+
+# Exported classes.
+# .............................................................................
+
+class Plan(object):
+    '''Estimates for one harvest.  Call estimate() after setting the sample
+    values and the history.'''
+
+    def __init__(self, backend, records, probe_time, concurrency):
+        self.host           = backend.host_name
+        self.backend        = backend.name
+        self.page_size      = backend.page_size
+        self.records        = records
+        self.probe_time     = probe_time
+        self.concurrency    = max(1, concurrency)
+        self.sample_time    = 0
+        self.sample_bytes   = 0
+        self.sample_records = 0
+        self.history        = {}
+        self.pages          = 0
+        self.requests       = 1
+        self.bytes          = 0
+        self.seconds        = 0
+        self.recommended    = 1
+        self.basis          = 'nothing'
+
+
+    def estimate(self):
+        self.pages = -(-self.records // self.page_size)
+        # Partitioning (see partition.py) aims for 4 parts per worker and
+        # takes roughly two count probes to find each one.
+        extra = 2 * 4 * self.concurrency if self.concurrency > 1 else 0
+        self.requests = 1 + self.pages + extra
+        if self.sample_records:
+            self.bytes = int(self.records * self.sample_bytes / self.sample_records)
+        self.recommended = self._recommend()
+        rate = self._rate_for(self.concurrency)
+        if rate:
+            self.seconds = self.records / rate
+            self.basis = 'history of {} runs'.format(sum(h['runs'] for h in
+                                                         self.history.values()))
+        else:
+            self.seconds = self.probe_time + self.pages * self.sample_time / self.concurrency
+            self.basis = 'one sample page (no history for this host)'
+
+
+    def summary(self):
+        '''Returns a list of lines describing the plan.'''
+        from humanize import intcomma, naturalsize, naturaldelta
+        from datetime import timedelta
+        if not self.records:
+            return ['This search produces no records']
+        return ['Records:        {}'.format(intcomma(self.records)),
+                'Requests:       about {} ({} pages of {})'.format(
+                    intcomma(self.requests), intcomma(self.pages), self.page_size),
+                'Data:           about {}'.format(naturalsize(self.bytes)),
+                'Duration:       about {} with {} part(s) at once'.format(
+                    naturaldelta(timedelta(seconds = self.seconds)), self.concurrency),
+                'Recommended:    -p {}'.format(self.recommended),
+                'Estimates from: {}'.format(self.basis)]
+
+
+    def _rate_for(self, concurrency):
+        '''Returns the records/second seen at the concurrency in the history
+        closest to 'concurrency', or None.'''
+        if not self.history:
+            return None
+        closest = min(self.history, key = lambda c: (abs(c - concurrency), c))
+        return self.history[closest]['records_per_s']
+
+
+    def _recommend(self):
+        if len(self.history) > 1:
+            best = max(h['records_per_s'] for h in self.history.values())
+            return min(c for c, h in self.history.items()
+                       if h['records_per_s'] >= _GOOD_ENOUGH * best)
+        # Without history, split into parts that are each worth the overhead.
+        return max(1, min(_MAX_SUGGESTED, self.pages // _PAGES_PER_PART))
+
+
+class History(object):
+    '''The database of past runs, in the SQLite file 'file' (by default,
+    history.db in Martian's data directory).'''
+
+    def __init__(self, file = None):
+        if not file:
+            from martian.files import user_data_path
+            file = path.join(user_data_path(), _HISTORY_FILE)
+        self.file = file
+
+
+    def add(self, backend, metrics):
+        '''Adds a row for a completed download with the backend object
+        'backend' and the RunMetrics 'metrics'.  Problems with the database
+        are logged but not raised, so that they never cost a harvest.'''
+        totals = metrics.totals()
+        if not totals['records']:
+            return
+        row = (metrics.finished or time.time(), backend.host_name, backend.name,
+               backend.page_size, metrics.concurrency, totals['records'],
+               totals['bytes'], totals['pages'], metrics.elapsed)
+        try:
+            with closing(self._connect()) as db:
+                with db:
+                    db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        except Exception as ex:
+            if __debug__: log('unable to record run in {}: {}', self.file, str(ex))
+
+
+    def throughput(self, host, backend, page_size):
+        '''Returns a dict mapping each concurrency used with 'host',
+        'backend' and 'page_size' to a dict with the number of runs and the
+        average records/second, bytes/second and seconds/page.'''
+        if not path.exists(self.file):
+            return {}
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT concurrency, COUNT(*), SUM(records), SUM(bytes),'
+                              ' SUM(pages), SUM(elapsed) FROM runs'
+                              ' WHERE host = ? AND backend = ? AND page_size = ?'
+                              ' GROUP BY concurrency', (host, backend, page_size))
+            return {c: {'runs'             : runs,
+                        'records_per_s'    : records / elapsed,
+                        'bytes_per_s'      : nbytes / elapsed,
+                        'seconds_per_page' : elapsed / pages if pages else 0}
+                    for (c, runs, records, nbytes, pages, elapsed) in rows
+                    if elapsed > 0}
+
+
+    def _connect(self):
+        import sqlite3
+        db = sqlite3.connect(self.file, timeout = 10)
+        db.execute(_SCHEMA)
+        return db
@@ -0,0 +1,254 @@
+'''
+profiling.py: optional CPU and memory profiling of Martian's threads
+
+When profiling is turned on (with enable()), functions wrapped with
+profiled() run under Python's deterministic profiler (cProfile), and at the
+same time a sampling thread periodically records the stack of every profiled
+thread.  The sampling thread runs only while profiled functions are running,
+and is stopped when the last of them returns.  When a profiled function
+returns, the following files are written to the profiling directory, named
+after the thread:
+
+  NAME.pstats   -- cProfile data, for pstats, snakeviz, flameprof, etc.
+  NAME.txt      -- the top functions by cumulative time, as plain text
+  NAME.folded   -- sampled stacks in "folded" format, one line per distinct
+                   stack, for flamegraph.pl, speedscope, inferno, etc.
+
+From Python 3.12 on, cProfile is built on sys.monitoring, which allows only
+one profiler in the process at a time.  A profiled function that starts
+while another one (or some other profiling tool) is active is then only
+sampled, and gets no .pstats or .txt file.
+
+Memory allocation is traced with tracemalloc from the time enable() is
+called, and a report of the top allocation sites is written to the file
+"allocations.txt" when the program exits.
+
+When profiling is not enabled, profiled() returns the function unchanged,
+so there is no cost.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import atexit
+from   collections import Counter
+import os
+from   os import path
+import sys
+from   threading import Lock, Thread, Event, get_ident
+
+# Note: cProfile, pstats and tracemalloc are imported only when profiling is
+# actually turned on, to avoid the cost when it is not.
+
+if __debug__:
+    from sidetrack import log, logr
+
+
+# Constants.
+# .............................................................................
+
+_SAMPLE_INTERVAL = 0.005
+'''Seconds between stack samples taken by the sampling profiler.'''
+
+_TOP_N = 30
+'''Number of entries reported in the text summaries.'''
+
+_TRACEMALLOC_FRAMES = 10
+'''Number of stack frames tracemalloc records per allocation.'''
+
+
+# Module state.
+# .............................................................................
+
+_directory = None
+_sampler   = None
+_lock      = Lock()
+
+
+# Exported functions.
+# .............................................................................
+
+def enable(directory):
+    '''Turns on profiling, with results to be written into 'directory'.'''
+    import tracemalloc
+    global _directory
+    _directory = path.abspath(directory)
+    os.makedirs(_directory, exist_ok = True)
+    if __debug__: log('profiling enabled; output will go to {}', _directory)
+    tracemalloc.start(_TRACEMALLOC_FRAMES)
+    atexit.register(write_allocation_report)
+
+
+def enabled():
+    '''Returns True if profiling has been turned on.'''
+    return _directory is not None
+
+
+def profiled(name, func):
+    '''Returns a function that calls 'func' under the profilers and writes
+    the results to files named after 'name' when 'func' returns or raises
+    an exception.  If profiling is not enabled, returns 'func' itself.'''
+    if not enabled():
+        return func
+
+    import cProfile
+
+    def wrapper(*args, **kwargs):
+        _start_sampling(get_ident(), name)
+        profiler = _start_profiler(cProfile, name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if profiler:
+                profiler.disable()
+                _write_profile(name, profiler)
+            _write_folded(name, _stop_sampling(get_ident()))
+
+    return wrapper
+
+
+def write_allocation_report(top = _TOP_N):
+    '''Writes the top 'top' memory allocation sites to "allocations.txt".'''
+    import tracemalloc
+    if not enabled() or not tracemalloc.is_tracing():
+        return
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ])
+    (current, peak) = tracemalloc.get_traced_memory()
+    file = path.join(_directory, 'allocations.txt')
+    if __debug__: log('writing allocation report to {}', file)
+    with open(file, 'w') as f:
+        f.write('Traced memory: current {:,} bytes, peak {:,} bytes\n\n'
+                .format(current, peak))
+        f.write('Top {} allocation sites by size:\n\n'.format(top))
+        for stat in snapshot.statistics('lineno')[:top]:
+            f.write('{}\n'.format(stat))
+        f.write('\nTracebacks of the top {} allocation sites:\n'.format(min(top, 5)))
+        for stat in snapshot.statistics('traceback')[:5]:
+            f.write('\n{:,} bytes in {:,} blocks\n'.format(stat.size, stat.count))
+            for line in stat.traceback.format():
+                f.write(line + '\n')
+    tracemalloc.stop()
+
+
+# Internal implementation.
+# .............................................................................
+
+def _start_sampling(ident, name):
+    '''Adds the thread 'ident' to the threads sampled, starting the sampling
+    thread if it is not running.'''
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = _StackSampler()
+            _sampler.start()
+        _sampler.add(ident, name)
+
+
+def _stop_sampling(ident):
+    '''Removes the thread 'ident' from the threads sampled and returns its
+    stacks.  Stops the sampling thread if no threads are left.'''
+    global _sampler
+    with _lock:
+        stacks = _sampler.remove(ident)
+        if _sampler.idle():
+            _sampler.stop()
+            _sampler = None
+    return stacks
+
+
+def _start_profiler(cProfile, name):
+    '''Returns a cProfile.Profile enabled for the calling thread, or None if
+    it can't be enabled because another profiler is active.'''
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as ex:
+        if __debug__: log('{} will only be sampled: {}', name, str(ex))
+        return None
+    return profiler
+
+
+def _write_profile(name, profiler):
+    import io
+    import pstats
+    base = path.join(_directory, name)
+    if __debug__: log('writing profile data for {} to {}.pstats', name, base)
+    profiler.dump_stats(base + '.pstats')
+    text = io.StringIO()
+    stats = pstats.Stats(profiler, stream = text)
+    stats.sort_stats('cumulative').print_stats(_TOP_N)
+    with open(base + '.txt', 'w') as f:
+        f.write(text.getvalue())
+
+
+def _write_folded(name, stacks):
+    with open(path.join(_directory, name + '.folded'), 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+class _StackSampler(Thread):
+    '''Daemon thread that periodically records the stacks of the threads
+    registered with add(), as folded stack strings with counts.'''
+
+    def __init__(self):
+        super().__init__(name = 'StackSampler', daemon = True)
+        self._threads = {}
+        self._stacks  = {}
+        self._lock    = Lock()
+        self._done    = Event()
+
+
+    def add(self, ident, name):
+        with self._lock:
+            self._threads[ident] = name
+            self._stacks[ident] = Counter()
+
+
+    def remove(self, ident):
+        with self._lock:
+            self._threads.pop(ident, None)
+            return self._stacks.pop(ident, Counter())
+
+
+    def idle(self):
+        with self._lock:
+            return not self._threads
+
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+    def run(self):
+        while not self._done.wait(_SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, counter in self._stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counter[_folded(frame)] += 1
+
+
+def _folded(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, path.basename(code.co_filename),
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
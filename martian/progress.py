@@ -14,12 +14,12 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   collections import deque
+from   datetime import timedelta
 from   halo import Halo
-from   pubsub import pub
 import sys
+from   threading import Lock
 import time
-import wx
-import wx.lib.dialogs
 
 try:
     from termcolor import colored
@@ -36,6 +36,21 @@ import martian
 from martian.exceptions import *
 from martian.messages import color, msg
 
+
+# Constants.
+# .............................................................................
+
+_REFRESH_INTERVAL = 0.25
+'''Minimum time (in seconds) between redraws of the live progress line.'''
+
+_SUMMARY_INTERVAL = 30
+'''Time (in seconds) between progress summary lines when not using a
+terminal, e.g., when the output is going to a log file.'''
+
+_MAX_PENDING_MESSAGES = 500
+'''Maximum number of messages a ProgressChannel holds between polls by the
+GUI.  If more arrive, the oldest are dropped.'''
+
 
 # Exported classes.
 # .............................................................................
@@ -51,7 +66,15 @@ from martian.messages import color, msg
 class ProgressIndicatorBase():
 
     def __init__(self):
-        pass
+        self._meter = ProgressMeter()
+
+
+    def progress(self, done, total, nbytes = 0):
+        '''Reports that 'done' records out of 'total' have been received so
+        far, amounting to 'nbytes' bytes.  This is called for every page of
+        records, so implementations must be cheap; they should record the
+        values and only redraw occasionally.'''
+        self._meter.set(done, total, nbytes)
 
 
 class ProgressIndicatorCLI(ProgressIndicatorBase):
@@ -61,12 +84,15 @@ class ProgressIndicatorCLI(ProgressIndicatorBase):
         self._colorize = use_color
         self._spinner = None
         self._current_message = ''
+        # A live, redrawn line only makes sense on a terminal.
+        self._live = use_color and sys.stdout.isatty()
+        self._last_drawn = 0
 
 
     def start(self, message = None):
         if message is None:
             message = ''
-        if self._colorize:
+        if self._live:
             text = color(message, 'info')
             self._spinner = Halo(spinner='bouncingBall', text = text)
             self._spinner.start()
@@ -76,7 +102,7 @@ class ProgressIndicatorCLI(ProgressIndicatorBase):
 
 
     def update(self, message = None):
-        if self._colorize:
+        if self._live:
             self._spinner.succeed(color(self._current_message, 'info', self._colorize))
             self._spinner.stop()
             self.start(message)
@@ -84,8 +110,24 @@ class ProgressIndicatorCLI(ProgressIndicatorBase):
             msg(message)
 
 
+    def progress(self, done, total, nbytes = 0):
+        super().progress(done, total, nbytes)
+        now = time.monotonic()
+        finished = done >= total
+        if self._live:
+            if finished or now - self._last_drawn >= _REFRESH_INTERVAL:
+                # Changing the text of the running spinner is cheap; the
+                # spinner's own thread redraws the line.
+                self._current_message = self._meter.summary()
+                self._spinner.text = color(self._current_message, 'info', self._colorize)
+                self._last_drawn = now
+        elif finished or now - self._last_drawn >= _SUMMARY_INTERVAL:
+            msg(self._meter.summary(), 'info', self._colorize)
+            self._last_drawn = now
+
+
     def stop(self, message = None):
-        if self._colorize:
+        if self._live:
             self._spinner.succeed(color(self._current_message, 'info', self._colorize))
             self._spinner.stop()
             self.start(message)
@@ -96,17 +138,104 @@ class ProgressIndicatorCLI(ProgressIndicatorBase):
 
 
 class ProgressIndicatorGUI(ProgressIndicatorBase):
+    '''Progress indicator for the GUI.  This does not send anything to the
+    GUI per message or per page.  Instead, it puts messages and counts into a
+    ProgressChannel, and the main frame polls the channel on a timer at a
+    fixed rate.  This keeps the cost to the worker thread constant and the
+    GUI responsive no matter how fast the pages arrive.'''
+
+    def __init__(self):
+        # Imported here so that the command-line interface never loads them.
+        import wx
+        from pubsub import pub
+
+        super().__init__()
+        self._channel = ProgressChannel(self._meter)
+        if __debug__: log('sending progress_channel to GUI')
+        wx.CallAfter(pub.sendMessage, "progress_channel", channel = self._channel)
+
 
     def start(self, message = None):
-        if __debug__: log('sending progress_message for start')
-        wx.CallAfter(pub.sendMessage, "progress_message", message = message)
+        self._channel.post(message)
 
 
     def update(self, message = None, count = None):
-        if __debug__: log('sending progress_message for update')
-        wx.CallAfter(pub.sendMessage, "progress_message", message = message)
+        self._channel.post(message)
 
 
     def stop(self, message = None):
-        if __debug__: log('sending progress_message for stop')
-        wx.CallAfter(pub.sendMessage, "progress_message", message = message)
+        self._channel.post(message)
+
+
+
+# Helper classes.
+# .............................................................................
+
+class ProgressMeter():
+    '''Keeps track of records and bytes received, and computes throughput
+    and the estimated time remaining.  Safe to update from one thread and
+    read from another.'''
+
+    def __init__(self):
+        self._lock    = Lock()
+        self._started = None
+        self.done     = 0
+        self.total    = 0
+        self.nbytes   = 0
+
+
+    def set(self, done, total, nbytes = 0):
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            self.done   = done
+            self.total  = total
+            self.nbytes = nbytes
+
+
+    def snapshot(self):
+        '''Returns a tuple (done, total, records/sec, bytes/sec, eta), where
+        'eta' is the estimated number of seconds remaining or None.'''
+        with self._lock:
+            (done, total, nbytes, started) = (self.done, self.total, self.nbytes,
+                                              self._started)
+        elapsed = (time.monotonic() - started) if started else 0
+        rate = done / elapsed if elapsed > 0 else 0
+        byte_rate = nbytes / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate > 0 else None
+        return (done, total, rate, byte_rate, eta)
+
+
+    def summary(self):
+        '''Returns a one-line human-readable summary of the progress.'''
+        from humanize import intcomma, naturalsize
+        (done, total, rate, byte_rate, eta) = self.snapshot()
+        percent = (100 * done // total) if total else 0
+        remaining = str(timedelta(seconds = round(eta))) if eta is not None else '?'
+        return 'Received {} of {} records ({}%), {:.0f} records/s, {}/s, ETA {}'.format(
+            intcomma(done), intcomma(total), percent, rate,
+            naturalsize(byte_rate), remaining)
+
+
+class ProgressChannel():
+    '''Shared state between a worker thread and the GUI.  The worker posts
+    messages and updates the ProgressMeter; the GUI periodically calls
+    drain() to get the messages posted since the last call.'''
+
+    def __init__(self, meter):
+        self.meter     = meter
+        self._messages = deque(maxlen = _MAX_PENDING_MESSAGES)
+        self._lock     = Lock()
+
+
+    def post(self, message):
+        if message is not None:
+            with self._lock:
+                self._messages.append(message)
+
+
+    def drain(self):
+        with self._lock:
+            messages = list(self._messages)
+            self._messages.clear()
+        return messages
@@ -0,0 +1,614 @@
+'''
+service.py: run Martian as a long-lived harvest service with an HTTP API
+
+In service mode, Martian stays running and accepts harvest jobs over a small
+HTTP/JSON API that listens only on the local host.  Jobs run on a bounded
+pool of worker threads and share one TransportPool per TIND instance, so
+that connections to TIND stay warm from one job to the next.  Jobs can also
+be recurring, with a cron-style schedule.  The job queue is saved to a file
+after every change, and jobs that were queued or running when the service
+stopped are queued again when it restarts.
+
+The API is as follows (all bodies are JSON):
+
+  GET    /jobs               list all jobs
+  POST   /jobs               submit a job; the body is an object with fields
+                               "search" (required), "output", "start",
+                               "total", "host" (the URL of the TIND
+                               instance), "backend" ("search" or "api"), and
+                               "schedule" (a cron expression such as
+                               "30 2 * * *"; if given, the job is a
+                               recurring job definition)
+  GET    /jobs/ID            get the status of a job
+  DELETE /jobs/ID            cancel a job (and remove a recurring job)
+  GET    /jobs/ID/output     get the output file of a finished job
+
+Output files are always written in the "outputs" subdirectory of the
+service directory.  "output" is the name of a file there (it may name a
+subdirectory, but can't be an absolute path or contain ".."); if it is not
+given, the job's id is used.  A job whose output file already exists fails
+rather than replacing the file.  The output name of a recurring job may
+contain "{id}" and "{time}", which are replaced for each run; if it doesn't
+contain "{time}", "-{time}" is added before the extension, so that each run
+writes a new file.
+
+A job that finishes with pages that could not be downloaded, even after
+retries, gets the status "incomplete" instead of "done".  The pages are
+listed in a file next to the output, named like it but ending in
+"-failed.jsonl", for the -e option; the job's "failed" field gives their
+number and "failure_log" the file.
+
+The service only accepts POST requests with the header "Content-Type:
+application/json".  Browsers don't send that type in requests from other
+sites without asking first, so web pages can't submit jobs.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   concurrent.futures import ThreadPoolExecutor
+from   datetime import datetime, timedelta
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from   os import path
+import shutil
+from   threading import Event, Lock, Thread
+import time
+import uuid
+
+if __debug__:
+    from sidetrack import log, logr
+
+import martian
+from martian.backends import backend_for
+from martian.exceptions import *
+from martian.failures import write_failures
+from martian.planner import History, whole_run
+from martian.tind import Tind
+from martian.transport import TransportPool
+
+
+# Constants.
+# .............................................................................
+
+_JOBS_FILE = 'jobs.json'
+'''Name of the file (in the service directory) where jobs are saved.'''
+
+_HISTORY_FILE = 'history.db'
+'''Name of the file (in the service directory) of the history of completed
+downloads, used for planning (see planner.py).'''
+
+_MAX_JOB_MESSAGES = 50
+'''Number of most recent progress messages kept for each job.'''
+
+_MAX_FINISHED_JOBS = 500
+'''Number of finished one-time jobs kept in the job list.  Older ones are
+dropped from the list (their output files are left alone).'''
+
+_FINISHED = ['done', 'incomplete', 'failed', 'cancelled']
+'''Statuses of jobs that have finished.'''
+
+_TIME_FORMAT = '%Y%m%d-%H%M%S'
+'''Format of the "{time}" value in output file names of recurring jobs.'''
+
+
+# Exported functions.
+# .............................................................................
+
+def run_service(port, workers, directory, notifier):
+    '''Runs the harvest service on localhost:'port' until interrupted, using
+    at most 'workers' concurrent harvests, and keeping the job queue and
+    default output files in 'directory'.'''
+    service = HarvestService(directory, workers)
+    server = ThreadingHTTPServer(('127.0.0.1', port), _handler_for(service))
+    server.daemon_threads = True
+    service.start()
+    notifier.info('{} service listening on http://127.0.0.1:{}/jobs'.format(
+        martian.__title__, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if __debug__: log('interrupted; shutting down service')
+    finally:
+        server.server_close()
+        service.stop()
+
+
+# Exported classes.
+# .............................................................................
+
+class HarvestService(object):
+    '''Runs harvest jobs on a bounded pool of threads and a shared pool of
+    transports, with persistent state and a scheduler for recurring jobs.'''
+
+    def __init__(self, directory, workers = 2):
+        self._dir      = directory
+        self._outputs  = path.join(directory, 'outputs')
+        self._file     = path.join(directory, _JOBS_FILE)
+        self._history  = History(path.join(directory, _HISTORY_FILE))
+        self._jobs     = {}
+        self._active   = {}
+        self._lock     = Lock()
+        self._wakeup   = Event()
+        self._stopping = False
+        self._workers  = workers
+        self._pools    = {}
+        self._executor = ThreadPoolExecutor(max_workers = workers,
+                                            thread_name_prefix = 'HarvestJob')
+        self._scheduler = Thread(target = self._schedule_loop, name = 'Scheduler',
+                                 daemon = True)
+        os.makedirs(self._outputs, exist_ok = True)
+        self._load()
+
+
+    def start(self):
+        # Queue anything that was pending or interrupted when we last stopped.
+        with self._lock:
+            pending = [job for job in self._jobs.values()
+                       if job['status'] in ['queued', 'running']]
+        for job in pending:
+            if __debug__: log('requeuing job {}', job['id'])
+            self._set(job, status = 'queued')
+            self._executor.submit(self._run, job['id'])
+        self._scheduler.start()
+
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        with self._lock:
+            active = list(self._active.values())
+        for tind in active:
+            tind.interrupt()
+        self._executor.shutdown(wait = True)
+        for pool in self._pools.values():
+            pool.close()
+        self._save()
+
+
+    def submit(self, spec):
+        '''Creates a job from the dict 'spec' and returns the job.  Raises
+        RequestError if the spec is invalid.'''
+        if not isinstance(spec, dict) or not spec.get('search'):
+            raise RequestError('A job must have a "search" value')
+        try:
+            start = int(spec.get('start', 1))
+            total = int(spec.get('total', -1))
+        except (TypeError, ValueError):
+            raise RequestError('"start" and "total" must be integers')
+        try:
+            backend_for(spec.get('backend') or 'search', host = spec.get('host'))
+        except ValueError as ex:
+            raise RequestError(str(ex))
+        output = self._output_path(spec.get('output'))
+        schedule = spec.get('schedule')
+        if output and schedule and '{time}' not in output:
+            # Every run needs a file of its own, or all but the first would
+            # find their output already there.
+            (base, ext) = path.splitext(output)
+            output = base + '-{time}' + (ext or '.xml')
+        if output and not schedule and path.exists(output):
+            raise RequestError('Output file {} already exists'.format(spec['output']))
+        if schedule:
+            try:
+                next_run = CronSchedule(schedule).next_after(datetime.now())
+            except ValueError as ex:
+                raise RequestError('Invalid schedule: {}'.format(ex))
+        job = {'id'          : uuid.uuid4().hex[:12],
+               'search'      : spec['search'],
+               'output'      : output,
+               'start'       : start,
+               'total'       : total,
+               'host'        : spec.get('host'),
+               'backend'     : spec.get('backend') or 'search',
+               'schedule'    : schedule,
+               'next_run'    : next_run.timestamp() if schedule else None,
+               'parent'      : None,
+               'status'      : 'scheduled' if schedule else 'queued',
+               'created'     : time.time(),
+               'started'     : None,
+               'finished'    : None,
+               'written'     : 0,
+               'failed'      : 0,
+               'failure_log' : None,
+               'progress'    : None,
+               'error'       : None,
+               'messages'    : []}
+        if not schedule and not job['output']:
+            job['output'] = path.join(self._outputs, job['id'] + '.xml')
+        with self._lock:
+            self._jobs[job['id']] = job
+        self._save()
+        if schedule:
+            self._wakeup.set()
+        else:
+            self._executor.submit(self._run, job['id'])
+        return self.get(job['id'])
+
+
+    def get(self, id):
+        with self._lock:
+            job = self._jobs.get(id)
+            return dict(job, messages = list(job['messages'])) if job else None
+
+
+    def list(self):
+        with self._lock:
+            return [dict(job, messages = list(job['messages']))
+                    for job in self._jobs.values()]
+
+
+    def cancel(self, id):
+        '''Cancels the job 'id'.  Returns the job, or None if not found.'''
+        with self._lock:
+            job = self._jobs.get(id)
+            tind = self._active.get(id)
+        if not job:
+            return None
+        if job['status'] in ['queued', 'running', 'scheduled']:
+            self._set(job, status = 'cancelled', finished = time.time())
+        if tind:
+            tind.interrupt()
+        return self.get(id)
+
+
+    def output_file(self, job):
+        '''Returns the path of the output file of 'job', or None if the job
+        has no output file in the service's output directory.'''
+        output = path.realpath(job['output'] or '')
+        if not _inside(output, path.realpath(self._outputs)) or not path.isfile(output):
+            return None
+        return output
+
+
+    def _run(self, id):
+        with self._lock:
+            job = self._jobs.get(id)
+            if not job or job['status'] != 'queued' or self._stopping:
+                return
+            # A job that was running when the service stopped is restarted,
+            # and replaces the output it had begun to write.
+            fresh = job['started'] is None
+            job.update(status = 'running', started = time.time())
+        self._save()
+        # Jobs saved by older versions could name any file.
+        problem = None
+        if not _inside(path.realpath(job['output']), path.realpath(self._outputs)):
+            problem = 'Output file {} is outside the output directory'
+        elif fresh and path.exists(job['output']):
+            problem = 'Output file {} already exists'
+        if problem:
+            self._set(job, status = 'failed', finished = time.time(),
+                      error = problem.format(job['output']))
+            return
+        os.makedirs(path.dirname(job['output']), exist_ok = True)
+        if __debug__: log('running job {}', id)
+        try:
+            backend = backend_for(job.get('backend') or 'search', host = job.get('host'))
+            tind = Tind(None, _JobNotifier(self, job), _JobTracer(self, job),
+                        self._pool_for(backend.host), backend = backend)
+            with self._lock:
+                self._active[id] = tind
+            result = tind.download(job['search'], job['output'], job['start'], job['total'])
+            if self._stopping:
+                # Leave it as 'running' so that it is requeued at restart.
+                return
+            if job['status'] == 'cancelled':
+                status = 'cancelled'
+            elif result.failed:
+                status = 'incomplete'
+            else:
+                status = 'done'
+            if status == 'done' and whole_run(job['start'], job['total'], result):
+                self._history.add(backend, result.metrics)
+            failure_log = None
+            if result.failed:
+                failure_log = path.splitext(job['output'])[0] + '-failed.jsonl'
+                write_failures(failure_log, result.failed)
+                self._note(job, '{} pages could not be downloaded; they are listed'
+                           ' in {}'.format(len(result.failed), failure_log))
+            self._set(job, status = status, written = result.written,
+                      failed = len(result.failed), failure_log = failure_log,
+                      finished = time.time())
+        except Exception as ex:
+            if __debug__: log('job {} failed: {}', id, str(ex))
+            self._set(job, status = 'failed', error = str(ex), finished = time.time())
+        finally:
+            with self._lock:
+                self._active.pop(id, None)
+
+
+    def _output_path(self, name):
+        '''Returns the path of the file 'name' in the output directory, or
+        None if 'name' is empty.  Raises RequestError if 'name' would be
+        outside the output directory.'''
+        if not name:
+            return None
+        if not isinstance(name, str):
+            raise RequestError('"output" must be a file name')
+        parts = name.replace('\\', '/').split('/')
+        if path.isabs(name) or path.splitdrive(name)[0] or '..' in parts:
+            raise RequestError('"output" must be a file name inside the output'
+                               ' directory, without ".." or an absolute path')
+        return path.join(self._outputs, path.normpath(name))
+
+
+    def _pool_for(self, host):
+        '''Returns the TransportPool for connections to 'host'.'''
+        with self._lock:
+            if host not in self._pools:
+                self._pools[host] = TransportPool(size = self._workers,
+                                                  limit = self._workers)
+            return self._pools[host]
+
+
+    def _schedule_loop(self):
+        while not self._stopping:
+            now = time.time()
+            due = []
+            with self._lock:
+                recurring = [j for j in self._jobs.values() if j['status'] == 'scheduled']
+            for job in recurring:
+                if job['next_run'] <= now:
+                    due.append(job)
+                    after = datetime.fromtimestamp(max(now, job['next_run']))
+                    next_run = CronSchedule(job['schedule']).next_after(after)
+                    self._set(job, next_run = next_run.timestamp())
+            for job in due:
+                self._launch(job)
+            with self._lock:
+                upcoming = [j['next_run'] for j in self._jobs.values()
+                            if j['status'] == 'scheduled']
+            delay = min(upcoming) - time.time() if upcoming else 60
+            self._wakeup.wait(max(1, min(delay, 60)))
+            self._wakeup.clear()
+
+
+    def _launch(self, recurring):
+        '''Creates and queues a one-time run of a recurring job.'''
+        run_id = uuid.uuid4().hex[:12]
+        stamp = datetime.now().strftime(_TIME_FORMAT)
+        template = recurring['output'] or path.join(self._outputs, '{id}-{time}.xml')
+        output = template.replace('{id}', recurring['id']).replace('{time}', stamp)
+        if __debug__: log('launching run {} of recurring job {}', run_id, recurring['id'])
+        job = dict(recurring, id = run_id, output = output, schedule = None,
+                   next_run = None, parent = recurring['id'], status = 'queued',
+                   created = time.time(), started = None, failed = 0,
+                   failure_log = None, messages = [])
+        with self._lock:
+            self._jobs[run_id] = job
+        self._save()
+        self._executor.submit(self._run, run_id)
+
+
+    def _set(self, job, **values):
+        with self._lock:
+            job.update(values)
+        self._save()
+
+
+    def _note(self, job, message):
+        with self._lock:
+            job['messages'].append(message)
+            del job['messages'][:-_MAX_JOB_MESSAGES]
+
+
+    def _load(self):
+        if not path.exists(self._file):
+            return
+        if __debug__: log('loading jobs from {}', self._file)
+        with open(self._file, 'r') as f:
+            self._jobs = {job['id']: job for job in json.load(f)}
+
+
+    def _save(self):
+        with self._lock:
+            finished = sorted((j for j in self._jobs.values()
+                               if j['status'] in _FINISHED),
+                              key = lambda j: j['finished'] or 0)
+            for job in finished[:-_MAX_FINISHED_JOBS]:
+                del self._jobs[job['id']]
+            text = json.dumps(list(self._jobs.values()), indent = 1)
+            tmp = self._file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, self._file)
+
+
+class CronSchedule(object):
+    '''A cron-style schedule with five fields: minute, hour, day of month,
+    month, and day of week (0-7, where both 0 and 7 are Sunday).  Each field
+    can be "*", a number, a range "a-b", a step "*/n" or "a-b/n", or a
+    comma-separated list of these.  As in cron, if both the day of month and
+    the day of week are restricted, a time matches if either one matches.'''
+
+    _RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, text):
+        fields = text.split()
+        if len(fields) != 5:
+            raise ValueError('expected 5 fields, got {}'.format(len(fields)))
+        sets = [_cron_field(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)]
+        (self.minutes, self.hours, self.days, self.months, weekdays) = sets
+        # Cron uses 0 = Sunday; Python's weekday() uses 0 = Monday.
+        self.weekdays = {(d - 1) % 7 for d in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+
+    def _day_matches(self, t):
+        day_ok = t.day in self.days
+        weekday_ok = t.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+
+    def next_after(self, after):
+        '''Returns the first datetime matching the schedule that is strictly
+        later than 'after' (to the minute).'''
+        t = after.replace(second = 0, microsecond = 0) + timedelta(minutes = 1)
+        limit = t + timedelta(days = 366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                month = t.month % 12 + 1
+                t = t.replace(year = t.year + (month == 1), month = month, day = 1,
+                              hour = 0, minute = 0)
+            elif not self._day_matches(t):
+                t = (t + timedelta(days = 1)).replace(hour = 0, minute = 0)
+            elif t.hour not in self.hours:
+                t = (t + timedelta(hours = 1)).replace(minute = 0)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes = 1)
+            else:
+                return t
+        raise ValueError('schedule never matches')
+
+
+# Internal implementation.
+# .............................................................................
+
+def _inside(file, directory):
+    '''Returns True if the path 'file' is inside 'directory'.'''
+    try:
+        return path.commonpath([file, directory]) == directory and file != directory
+    except ValueError:
+        # Paths on different drives.
+        return False
+
+
+def _cron_field(text, lo, hi):
+    values = set()
+    for part in text.split(','):
+        (span, _, step) = part.partition('/')
+        step = int(step) if step else 1
+        if span == '*':
+            (first, last) = (lo, hi)
+        elif '-' in span:
+            (first, last) = (int(x) for x in span.split('-', 1))
+        else:
+            first = last = int(span)
+        if not (lo <= first <= last <= hi) or step < 1:
+            raise ValueError('bad cron field "{}"'.format(text))
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class _JobNotifier(object):
+    '''Notifier for Tind that records messages in a job.'''
+
+    def __init__(self, service, job):
+        self._service = service
+        self._job = job
+
+    def _note(self, text, details = ''):
+        self._service._note(self._job, text)
+
+    info = warn = error = fatal = _note
+
+    def yes_no(self, question):
+        return False
+
+
+class _JobTracer(object):
+    '''Progress tracer for Tind that records progress in a job.'''
+
+    def __init__(self, service, job):
+        self._service = service
+        self._job = job
+
+    def _note(self, message = None):
+        if message:
+            self._service._note(self._job, message)
+
+    start = update = stop = _note
+
+    def progress(self, done, total, nbytes = 0):
+        # Called for every page; don't save the job file for this.
+        self._job['progress'] = {'done': done, 'total': total, 'bytes': nbytes}
+
+
+def _handler_for(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            if __debug__: log('http: ' + format, *args)
+
+
+        def _reply(self, code, body):
+            data = json.dumps(body, indent = 1).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+
+        def _parts(self):
+            return [p for p in self.path.split('?')[0].split('/') if p]
+
+
+        def do_GET(self):
+            parts = self._parts()
+            if parts == ['jobs']:
+                self._reply(200, service.list())
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                job = service.get(parts[1])
+                self._reply(200, job) if job else self._reply(404, {'error': 'no such job'})
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'output':
+                self._send_output(service.get(parts[1]))
+            else:
+                self._reply(404, {'error': 'not found'})
+
+
+        def do_POST(self):
+            if self._parts() != ['jobs']:
+                self._reply(404, {'error': 'not found'})
+                return
+            # Requiring this type stops web pages in a browser from sending
+            # jobs here: they can only send other types without a preflight.
+            kind = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if kind != 'application/json':
+                self._reply(415, {'error': 'Content-Type must be application/json'})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                spec = json.loads(self.rfile.read(length) or b'{}')
+                self._reply(201, service.submit(spec))
+            except (ValueError, RequestError) as ex:
+                self._reply(400, {'error': str(ex)})
+
+
+        def do_DELETE(self):
+            parts = self._parts()
+            job = service.cancel(parts[1]) if len(parts) == 2 and parts[0] == 'jobs' else None
+            self._reply(200, job) if job else self._reply(404, {'error': 'no such job'})
+
+
+        def _send_output(self, job):
+            if not job:
+                self._reply(404, {'error': 'no such job'})
+                return
+            output = service.output_file(job)
+            if job['status'] not in ['done', 'incomplete'] or not output:
+                self._reply(409, {'error': 'job has no output', 'status': job['status']})
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(path.getsize(output)))
+                self.end_headers()
+                with open(output, 'rb') as f:
+                    shutil.copyfileobj(f, self.wfile)
+
+    return Handler
@@ -0,0 +1,189 @@
+'''
+sorting.py: sort the records of a MARC XML file by control number
+
+TIND returns search results in its own order, which can change from one
+harvest to the next.  sort_file() puts the records of a file in order of
+their 001 field (numerically, as TIND's record ids are numbers), so that
+harvests of the same records produce the same file and can be compared with
+ordinary tools.  Records without a 001 field go at the end, in their
+original order.
+
+Output files can be much larger than the memory available, so the sort is
+an external merge sort.  The records are read in batches of bounded size;
+each batch is sorted and written to a temporary "run" file, by a pool of
+worker processes so that several batches are sorted at once.  The runs are
+then merged into the output with a heap, reading each run a chunk at a time.
+If there are more runs than can sensibly be open at once, groups of them
+are first merged into longer runs.  Memory use stays within roughly the
+'memory' limit given to sort_file() no matter how large the file is.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+import heapq
+import os
+from   os import path
+import shutil
+import tempfile
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.changes import id_order, record_id, records_in
+from martian.exceptions import *
+from martian.tracing import span
+
+
+# Constants.
+# .............................................................................
+
+_MEMORY = 256 * 1024 * 1024
+'''Default number of bytes of records to hold in memory during a sort.'''
+
+_MIN_RUN_SIZE = 1024 * 1024
+'''Smallest number of bytes of records sorted into one run.'''
+
+_MIN_CHUNK_SIZE = 64 * 1024
+'''Smallest number of bytes read from a run at a time while merging.'''
+
+_MAX_FAN_IN = 64
+'''Largest number of runs merged at one time.'''
+
+_HEADER = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+           b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+_FOOTER = b'</collection>\n'
+
+
+# Exported functions.
+# .............................................................................
+
+def sort_key(record):
+    '''Returns the sort key of 'record' (bytes): its 001 value, in the
+    order given by id_order() (see changes.py).'''
+    return id_order(record_id(record))
+
+
+def sort_file(input, output, memory = _MEMORY, workers = None, directory = None):
+    '''Writes the records of the MARC XML file 'input' to the file 'output',
+    sorted by their 001 field, and returns the number of records.  'input'
+    and 'output' can be the same file.  At most about 'memory' bytes of
+    records are held in memory at once.  Batches are sorted by 'workers'
+    processes (default: one per CPU core; 0 or 1 to sort in this process).
+    Temporary files go in 'directory' (default: the directory of 'output').'''
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    # The batch being read and each batch given to a worker (which the
+    # worker holds a copy of) all count against the limit.
+    run_size = max(_MIN_RUN_SIZE, memory // (2 * max(1, workers) + 1))
+    directory = directory or path.dirname(path.abspath(output))
+    scratch = tempfile.mkdtemp(prefix = '.martian-sort-', dir = directory)
+    if __debug__: log('sorting {} in runs of {} bytes using {} workers',
+                      input, run_size, workers)
+    try:
+        runs = _make_runs(input, scratch, run_size, workers)
+        while len(runs) > _MAX_FAN_IN:
+            runs = [_merge_runs(runs[i : i + _MAX_FAN_IN], scratch, memory)
+                    for i in range(0, len(runs), _MAX_FAN_IN)]
+        (fd, temp) = tempfile.mkstemp(prefix = '.martian-sorted-', suffix = '.xml',
+                                      dir = path.dirname(path.abspath(output)))
+        try:
+            with os.fdopen(fd, 'wb') as out, span('merge', runs = len(runs)):
+                out.write(_HEADER)
+                count = _merge(runs, out, memory)
+                out.write(_FOOTER)
+            os.replace(temp, output)
+        except BaseException:
+            if path.exists(temp):
+                os.remove(temp)
+            raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors = True)
+    if __debug__: log('wrote {} sorted records to {}', count, output)
+    return count
+
+
+# Internal implementation.
+# .............................................................................
+
+def _make_runs(input, scratch, run_size, workers):
+    '''Returns the names of sorted run files made from 'input'.'''
+    executor = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers = workers)
+    runs = []
+    pending = deque()
+
+    def submit(batch):
+        file = path.join(scratch, 'run-{:06d}'.format(len(runs) + len(pending)))
+        if executor:
+            # Wait for a worker rather than letting batches pile up.
+            while len(pending) >= workers:
+                runs.append(pending.popleft().result())
+            pending.append(executor.submit(_write_run, batch, file))
+        else:
+            runs.append(_write_run(batch, file))
+
+    try:
+        batch = []
+        size = 0
+        for record in records_in(input):
+            batch.append(record)
+            size += len(record)
+            if size >= run_size:
+                submit(batch)
+                batch = []
+                size = 0
+        if batch or not (runs or pending):
+            submit(batch)
+        while pending:
+            runs.append(pending.popleft().result())
+    finally:
+        if executor:
+            executor.shutdown(wait = True, cancel_futures = True)
+    if __debug__: log('made {} sorted runs', len(runs))
+    return runs
+
+
+def _write_run(records, file):
+    # This runs in worker processes, so it has to be at the top level.
+    with span('sort-run', records = len(records)):
+        records.sort(key = sort_key)
+        with open(file, 'wb') as f:
+            for record in records:
+                f.write(record)
+                f.write(b'\n')
+    return file
+
+
+def _merge_runs(runs, scratch, memory):
+    (fd, file) = tempfile.mkstemp(prefix = 'merged-', dir = scratch)
+    with os.fdopen(fd, 'wb') as out:
+        _merge(runs, out, memory)
+    return file
+
+
+def _merge(runs, out, memory):
+    '''Writes the records of the sorted 'runs' to 'out' in order, deletes
+    the run files, and returns the number of records.'''
+    # Each run is read in chunks, and the chunks share the memory limit.
+    chunk_size = max(_MIN_CHUNK_SIZE, memory // (2 * max(1, len(runs))))
+    readers = [records_in(run, chunk_size) for run in runs]
+    count = 0
+    for record in heapq.merge(*readers, key = sort_key):
+        out.write(record)
+        out.write(b'\n')
+        count += 1
+    for run in runs:
+        os.remove(run)
+    return count
@@ -14,210 +14,576 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from   bs4 import BeautifulSoup
-import certifi
-import humanize
-from   lxml import html
-from   pubsub import pub
-import pycurl
-from   pycurl import Curl
+import os
+from   os import path
 import re
-from   threading import Thread
+import sys
+import tempfile
+from   threading import Event, Lock, Thread
+import time
 import urllib.parse
-try:
-    from io import BytesIO
-except ImportError:
-    from StringIO import StringIO as BytesIO
 
 if __debug__:
     from sidetrack import log, logr
 
 import martian
+from martian.backends import SearchBackend
+from martian.database import DatabaseWriter, is_database
 from martian.exceptions import *
-from martian.network import net
+from martian.failures import Page, RetryPolicy, RetryQueue, check_page
+from martian.metrics import DownloadResult, PageMetrics, RunMetrics
+from martian.partition import Part, WorkQueues, collection_parts, concatenate
+from martian.partition import merge_unique, plan, remove_files
+from martian.pipeline import PagePipeline
+from martian.profiling import profiled
+from martian.tracing import span
+from martian.transport import Transport
+from martian.writer import BackgroundWriter
 
 
-# Global constants.
+# Constants.
 # .............................................................................
 
-# Some testing with caltech.tind.io reveals that if you ask for more than 200,
-# it returns 200.
+STDOUT = '-'
+'''Output file name that means the standard output.'''
 
-_RECORDS_PER_GET = 200
-'''
-Number of records to request from TIND at each iteration.  The maximum allowed
-by TIND is 200.
-'''
 
-_BASE_GET_URL = 'https://caltech.tind.io/search?ln=en'
-'''
-URL fragment common to all our search + download calls.
-'''
+# Exported functions.
+# .............................................................................
+
+def parse_search(search):
+    '''Returns a tuple (query, collections) for the 'search', which can be a
+    search expression or a complete search URL.  'query' is the URL-quoted
+    search expression and 'collections' is a list of the collections named
+    in the URL (if any).'''
+    if search.startswith('http'):
+        # We were given a full url.  Extract just the search part.
+        match = re.search(r'p=([^&]+)', search)
+        query = match.group(1) if match is not None else ""
+    else:
+        # We were given a search expression directly.  Quote it to deal
+        # with embedded spaces and whatnot.
+        query = urllib.parse.quote(search)
+
+    # Look for any collections that might be specified.  There can be more
+    # than one.
+    collections = [match.group(1) for match in re.finditer(r'&c=([^&]+)', search)]
+    return (query, collections)
+
 
-
 # Main class.
 # .............................................................................
 
 class Tind(object):
 
-    def __init__(self, controller, notifier, tracer):
+    def __init__(self, controller, notifier, tracer, pool = None, workers = 0,
+                 parallel = 0, partition_by = 'recid', backend = None,
+                 buffer_size = None, by_collection = False, retry_policy = None,
+                 stages = ()):
+        '''Initializes the object.  'backend' is the backend object to use to
+        talk to TIND (default: a SearchBackend).  If 'pool' is given, it must be a
+        TransportPool; connections are then taken from and returned to the
+        pool, so that they can be reused by later downloads.  If 'workers'
+        is greater than 0, pages are converted in that many processes while
+        the download proceeds (see pipeline.py).  If 'parallel' is greater
+        than 1, complete downloads are split into parts by ranges of the
+        field 'partition_by', and the parts are fetched by that many
+        threads at once (see partition.py).  If 'by_collection' is True,
+        complete downloads of searches in more than one collection are
+        instead split by collection, and all the collections are fetched at
+        once.  Output is written on a separate thread in chunks of up to
+        'buffer_size' bytes (see writer.py).  Pages that fail are retried
+        according to 'retry_policy' (see failures.py).  The records of each
+        page are passed through the conversion functions in 'stages', such
+        as a RecordTransform (see transforms.py), before they are written.'''
         self._controller  = controller
         self._notifier    = notifier
         self._tracer      = tracer
-        self._stop        = False
+        self._pool        = pool
+        self._backend     = backend or SearchBackend()
+        self._workers     = workers
+        self._parallel    = parallel
+        self._partition   = partition_by
+        self._per_coll    = by_collection
+        self._buffer_size = buffer_size
+        self._stages      = tuple(stage for stage in stages if stage)
+        self._stop        = Event()
         self._downloader  = None
         self._num_written = 0
+        self._metrics     = None
+        self._changes     = None
+        self._policy      = retry_policy or RetryPolicy()
+        self._retries     = None
+        self._failed      = []
 
 
-    def download(self, search, output, start = 1, total = -1):
+    def download(self, search, output, start = 1, total = -1, changes = None):
         '''Search with the given 'search' string and write the output to file
-        named by 'output'.  Get 'total' number of records (default: all),
-        optionally starting from record number 'start' (default: 1).
-        Returns the number of records downloaded, or 0 if something went wrong.
+        named by 'output' ("-" for the standard output).  Get 'total' number
+        of records (default: all), optionally starting from record number
+        'start' (default: 1).  If 'changes' is given, it must be a
+        ChangeTracker (see changes.py), and every record written is passed
+        to it.  Returns a DownloadResult object, whose 'written' attribute
+        is the number of records downloaded (0 if something went wrong),
+        whose 'metrics' attribute holds the RunMetrics for the download, and
+        whose 'failed' attribute lists the pages that could not be
+        downloaded (see failures.py).
         '''
         tracer   = self._tracer
         notifier = self._notifier
+        metrics  = self._metrics = RunMetrics()
+        result   = DownloadResult(0, output, metrics)
+        self._changes = changes
+        self._failed  = []
 
         if not search:
             tracer.update('Given an empty search string -- nothing to do')
-            return 0
-        elif search.startswith('http'):
-            # We were given a full url.  Extract just the search part.
-            match = re.search(r'p=([^&]+)', search)
-            query = match.group(1) if match is not None else ""
-        else:
-            # We were given a search expression directly.  Quote it to deal
-            # with embedded spaces and whatnot.
-            query = urllib.parse.quote(search)
-
-        # Look for any collections that might be specified.
-        collections = []
-        if search.find('&c'):
-            # There can be more than one.
-            for match in re.finditer(r'&c=([^&]+)', search):
-                collections.append(match.group(1))
-
-        # TIND doesn't seem to offer a way to find out the number of expected
-        # records if you ask for MARC XML output.  So here we start by doing
-        # a normal TIND search and parsing the HTML to look for the total
-        # results it reports, then loop to get the MARC records.
-
-        tracer.update('Asking caltech.tind.io how many records to expect')
-        prelim_search = url_for_get(query, collections, get = 1, start = 1, marc = False)
-        (response, error) = net('get', prelim_search)
-        if response.status_code > 300:
-            details = 'exception connecting to tind.io: {}'.format(error)
-            notifier.fatal('Failed to connect to tind.io -- try again later', details)
-            raise ServiceFailure(details)
-        if error:
-            details = 'exception: {}'.format(error)
-            notifier.fatal('Failed to search TIND', details)
-            raise RequestError(details)
-        soup = BeautifulSoup(response.content, features='lxml')
-        tds = soup.select('.searchresultsboxheader')
-        if tds == []:
-            notifier.info('This TIND search produced 0 records')
-            return 0
-
-        # When multiple collections are used, the total number of records is
-        # the sum of the results from individual collections.
-        num_records = 0
-        for td in tds:
-            if td.text.find('records found') > 0:
-                match = re.search('([0-9,]+) records found', td.text)
-                if match and match.group(1):
-                    num_records += int(match.group(1).replace(',', ''))
-                else:
-                    notifier.fatal('Unexpected format for number of records')
-                    raise InternalError(details)
+            return result
+        (query, collections) = parse_search(search)
+
+        # First find out how many records to expect, then loop to get the
+        # MARC records.
+        host = self._backend.host_name
+        tracer.update('Asking {} how many records to expect'.format(host))
+        probe_start = time.perf_counter()
+        session = self._pool.session if self._pool else None
+        try:
+            with span('probe'):
+                num_records = self._backend.count(query, collections, session)
+        except AuthenticationFailure as ex:
+            notifier.fatal('TIND did not accept the API key', str(ex))
+            raise
+        except ServiceFailure as ex:
+            notifier.fatal('Failed to connect to {} -- try again later'.format(host), str(ex))
+            raise
+        except RequestError as ex:
+            notifier.fatal('Failed to search TIND', str(ex))
+            raise
+        except InternalError as ex:
+            notifier.fatal('Unexpected format for number of records')
+            raise
+        finally:
+            metrics.probe_time = time.perf_counter() - probe_start
 
         if num_records == 0:
             notifier.info('This TIND search produced 0 records')
-            return 0
+            return result
         else:
-            text_number = humanize.intcomma(num_records)
+            from humanize import intcomma
+            text_number = intcomma(num_records)
             tracer.update('This search will produce {} records'.format(text_number))
 
-        # OK, now let's loop.
-        self._downloader = Thread(target = self._download_loop,
-                                  args = (query, collections, output, start,
-                                          total, num_records, tracer))
-        if __debug__: log('starting downloader thread')
-        self._downloader.start()
-        if __debug__: log('waiting on downloader thread')
-        self._downloader.join()
-        if __debug__: log('downloader thread has returned')
+        # Partitioning only makes sense when getting the whole result set.
+        parts = None
+        if self._per_coll and len(collections) > 1 and start == 1 and total < 0:
+            tracer.update('Counting the records in each collection')
+            count = lambda c: self._backend.count(query, c, session)
+            with span('partition'):
+                parts = collection_parts(count, collections)
+        elif self._parallel > 1 and start == 1 and total < 0:
+            tracer.update('Dividing the search into parts')
+            count = lambda q: self._backend.count(q, collections, session)
+            with span('partition'):
+                parts = plan(count, query, num_records, self._parallel,
+                             self._backend.page_size, self._partition)
+            if not parts:
+                tracer.update('Cannot divide this search; getting it in one piece')
 
-        # Return how many records ended up being written.
-        return self._num_written
+        # OK, now let's loop.
+        if parts:
+            loop = profiled(self._profile_name(), self._partitioned_loop)
+            args = (query, collections, output, parts, num_records, tracer)
+        else:
+            loop = profiled(self._profile_name(), self._download_loop)
+            args = (query, collections, output, start, total, num_records, tracer)
+        self._run_downloader(loop, args)
+
+        # Report how many records ended up being written.
+        metrics.finish()
+        result.written = self._num_written
+        result.failed = self._failed
+        return result
+
+
+    def download_pages(self, pages, output):
+        '''Gets the pages listed in 'pages' (Page objects, such as those in
+        the 'failed' attribute of the result of an earlier download, or read
+        from a failure log by read_failures()) and writes their records to
+        the file named by 'output'.  Returns a DownloadResult.'''
+        metrics = self._metrics = RunMetrics()
+        result  = DownloadResult(0, output, metrics)
+        self._failed = []
+        for page in pages:
+            page.attempts = 0
+            page.backoff = 0
+        loop = profiled(self._profile_name(), self._pages_loop)
+        self._run_downloader(loop, (pages, output, self._tracer))
+        metrics.finish()
+        result.written = self._num_written
+        result.failed = self._failed
+        return result
 
 
     def interrupt(self):
         if __debug__: log('setting the stop flag')
-        self._stop = True
+        self._stop.set()
+        if self._retries:
+            # Pages still waiting to be retried are reported as failed.
+            self._retries.close(abandon = True)
         if self._downloader:
             if __debug__: log('waiting on downloader thread')
             self._downloader.join()
             if __debug__: log('downloader thread has returned')
 
 
+    def _run_downloader(self, loop, args):
+        errors = []
+
+        def run():
+            try:
+                loop(*args)
+            except Exception as ex:
+                if __debug__: log('downloader thread got exception: {}', str(ex))
+                errors.append(ex)
+
+        self._downloader = Thread(target = run, name = 'Downloader')
+        if __debug__: log('starting downloader thread')
+        self._downloader.start()
+        if __debug__: log('waiting on downloader thread')
+        self._downloader.join()
+        if __debug__: log('downloader thread has returned')
+        if errors:
+            # Pass the problem on to our caller rather than losing it.
+            raise errors[0]
+
+
     def _download_loop(self, query, collections, output, start, total, num_records, tracer):
         if total < 0:
             total = num_records
+        # Progress is reported in terms of records received in this run.
+        expected = max(0, min(total, num_records) - start + 1)
+        report = self._reporter(tracer, expected)
+
+        backend = self._backend
+        pages = []
+        while start <= total:
+            pages.append(self._page(query, collections, start))
+            start += backend.page_size
+        self._write_pages(pages, output, report)
+
+
+    def _pages_loop(self, pages, output, tracer):
+        expected = sum(page.size for page in pages)
+        self._write_pages(pages, output, self._reporter(tracer, expected))
+
+
+    def _write_pages(self, pages, output, report):
         if __debug__: log('opening output file: {}', output)
-        out = open(output, 'wb')
+        out = self._open_output(output)
+        transport = self._pool.acquire() if self._pool else Transport()
         out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
         out.write(b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
-
-        while start <= total and not self._stop:
-            # The value of end_at is only used for the user message.
-            if start + _RECORDS_PER_GET > num_records:
-                end_at = num_records
-            else:
-                end_at = _RECORDS_PER_GET + start - 1
-            tracer.update('Getting records {} to {}'.format(start, end_at))
-            data = None
+        # Pages of a sequential backend can't be retried out of order, so a
+        # damaged one stops the download.
+        sequential = self._backend.sequential
+        pipeline = PagePipeline(out, self._stages, workers = self._workers,
+                                observer = self._observer(),
+                                on_corrupt = None if sequential else self._retry_later)
+        pipeline.start()
+        self._retries = self._retry_queue(pipeline, report)
+        cursor = None
+        try:
+            for page in pages:
+                if self._stop.is_set():
+                    break
+                if sequential:
+                    try:
+                        response = self._get_now(transport, page, cursor)
+                    except UserCancelled:
+                        break
+                    cursor = self._backend.next_cursor(response.body)
+                    self._accept(pipeline, page, response, report)
+                else:
+                    self._get_or_retry(transport, pipeline, page, report)
+            if __debug__: log('closing output due to interruption'
+                              if self._stop.is_set() else 'closing output file')
+            # The retry thread may need this connection to get the last pages.
+            self._done_with(transport)
+            transport = None
+            self._finish_retries(pipeline)
+            pipeline.close()
+        except Exception:
+            self._retries.close(abandon = True)
+            pipeline.abort()
             try:
-                url = url_for_get(query, collections, _RECORDS_PER_GET, start, marc = True)
-                data = BytesIO()
-                curl = Curl()
-                curl.setopt(pycurl.CAINFO, certifi.where())
-                curl.setopt(curl.URL, url)
-                curl.setopt(curl.WRITEDATA, data)
-                if __debug__: log('curling "{}"', url)
-                curl.perform()
-                curl.close()
-            except Exception as err:
-                if __debug__: log('exception in curl process: {}', str(err))
-                tracer.update('Stopping download due to problem')
-                data = None
-                raise err
-
-            if data:
-                # Skip stuff at beginning and end, and write to the file.
-                v = data.getvalue()
-                block_start = v.find(b'<collection xmlns="http://www.loc.gov/MARC21/slim">')
-                block_end = v.rfind(b'</collection>')
-                out.write(v[block_start + 52 : block_end])
-
-                # Increment and continue to get more
-                start += _RECORDS_PER_GET
-                self._num_written = end_at
-
-        if __debug__: log('closing output due to interruption' if self._stop
-                          else 'closing output file')
+                out.close()
+            except Exception:
+                pass                    # Report the original problem instead.
+            if transport:
+                self._done_with(transport)
+            raise
         out.write(b'</collection>\n')
         out.close()
+        self._num_written = pipeline.records
+
+
+    def _partitioned_loop(self, query, collections, output, parts, num_records, tracer):
+        # Collections are all fetched at once, however many there are.
+        by_collection = all(part.collections for part in parts)
+        num_workers = len(parts) if by_collection else self._parallel
+        if by_collection and self._pool:
+            # Every collection holds a connection while it is fetched, and
+            # the retry thread needs one more.
+            self._pool.widen(num_workers + 1)
+        queues = WorkQueues(parts, num_workers)
+        self._metrics.concurrency = num_workers
+        # Parts of output going to a pipe are kept in the temporary directory.
+        directory = (tempfile.gettempdir() if output == STDOUT
+                     else path.dirname(path.abspath(output)))
+        lock = Lock()
+        errors = []
+        report = self._reporter(tracer, num_records)
+        written = {'records': 0}
+
+        # Pages that have to be retried are written to a part of their own.
+        retried = Part(None, 0, 0, 0)
+        (fd, retried.file) = tempfile.mkstemp(prefix = '.martian-part-', suffix = '.xml',
+                                              dir = directory)
+        retry_out = BackgroundWriter(os.fdopen(fd, 'wb'), self._buffer_size)
+        retry_pipeline = PagePipeline(retry_out, self._stages,
+                                      observer = self._observer(),
+                                      on_corrupt = self._retry_later).start()
+        self._retries = self._retry_queue(retry_pipeline, report)
+        parts = parts + [retried]
+
+        def work(worker):
+            transport = self._pool.acquire() if self._pool else Transport()
+            try:
+                part = queues.next(worker)
+                while part and not self._stop.is_set() and not errors:
+                    count = self._fetch_part(transport, query, collections, part,
+                                             directory, report)
+                    with lock:
+                        written['records'] += count
+                    part = queues.next(worker)
+            except Exception as ex:
+                if __debug__: log('exception in part worker {}: {}', worker, str(ex))
+                errors.append(ex)
+            finally:
+                self._done_with(transport)
+
+        if __debug__: log('starting {} part workers', num_workers)
+        workers = [Thread(target = profiled(self._profile_name(i), work),
+                          args = (i,), name = 'PartWorker-{}'.format(i))
+                   for i in range(num_workers)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        try:
+            if errors:
+                raise errors[0]
+            self._finish_retries(retry_pipeline)
+            retry_pipeline.close()
+            retry_out.close()
+        except Exception:
+            self._retries.close(abandon = True)
+            retry_pipeline.abort()
+            try:
+                retry_out.close()
+            except Exception:
+                pass
+            remove_files(parts)
+            tracer.update('Stopping download due to problem')
+            raise
+
+        if __debug__: log('merging {} parts into {}', len(parts), output)
+        with self._open_output(output) as out, span('merge', parts = len(parts)):
+            out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+            out.write(b'<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+            if by_collection:
+                # Collections can overlap, so drop repeated records.
+                self._num_written = merge_unique(parts, out)
+            else:
+                concatenate(parts, out)
+                self._num_written = written['records'] + retry_pipeline.records
+            out.write(b'</collection>\n')
+
+
+    def _fetch_part(self, transport, query, collections, part, directory, report):
+        '''Gets the records of 'part' into a temporary file, and returns the
+        number of records written to it.'''
+        if __debug__: log('getting {}', part)
+        subquery = part.query(query)
+        collections = part.collections or collections
+        (fd, part.file) = tempfile.mkstemp(prefix = '.martian-part-', suffix = '.xml',
+                                           dir = directory)
+        backend = self._backend
+        with BackgroundWriter(os.fdopen(fd, 'wb'), self._buffer_size) as out:
+            pipeline = PagePipeline(out, self._stages, observer = self._observer(),
+                                    on_corrupt = self._retry_later).start()
+            try:
+                start = 1
+                cursor = None
+                while start <= part.count and not self._stop.is_set():
+                    page = self._page(subquery, collections, start)
+                    if backend.sequential:
+                        try:
+                            response = self._get_now(transport, page, cursor)
+                        except UserCancelled:
+                            break
+                        cursor = backend.next_cursor(response.body)
+                        self._accept(pipeline, page, response, report)
+                    else:
+                        self._get_or_retry(transport, pipeline, page, report)
+                    start += backend.page_size
+                pipeline.close()
+            except Exception:
+                pipeline.abort()
+                raise
+        return pipeline.records
+
+
+    def _page(self, query, collections, start):
+        backend = self._backend
+        return Page(backend.host_name, backend.name, query, collections, start,
+                    backend.page_size)
+
+
+    def _get(self, transport, page, cursor = None):
+        '''Gets 'page' and returns the Response.  Raises an exception if the
+        response is not a usable page of records.'''
+        (url, headers) = self._backend.page(page.query, page.collections,
+                                            page.start, cursor)
+        with span('fetch', start = page.start, attempt = page.attempts + 1):
+            response = transport.get(url, headers, cancel = self._stop)
+            check_page(response)
+        return response
+
+
+    def _get_or_retry(self, transport, pipeline, page, report):
+        '''Gets 'page' and sends it to 'pipeline', or, if that fails, puts it
+        on the retry queue.'''
+        if __debug__: log('getting records {} to {}', page.start,
+                          page.start + page.size - 1)
+        try:
+            response = self._get(transport, page)
+        except AuthenticationFailure:
+            raise
+        except Exception as ex:
+            if __debug__: log('failed to get {}: {}', page, str(ex))
+            self._retries.add(page, ex)
+        else:
+            self._accept(pipeline, page, response, report)
 
-
-# Miscellaneous utility functions.
-# .............................................................................
 
-def url_for_get(search_string, collections, get, start, marc = False):
-    u = (_BASE_GET_URL
-            + ('&c=' + '&c='.join(collections) if collections else '')
-            + '&p=' + search_string
-            + '&jrec=' + str(start)
-            + '&rg=' + str(get)
-            + ('&of=xm' if marc else ''))
-    return u
+    def _get_now(self, transport, page, cursor):
+        '''Gets 'page', retrying it in place as the policy allows.  Used for
+        backends whose pages have to be fetched in order.'''
+        while True:
+            try:
+                return self._get(transport, page, cursor)
+            except AuthenticationFailure:
+                raise
+            except Exception as ex:
+                page.attempts += 1
+                if (page.attempts >= self._policy.attempts or self._stop.is_set()
+                    or isinstance(ex, (NoContent, RequestError))):
+                    raise
+                if __debug__: log('retrying {} after error: {}', page, str(ex))
+                waited = time.monotonic()
+                with span('retry-wait', start = page.start):
+                    self._stop.wait(self._policy.wait_after(page.attempts))
+                page.backoff += time.monotonic() - waited
+
+
+    def _accept(self, pipeline, page, response, report):
+        data = response.body
+        pipeline.submit(self._backend.records(data), tag = page)
+        records = data.count(b'</record>')
+        self._metrics.add_page(PageMetrics(page.start, response.status, len(data),
+                                           records, retries = page.attempts,
+                                           backoff = page.backoff,
+                                           timing = response.timing))
+        report(records, len(data))
+
+
+    def _retry_queue(self, pipeline, report):
+        def fetch(page):
+            # Waiting for a connection has to give way to interrupt(), which
+            # joins this thread.
+            transport = self._pool.acquire(self._stop) if self._pool else Transport()
+            try:
+                return self._get(transport, page)
+            finally:
+                self._done_with(transport)
+
+        def accept(page, response):
+            self._accept(pipeline, page, response, report)
+
+        return RetryQueue(fetch, accept, self._policy)
+
+
+    def _retry_later(self, page, error):
+        self._retries.add(page, error)
+
+
+    def _finish_retries(self, pipeline):
+        '''Waits until the retry queue and 'pipeline' have nothing left to do.
+        A page retried successfully can turn out to be damaged, and go back
+        on the queue, so this has to go around until both are idle.'''
+        retries = self._retries
+        while not self._stop.is_set():
+            retries.wait()
+            pipeline.join()
+            if retries.idle():
+                break
+        retries.close(abandon = self._stop.is_set())
+        self._failed.extend(retries.failed)
+
+
+    def _reporter(self, tracer, expected):
+        '''Returns a function that adds up the records and bytes received
+        (possibly by several threads) and reports progress to 'tracer'.'''
+        lock = Lock()
+        counts = {'records': 0, 'bytes': 0}
+
+        def report(records, nbytes):
+            with lock:
+                counts['records'] += records
+                counts['bytes'] += nbytes
+                tracer.progress(counts['records'], expected, counts['bytes'])
+
+        report(0, 0)
+        return report
+
+
+    def _open_output(self, output):
+        '''Returns a BackgroundWriter for the file 'output', which can also be
+        a database (see database.py) or STDOUT.'''
+        if output == STDOUT:
+            # The process's real standard output, even if sys.stdout has been
+            # redirected to keep messages out of the data.
+            stdout = open(sys.__stdout__.fileno(), 'wb', closefd = False)
+            return BackgroundWriter(stdout, self._buffer_size, flush = True)
+        if is_database(output):
+            return BackgroundWriter(DatabaseWriter(output), self._buffer_size)
+        return BackgroundWriter(open(output, 'wb'), self._buffer_size)
+
+
+    def _observer(self):
+        return self._changes.observe if self._changes else None
+
+
+    def _profile_name(self, worker = None):
+        '''Returns the name for profiles of a downloader thread, which has to
+        tell the hosts of a multi-host harvest apart.'''
+        name = 'downloader-' + self._backend.host_name.replace(':', '_')
+        return name if worker is None else '{}-{}'.format(name, worker)
+
+
+    def _done_with(self, transport):
+        if self._pool:
+            self._pool.release(transport)
+        else:
+            transport.close()
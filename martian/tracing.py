@@ -0,0 +1,159 @@
+'''
+tracing.py: record a timeline of what Martian's threads are doing
+
+When tracing is turned on (with enable()), the code in tind.py, pipeline.py,
+writer.py and failures.py marks the steps of a download as named spans:
+the count probe, the fetch of each page, the conversion ("strip") and
+writing of each page, disk writes, and waits before retries.  Each span
+records the thread it ran on and its start and end times.  When the program
+exits (or when write() is called), the spans are written to a file in the
+Chrome trace event format, which can be opened in Perfetto
+(https://ui.perfetto.dev) or in chrome://tracing.  The timeline shows how
+fetching, conversion and writing overlap, and where one of them sits idle
+waiting for another.
+
+When tracing is not enabled, span() returns a shared object whose "with"
+block does nothing, so the cost of a span is one function call.
+
+This module also provides background_logging(), which moves the writing of
+debug log messages (from sidetrack's log()) to a separate thread, so that
+the threads doing the work only have to put messages on a queue.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import atexit
+import json
+import os
+from   threading import current_thread, get_ident
+from   time import perf_counter_ns
+
+if __debug__:
+    from sidetrack import log, logr
+
+
+# Module state.
+# .............................................................................
+
+_file    = None
+_events  = []
+_threads = {}
+_origin  = 0
+
+
+# Exported functions.
+# .............................................................................
+
+def enable(file):
+    '''Turns on tracing, with the timeline to be written to 'file'.'''
+    global _file, _origin
+    _file = os.path.abspath(file)
+    _origin = perf_counter_ns()
+    if __debug__: log('tracing enabled; timeline will go to {}', _file)
+    atexit.register(write)
+
+
+def enabled():
+    '''Returns True if tracing has been turned on.'''
+    return _file is not None
+
+
+def span(name, **args):
+    '''Returns a context manager that records the time spent in its "with"
+    block as a span named 'name', with 'args' as details shown in the
+    timeline.  If tracing is not enabled, the context manager does nothing.'''
+    if _file is None:
+        return _NO_SPAN
+    return _Span(name, args)
+
+
+def write(file = None):
+    '''Writes the spans recorded so far to 'file' (default: the file given
+    to enable()) in the Chrome trace event format.'''
+    file = file or _file
+    if not file:
+        return
+    if __debug__: log('writing {} trace events to {}', len(_events), file)
+    pid = os.getpid()
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+               'args': {'name': name}} for tid, name in list(_threads.items())]
+    events += [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': ts,
+                'dur': dur, 'args': args} for (name, tid, ts, dur, args) in list(_events)]
+    with open(file, 'w', encoding = 'utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def background_logging():
+    '''Makes debug log messages be written by a separate thread.  Must be
+    called after sidetrack's set_debug(); does nothing if debug logging is
+    not turned on.'''
+    import logging
+    from logging.handlers import QueueHandler, QueueListener
+    from queue import SimpleQueue
+    logger = logging.getLogger('sidetrack')
+    handlers = [h for h in logger.handlers if not isinstance(h, QueueHandler)]
+    if not handlers:
+        return
+    queue = SimpleQueue()
+    listener = QueueListener(queue, *handlers, respect_handler_level = True)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(queue))
+    listener.start()
+    # Messages still on the queue are written before the program exits.
+    atexit.register(listener.stop)
+
+
+# Internal implementation.
+# .............................................................................
+
+class _NoSpan(object):
+    '''Context manager that does nothing, used when tracing is off.'''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+
+    def __exit__(self, exc_type, *args):
+        end = perf_counter_ns()
+        tid = get_ident()
+        if tid not in _threads:
+            _threads[tid] = current_thread().name
+        if exc_type:
+            self.args['error'] = exc_type.__name__
+        # Chrome trace times are in microseconds.  list.append is atomic, so
+        # threads can add events without a lock.
+        _events.append((self.name, tid, (self.start - _origin) // 1000,
+                        (end - self.start) // 1000, self.args))
+        return False
@@ -0,0 +1,154 @@
+'''
+transforms.py: apply user-supplied functions to records during a download
+
+A transform is a function that takes one MARC record, as an lxml element,
+and returns what should be written in its place: the same element (possibly
+changed in place), a different element, a list of elements (to split a
+record into several), or None (to drop the record).  Transforms let a site
+do its usual post-processing -- removing local fields, normalizing 856
+URLs, adding a provenance note -- while the records stream through the page
+pipeline, instead of in separate passes over the output file afterward.
+
+Transforms are named in one of two ways:
+
+  module:function   -- the function 'function' in the importable module
+                       'module' (e.g., "mysite.marc:strip_local")
+  name              -- a transform registered by an installed package under
+                       the entry point group "martian.transforms"
+
+A RecordTransform combines a list of transforms into one conversion stage
+for a PagePipeline (see pipeline.py), applying them in order to each record
+of a page.  The elements of a record are in the MARC XML namespace, so
+lxml paths have to include it (see the constant MARC).  The stage runs
+wherever the pipeline does its conversion: on the pipeline's writer thread,
+or in its worker processes if it has any.  Transform functions must
+therefore be defined at the top level of a module, so that they can be sent
+to worker processes.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import copy
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.exceptions import *
+
+
+# Constants.
+# .............................................................................
+
+ENTRY_POINT_GROUP = 'martian.transforms'
+'''Entry point group under which packages can register transforms.'''
+
+MARC = '{http://www.loc.gov/MARC21/slim}'
+'''Namespace prefix of the MARC elements, for use in lxml paths such as
+record.findall(MARC + 'datafield').'''
+
+_MARC_NS          = 'http://www.loc.gov/MARC21/slim'
+_COLLECTION_START = b'<collection xmlns="http://www.loc.gov/MARC21/slim">'
+_COLLECTION_END   = b'</collection>'
+_NAMESPACE_DECL   = b' xmlns="http://www.loc.gov/MARC21/slim"'
+
+
+# Exported functions.
+# .............................................................................
+
+def load_transform(spec):
+    '''Returns the transform function named by 'spec', which is either
+    "module:function" or the name of a registered entry point.'''
+    if ':' in spec:
+        import importlib
+        (module_name, func_name) = spec.split(':', 1)
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as ex:
+            raise TransformError('Cannot import {}: {}'.format(module_name, ex))
+        func = getattr(module, func_name, None)
+    else:
+        from importlib.metadata import entry_points
+        found = [ep for ep in entry_points(group = ENTRY_POINT_GROUP) if ep.name == spec]
+        if not found:
+            raise TransformError('No transform named "{}" is installed'.format(spec))
+        func = found[0].load()
+    if not callable(func):
+        raise TransformError('"{}" is not a function'.format(spec))
+    if __debug__: log('loaded transform {}', spec)
+    return func
+
+
+def load_transforms(specs):
+    '''Returns a RecordTransform for the comma-separated list of transform
+    names in the string 'specs'.'''
+    return RecordTransform([load_transform(spec.strip())
+                            for spec in specs.split(',') if spec.strip()])
+
+
+# Main class.
+# .............................................................................
+
+class RecordTransform(object):
+    '''Conversion stage that applies the functions 'funcs', in order, to
+    each record of a page.  Call it with the records of a page (as bytes,
+    without the collection element) to get the transformed records.'''
+
+    def __init__(self, funcs):
+        self.funcs = list(funcs)
+
+
+    def __call__(self, body):
+        from lxml import etree
+        collection = etree.fromstring(_COLLECTION_START + body + _COLLECTION_END)
+        records = list(collection)
+        for func in self.funcs:
+            records = [result for record in records
+                       for result in _results(func, record)]
+        # Records made by a transform can have the MARC namespace under a
+        # prefix of lxml's choosing ("ns0:record").  Gathering the results in
+        # a collection whose default namespace is MARC's, and moving all the
+        # declarations up to it, makes every record come out unprefixed.
+        results = etree.Element(MARC + 'collection', nsmap = {None: _MARC_NS})
+        for record in records:
+            if record.getparent() is results:
+                # A transform returned the same element more than once.
+                record = copy.deepcopy(record)
+            results.append(record)
+        etree.cleanup_namespaces(results, top_nsmap = {None: _MARC_NS})
+        # Serialized records would otherwise each repeat the namespace
+        # declaration of the collection element they came from.
+        return b''.join(etree.tostring(record, with_tail = False)
+                        .replace(_NAMESPACE_DECL, b'', 1) + b'\n' for record in results)
+
+
+    def __bool__(self):
+        return bool(self.funcs)
+
+
+    def __repr__(self):
+        return '<RecordTransform {}>'.format(', '.join(f.__name__ for f in self.funcs))
+
+
+# Internal implementation.
+# .............................................................................
+
+def _results(func, record):
+    try:
+        result = func(record)
+    except Exception as ex:
+        raise TransformError('Transform {} failed: {}'.format(func.__name__, ex))
+    if result is None:
+        return ()
+    if isinstance(result, (list, tuple)):
+        return result
+    return (result,)
@@ -0,0 +1,353 @@
+'''
+transport.py: HTTP transport used by Martian to fetch pages from TIND
+
+The MARC XML pages are fetched with pycurl, which is considerably faster than
+requests for large bodies.  The Transport object wraps a single Curl handle
+that is reused from one request to the next, so that the connection to the
+server is kept alive between pages.  Each call to get() returns the status
+code, the body, and a breakdown of where the time went, taken from Curl's
+getinfo() values.
+
+Transfers are limited by a Timeouts object: a connection that can't be made
+within a time limit, a page that takes too long overall, and a transfer that
+stalls (moves fewer than a given number of bytes per second for a given
+number of seconds) all end in a pycurl.error, so that the page can be
+fetched again.  A transfer in progress can also be cancelled from another
+thread by setting a threading.Event given to get(); Curl checks it from its
+progress callback, several times a second, even while the connection is
+silent.
+
+A TransportPool keeps Transport objects (and their open connections) around
+after use, so that a long-running process can reuse warm connections across
+many downloads.  The Transports in a pool share a DNS cache and TLS session
+cache, and the pool also provides a shared requests Session for the calls
+made through network.net().  A pool is meant to serve one server, and can
+also limit the number of connections open to it at once, space out the
+requests made to it, and keep track of whether it seems to be healthy,
+turning requests away for a while when it does not.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+try:
+    from io import BytesIO
+except ImportError:
+    from StringIO import StringIO as BytesIO
+from   threading import Lock, Semaphore
+import time
+
+if __debug__:
+    from sidetrack import log, logr
+
+from .exceptions import *
+
+
+# Exported classes.
+# .............................................................................
+
+class Timeouts(object):
+    '''Limits on transfers, in seconds: 'connect' for making a connection and
+    'total' for a whole transfer.  A transfer is also abandoned if it moves
+    fewer than 'low_speed' bytes per second for 'low_speed_time' seconds.
+    A value of 0 means no limit.'''
+
+    __slots__ = ('connect', 'total', 'low_speed', 'low_speed_time')
+
+    def __init__(self, connect = 30, total = 600, low_speed = 100, low_speed_time = 60):
+        self.connect        = connect
+        self.total          = total
+        self.low_speed      = low_speed
+        self.low_speed_time = low_speed_time
+
+
+    def apply(self, curl):
+        import pycurl
+        curl.setopt(pycurl.CONNECTTIMEOUT, int(self.connect))
+        curl.setopt(pycurl.TIMEOUT, int(self.total))
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, int(self.low_speed))
+        curl.setopt(pycurl.LOW_SPEED_TIME, int(self.low_speed_time))
+
+
+class Timing(object):
+    '''Durations (in seconds) of the phases of one HTTP transfer.
+
+    The phases are computed from Curl's cumulative timers:
+      dns      = time to resolve the host name
+      connect  = time to establish the TCP connection (after DNS)
+      tls      = time for the TLS handshake (0 for plain http or reused
+                 connections)
+      ttfb     = time from sending the request to the first byte of the reply
+      transfer = time to receive the rest of the body
+      total    = total time for the transfer
+    '''
+
+    __slots__ = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'total')
+
+    def __init__(self, dns = 0, connect = 0, tls = 0, ttfb = 0, transfer = 0, total = 0):
+        self.dns      = dns
+        self.connect  = connect
+        self.tls      = tls
+        self.ttfb     = ttfb
+        self.transfer = transfer
+        self.total    = total
+
+
+    @classmethod
+    def from_curl(cls, curl):
+        import pycurl
+        namelookup    = curl.getinfo(pycurl.NAMELOOKUP_TIME)
+        connect       = curl.getinfo(pycurl.CONNECT_TIME)
+        appconnect    = curl.getinfo(pycurl.APPCONNECT_TIME)
+        pretransfer   = curl.getinfo(pycurl.PRETRANSFER_TIME)
+        starttransfer = curl.getinfo(pycurl.STARTTRANSFER_TIME)
+        total         = curl.getinfo(pycurl.TOTAL_TIME)
+        return cls(dns      = namelookup,
+                   connect  = max(0, connect - namelookup),
+                   tls      = max(0, appconnect - connect) if appconnect else 0,
+                   ttfb     = max(0, starttransfer - pretransfer),
+                   transfer = max(0, total - starttransfer),
+                   total    = total)
+
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Response(object):
+    '''Result of a Transport.get(): status code, body bytes, and Timing.'''
+
+    __slots__ = ('status', 'body', 'timing')
+
+    def __init__(self, status, body, timing):
+        self.status = status
+        self.body   = body
+        self.timing = timing
+
+
+class Transport(object):
+    '''Fetches URLs using a reused pycurl handle.  Not thread-safe: each
+    thread that fetches pages needs its own Transport object.'''
+
+    def __init__(self, share = None, pool = None, timeouts = None):
+        self._curl     = None
+        self._share    = share
+        self._pool     = pool
+        self._timeouts = timeouts or Timeouts()
+
+
+    def get(self, url, headers = None, cancel = None):
+        '''Performs an HTTP GET on 'url' and returns a Response object.
+        'headers' is an optional list of extra header lines to send, such
+        as "Authorization: Token xyz".  If 'cancel' is given, it must be a
+        threading.Event; setting it aborts the transfer, and get() then
+        raises UserCancelled.  Other exceptions raised by pycurl
+        (pycurl.error, including timeouts) are passed through.'''
+        # pycurl loads libcurl and its TLS libraries, so don't import it
+        # until the first time it's actually needed.
+        import pycurl
+        if self._curl is None:
+            import certifi
+            self._curl = pycurl.Curl()
+            self._curl.setopt(pycurl.CAINFO, certifi.where())
+            if self._share is not None:
+                self._curl.setopt(pycurl.SHARE, self._share)
+            self._timeouts.apply(self._curl)
+        buffer = BytesIO()
+        self._curl.setopt(pycurl.URL, url)
+        self._curl.setopt(pycurl.WRITEDATA, buffer)
+        self._curl.setopt(pycurl.HTTPHEADER, headers or [])
+        if cancel is not None:
+            # A nonzero return value from the callback aborts the transfer.
+            self._curl.setopt(pycurl.NOPROGRESS, 0)
+            self._curl.setopt(pycurl.XFERINFOFUNCTION,
+                              lambda *args: 1 if cancel.is_set() else 0)
+        else:
+            self._curl.setopt(pycurl.NOPROGRESS, 1)
+        if __debug__: log('curling "{}"', url)
+        if self._pool:
+            self._pool.pace()
+        try:
+            self._curl.perform()
+        except pycurl.error as ex:
+            # Don't reuse a handle whose connection is in an unknown state.
+            self.close()
+            if cancel is not None and cancel.is_set():
+                if __debug__: log('transfer of "{}" cancelled', url)
+                raise UserCancelled('transfer cancelled') from ex
+            if self._pool:
+                self._pool.record(False, ex)
+            raise
+        status = self._curl.getinfo(pycurl.RESPONSE_CODE)
+        if self._pool:
+            self._pool.record(status < 500 and status != 429, status)
+        return Response(status, buffer.getvalue(), Timing.from_curl(self._curl))
+
+
+    def close(self):
+        if self._curl is not None:
+            self._curl.close()
+            self._curl = None
+
+
+class TransportPool(object):
+    '''Thread-safe pool of Transport objects.  Callers acquire() a Transport,
+    use it from one thread, and release() it when done.  At most 'size' idle
+    Transports are kept; extra ones are closed when released.
+
+    If 'limit' is given, at most that many Transports can be in use at one
+    time, and acquire() waits until one is released.  If 'rate' is given,
+    the Transports from this pool make at most that many requests per second
+    between them.  The pool counts consecutive failed requests (connection
+    errors, 429 and 5xx responses); after 'max_failures' of them in a row it
+    is considered unhealthy until a request succeeds.  While it is unhealthy,
+    requests made within 'pause' seconds of the latest failure fail at once
+    with ServiceFailure, without reaching the server; the pause doubles with
+    each further failure, up to 'max_pause' seconds.  A server that is down
+    thus gets a rest, and pages meant for it use up their retries (and end
+    up in the failure log) quickly instead of waiting on it one by one.  The
+    Transports use the Timeouts object 'timeouts' (default: Timeouts()).'''
+
+    def __init__(self, size = 8, limit = None, rate = None, max_failures = 5,
+                 timeouts = None, pause = 5, max_pause = 60):
+        self._size     = size
+        self._idle     = []
+        self._lock     = Lock()
+        self._share    = None
+        self._session  = None
+        self._limit    = limit
+        self._slots    = Semaphore(limit) if limit else None
+        self._interval = 1 / rate if rate else 0
+        self._next     = 0
+        self._max_fail = max_failures
+        self._pause    = pause
+        self._max_wait = max_pause
+        self._failed_at = 0
+        self._timeouts = timeouts
+        self.requests  = 0
+        self.failures  = 0
+        self.last_error = None
+
+
+    @property
+    def healthy(self):
+        return self.failures < self._max_fail
+
+
+    def pace(self):
+        '''Waits until the pool's rate limit allows another request.  Raises
+        ServiceFailure without making the caller wait if the pool is
+        unhealthy and its pause after the latest failure is not over.'''
+        with self._lock:
+            now = time.monotonic()
+            excess = self.failures - self._max_fail
+            if excess >= 0:
+                pause = min(self._max_wait, self._pause * 2 ** min(excess, 16))
+                if now < self._failed_at + pause:
+                    raise ServiceFailure('{} requests in a row failed; holding back'
+                                         ' requests for {:.1f} s'.format(
+                                             self.failures, self._failed_at + pause - now))
+            if not self._interval:
+                return
+            when = max(now, self._next)
+            self._next = when + self._interval
+        if when > now:
+            time.sleep(when - now)
+
+
+    def record(self, ok, detail = None):
+        '''Records the outcome of a request made with a Transport from here.'''
+        with self._lock:
+            self.requests += 1
+            if ok:
+                self.failures = 0
+            else:
+                self.failures += 1
+                self.last_error = detail
+                self._failed_at = time.monotonic()
+                if __debug__ and self.failures == self._max_fail:
+                    log('transport pool is now unhealthy: {}', detail)
+
+
+    def widen(self, limit):
+        '''Raises the number of Transports that can be in use at one time to
+        at least 'limit', for callers that need that many at once.'''
+        with self._lock:
+            if not self._slots or limit <= self._limit:
+                return
+            if __debug__: log('raising transport pool limit from {} to {}',
+                              self._limit, limit)
+            for _ in range(limit - self._limit):
+                self._slots.release()
+            self._limit = limit
+            self._size = max(self._size, limit)
+
+
+    def acquire(self, cancel = None):
+        '''Returns a Transport, waiting for one to be released if the pool's
+        limit has been reached.  If the Event 'cancel' is set while waiting,
+        raises UserCancelled.'''
+        self._take_slot(cancel)
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._share is None:
+                import pycurl
+                # Sharing the connection cache between handles that are used
+                # from different threads is fragile in libcurl, so we only
+                # share DNS and TLS sessions.  Each Transport keeps its own
+                # connection open between uses.
+                self._share = pycurl.CurlShare()
+                self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+                self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            return Transport(self._share, self, self._timeouts)
+
+
+    def _take_slot(self, cancel):
+        if not self._slots:
+            return
+        if cancel is None:
+            self._slots.acquire()
+            return
+        while not self._slots.acquire(timeout = 0.1):
+            if cancel.is_set():
+                raise UserCancelled('stopped while waiting for a connection')
+
+
+    def release(self, transport):
+        if self._slots:
+            self._slots.release()
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(transport)
+                return
+        transport.close()
+
+
+    @property
+    def session(self):
+        '''A requests.Session shared by users of this pool.'''
+        with self._lock:
+            if self._session is None:
+                import requests
+                self._session = requests.Session()
+            return self._session
+
+
+    def close(self):
+        with self._lock:
+            for transport in self._idle:
+                transport.close()
+            self._idle = []
+            if self._session is not None:
+                self._session.close()
+                self._session = None
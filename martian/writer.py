@@ -0,0 +1,150 @@
+'''
+writer.py: write output files on a background thread
+
+A BackgroundWriter stands in front of an open binary file.  Calls to its
+write() method put the data on a queue and return at once; a separate thread
+takes everything waiting on the queue, joins it into chunks of up to
+'buffer_size' bytes, and writes each chunk to the file with one call.  The
+queue is bounded by the number of bytes in it ('budget'), not the number of
+items, and write() only blocks when the queue is full.  So a slow disk (for
+example, a network file system that stalls now and then) does not hold up
+the network transfers unless it falls behind by more than the budget.
+
+Errors from the underlying file are raised by the next call to write() or
+by close().
+
+When the file is a pipe (such as the standard output in a shell pipeline),
+the writer can be told to flush the file after every chunk, so that the
+program reading from the pipe gets the data as soon as it is written.  The
+budget then also provides backpressure: if the reader is slow, write()
+blocks, and with it the download.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2019-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+from   collections import deque
+from   threading import Condition, Thread
+
+if __debug__:
+    from sidetrack import log, logr
+
+from martian.tracing import span
+
+
+# Constants.
+# .............................................................................
+
+_BUFFER_SIZE = 4 * 1024 * 1024
+'''Default largest number of bytes written to the file in one call.'''
+
+_BUDGET_FACTOR = 8
+'''Default queue budget, as a multiple of the buffer size.'''
+
+
+# Main class.
+# .............................................................................
+
+class BackgroundWriter(object):
+    '''File-like object that writes to the open binary file 'file' from a
+    background thread.  At most 'budget' bytes (default: 8 times
+    'buffer_size') can be waiting to be written.  If 'flush' is True, the
+    file is flushed after each chunk is written.'''
+
+    def __init__(self, file, buffer_size = None, budget = None, flush = False):
+        self._file        = file
+        self._flush       = flush
+        self._buffer_size = buffer_size or _BUFFER_SIZE
+        self._budget      = budget or _BUDGET_FACTOR * self._buffer_size
+        self._chunks      = deque()
+        self._queued      = 0
+        self._closing     = False
+        self._error       = None
+        self._ready       = Condition()
+        self._thread      = Thread(target = self._write_loop, name = 'FileWriter',
+                                   daemon = True)
+        self._thread.start()
+
+
+    @property
+    def name(self):
+        return getattr(self._file, 'name', None)
+
+
+    def write(self, data):
+        '''Queues 'data' (bytes) to be written.  Blocks only while the queue
+        holds more than the budget allows.'''
+        if not data:
+            return
+        with self._ready:
+            # Always admit at least one item, so that a chunk bigger than the
+            # whole budget can't block forever.
+            while (self._queued and self._queued + len(data) > self._budget
+                   and not self._error):
+                with span('write-blocked'):
+                    self._ready.wait()
+            if self._error:
+                raise self._error
+            self._chunks.append(data)
+            self._queued += len(data)
+            self._ready.notify_all()
+
+
+    def close(self):
+        '''Waits for everything queued to be written, then closes the file.
+        Raises any error that occurred while writing.'''
+        with self._ready:
+            self._closing = True
+            self._ready.notify_all()
+        self._thread.join()
+        self._file.close()
+        if self._error:
+            raise self._error
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                while not self._chunks and not self._closing:
+                    self._ready.wait()
+                if not self._chunks:
+                    return
+                # Take as much as fits in one buffer (but at least one item).
+                batch = [self._chunks.popleft()]
+                size = len(batch[0])
+                while self._chunks and size + len(self._chunks[0]) <= self._buffer_size:
+                    size += len(self._chunks[0])
+                    batch.append(self._chunks.popleft())
+            try:
+                with span('disk-write', bytes = size):
+                    self._file.write(b''.join(batch) if len(batch) > 1 else batch[0])
+                    if self._flush:
+                        self._file.flush()
+            except Exception as ex:
+                if __debug__: log('background writer got exception: {}', str(ex))
+                with self._ready:
+                    self._error = ex
+                    self._chunks.clear()
+                    self._queued = 0
+                    self._ready.notify_all()
+                return
+            with self._ready:
+                self._queued -= size
+                self._ready.notify_all()